@@ -1,59 +1,167 @@
+import bisect
 import hashlib
-from bidict import bidict
+import io
+import itertools
+from array import array
+import mmap
 import os
+import re
 import requests
+import struct
+import sys
+import threading
 import time
-import tqdm
+import zlib
 from datetime import datetime, timezone, timedelta
 import json
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
+from concurrency import map_concurrently
+from metrics import metrics
+from records import DateTimeEncoder, JsonDocumentReader, RawJson, is_json_lines, iter_records, open_records, write_json_object
 
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+class IdAllocator:
+    """Deterministic 64-bit ids derived from SHA-256 of a key.
 
-class UniqueIdGenerator:
-    def __init__(self):
-        self.generated_ids_dict = bidict()
+    A key's id is the first 8 bytes of its digest; on collision the next
+    8-byte slices are tried, then salted digests. Issued ids live in an
+    open-addressed array('Q') table, and the key -> id map can be saved and
+    reloaded so that later runs keep every id they already handed out.
+    """
+    def __init__(self, keep_keys=True, capacity=1 << 10):
+        self.table = array('Q', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.size = 0
+        self.has_zero = False # 0 は空きスロットを表すので別に持つ
+        self.key_ids = {} if keep_keys else None
+        self.id_keys = None # id: key  (key_of を初めて呼んだときに作る)
+        self.saved = 0
 
-    def sha256(self, input_string):
-        return hashlib.sha256(input_string.encode('utf-8')).digest()
+    def __len__(self):
+        return self.size
 
-    def bytes_to_long(self, bytes):
-        return int.from_bytes(bytes[:8], byteorder='big')
-    
-    def add_id(self, input_string, id):
-        self.generated_ids_dict[id] = input_string
+    def digest(self, key):
+        return hashlib.sha256(key.encode('utf-8')).digest()
 
-    def generate_unique_id(self, input_string):
-        try:
-            hash_bytes = self.sha256(input_string)
-            unique_id = self.bytes_to_long(hash_bytes)
-            iteration = 0
-
-            # If the ID is already present, recalculate using different parts of the hash
-            while unique_id in self.generated_ids_dict:
-                iteration += 1
-                # Change the part of the hash used or use another hash function
-                if iteration < 4:
-                    unique_id = self.bytes_to_long(hash_bytes[iteration*8:(iteration+1)*8])
-                else:
-                    # If all parts of the hash are used, generate a new hash with a salt
-                    salted_input = input_string + str(iteration)
-                    hash_bytes = self.sha256(salted_input)
-                    unique_id = self.bytes_to_long(hash_bytes)
-            return unique_id
-        except Exception as e:
-            print(f"Error generating unique ID for input: {input_string}")
-            print(f"Exception: {e}")
-            raise
-    def assign_unique_id(self, input_string):
-        unique_id = self.generate_unique_id(input_string)
-        self.add_id(input_string, unique_id)
-        return unique_id
+    def first_id(self, digest):
+        return int.from_bytes(digest[:8], byteorder='big')
+
+    def candidate_ids(self, key, digest):
+        # If the ID is already present, recalculate using different parts of the hash
+        for iteration in range(4):
+            yield int.from_bytes(digest[iteration*8:(iteration+1)*8], byteorder='big')
+        iteration = 4
+        while True:
+            # If all parts of the hash are used, generate a new hash with a salt
+            yield self.first_id(self.digest(key + str(iteration)))
+            iteration += 1
+
+    def __contains__(self, id):
+        if id == 0:
+            return self.has_zero
+        table, mask = self.table, self.mask
+        slot = id & mask
+        while True:
+            value = table[slot]
+            if value == id:
+                return True
+            if value == 0:
+                return False
+            slot = (slot + 1) & mask
+
+    def insert_id(self, id):
+        """Record id and return True, or return False if it was already issued."""
+        if id == 0:
+            if self.has_zero:
+                return False
+            self.has_zero = True
+            self.size += 1
+            return True
+        if (self.size + 1) * 2 > len(self.table):
+            self.grow()
+        table, mask = self.table, self.mask
+        slot = id & mask
+        while True:
+            value = table[slot]
+            if value == 0:
+                table[slot] = id
+                self.size += 1
+                return True
+            if value == id:
+                return False
+            slot = (slot + 1) & mask
+
+    def grow(self):
+        old_table = self.table
+        self.table = array('Q', bytes(16 * len(old_table)))
+        self.mask = len(self.table) - 1
+        for id in old_table:
+            if id != 0:
+                slot = id & self.mask
+                while self.table[slot] != 0:
+                    slot = (slot + 1) & self.mask
+                self.table[slot] = id
+
+    def assign(self, key, digest=None):
+        if self.key_ids is not None:
+            id = self.key_ids.get(key)
+            if id is not None:
+                return id
+        digest = digest or self.digest(key)
+        id = int.from_bytes(digest[:8], byteorder='big')
+        if not self.insert_id(id):
+            id = next(id for id in self.candidate_ids(key, digest) if self.insert_id(id))
+        if self.key_ids is not None:
+            self.key_ids[key] = id
+            if self.id_keys is not None:
+                self.id_keys[id] = key
+        return id
+
+    def key_of(self, id):
+        """Return the key that id was assigned to, or None."""
+        if self.key_ids is None:
+            return None
+        if self.id_keys is None:
+            # 逆引きを使わない構築では持たずに済むよう，最初の問い合わせで作ってから更新していく
+            self.id_keys = {id: key for key, id in self.key_ids.items()}
+        return self.id_keys.get(id)
+
+    def assign_many(self, keys, digests=None):
+        """Assign ids to keys in order, from digests computed elsewhere (e.g. in worker processes) if given.
+
+        hashlib has no batched SHA-256, so without digests they are computed
+        in one pass first; the gain comes from passing digests in.
+        """
+        keys = list(keys)
+        if digests is None:
+            sha256 = hashlib.sha256
+            digests = [sha256(key.encode('utf-8')).digest() for key in keys]
+        return [self.assign(key, digest) for key, digest in zip(keys, digests)]
+
+    def load(self, filepath):
+        print(f"Loading ids from {filepath}")
+        with open(filepath, 'r', encoding='utf-8') as id_file:
+            for line in id_file:
+                id, key = line.rstrip('\n').split('\t', 1)
+                key = json.loads(key)
+                if key not in self.key_ids:
+                    self.register(key, int(id))
+        self.saved = len(self.key_ids)
+
+    def register(self, key, id):
+        # 以前の実行で発行した id をそのまま使う
+        if self.key_ids is not None and key is not None and key not in self.key_ids:
+            self.key_ids[key] = id
+            if self.id_keys is not None:
+                self.id_keys[id] = key
+        self.insert_id(id)
+
+    def save(self, filepath):
+        # 前回の保存以降に割り当てたものだけを追記する
+        with open(filepath, 'a', encoding='utf-8') as id_file:
+            for key, id in itertools.islice(self.key_ids.items(), self.saved, None):
+                id_file.write(f"{id}\t{json.dumps(key)}\n")
+        self.saved = len(self.key_ids)
 
 class Node:
     def __init__(self):
@@ -140,16 +248,6 @@ class FileNode(Node):
         ('patch', 'patch'),
         ('previous_filename', 'previous_filename'),
         ]
-    def __init__(self, file, need_extract=True):
-        self.file = file
-        if not need_extract:
-            self.data = file
-            return
-        self.data = self.extract_and_rename(file, self.extract_keys_for_file)
-        self.data['directory'] = os.path.dirname(self.data['filename'])
-        extension = os.path.splitext(self.data['filename'])[1]
-        self.data['label'] = ['file', extension]
-    
     def __init__(self, file, sha, need_extract=True):
         self.file = file
         self.commit_sha = sha
@@ -169,6 +267,23 @@ class FileNode(Node):
     
     def get_name(self):
         return self.data['filename']
+
+    def detach_patch(self):
+        """Replace the patch with a PatchStore reference and return (ref, compressed patch).
+
+        Returns None if the file has no patch.
+        """
+        if self.data.get('patch') is None:
+            return None
+        ref, blob = PatchStore.pack_patch(self.data['patch'])
+        # patch_ref は patch と同じ位置に置く
+        self.data = {('patch_ref' if key == 'patch' else key): (ref if key == 'patch' else value) for key, value in self.data.items()}
+        return ref, blob
+
+    def get_patch(self, patch_store=None):
+        if 'patch_ref' in self.data and patch_store is not None:
+            return patch_store.get(self.data['patch_ref'])
+        return self.data.get('patch')
     
     def get_status(self):
         return self.data['status']
@@ -189,114 +304,504 @@ class FileNode(Node):
         return self.data
         
 
+class Scope:
+    """Restricts a build to path prefixes, file extensions and a committer date range.
+
+    Paths and dates are pushed down to the commit listing (api_params);
+    apply() drops the commits outside the date range and the files outside
+    the paths and extensions, and drops a commit left with no files when
+    paths or extensions are given. Dates are "%Y-%m-%dT%H:%M:%SZ" strings
+    and both bounds are inclusive, as in the API.
+    """
+    def __init__(self, paths=None, extensions=None, since=None, until=None):
+        # 'sql/core/' と 'sql/core' は同じ範囲を表す
+        self.paths = tuple(sorted({path.strip('/') for path in paths or [] if path.strip('/')}))
+        self.extensions = tuple(sorted({extension if extension.startswith('.') or not extension else '.' + extension for extension in extensions or []}))
+        self.since = since
+        self.until = until
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**(data or {}))
+
+    def to_dict(self):
+        return {'paths': list(self.paths), 'extensions': list(self.extensions), 'since': self.since, 'until': self.until}
+
+    def __bool__(self):
+        return bool(self.paths or self.extensions or self.since or self.until)
+
+    def __eq__(self, other):
+        return isinstance(other, Scope) and self.to_dict() == other.to_dict()
+
+    def api_params(self):
+        """Return the query parameters of each commit listing; the API takes one path per listing."""
+        params = {key: value for key, value in (('since', self.since), ('until', self.until)) if value}
+        return [dict(params, path=path) for path in self.paths] or [params]
+
+    def matches_path(self, filename):
+        return not self.paths or any(filename == path or filename.startswith(path + '/') for path in self.paths)
+
+    def matches_file(self, file):
+        if self.extensions and os.path.splitext(file['filename'])[1] not in self.extensions:
+            return False
+        # 範囲の外へ移動したファイルも範囲から消えた変更として含める
+        return self.matches_path(file['filename']) or bool(file.get('previous_filename')) and self.matches_path(file['previous_filename'])
+
+    def matches_date(self, date):
+        return (not self.since or date >= self.since) and (not self.until or date <= self.until)
+
+    def apply(self, commit):
+        """Return the commit with only the files in scope, or None if it is out of scope."""
+        if not self:
+            return commit
+        if not self.matches_date(commit['commit']['committer']['date']):
+            return None
+        if not (self.paths or self.extensions):
+            return commit
+        files = [file for file in commit['files'] if self.matches_file(file)]
+        if not files:
+            return None
+        return dict(commit, files=files)
+
+    def filter(self, commits):
+        for commit in commits:
+            commit = self.apply(commit)
+            if commit is not None:
+                yield commit
+
+
+class LabelTable:
+    """Interns label lists as small integer codes."""
+    def __init__(self):
+        self.labels = []
+        self.codes = {}
+
+    def encode(self, label):
+        label = tuple(label)
+        code = self.codes.get(label)
+        if code is None:
+            code = len(self.labels)
+            self.codes[label] = code
+            self.labels.append(label)
+        return code
+
+    def decode(self, code):
+        return list(self.labels[code])
+
+
+class NodeRecord:
+    __slots__ = ('id', 'label', 'property')
+
+    def __init__(self, id, label, property):
+        self.id = id
+        self.label = label
+        self.property = property
+
+
 class Nodes:
+    # 値の種類が少ないプロパティは文字列を共有する
+    interned_properties = ('author_name', 'author_email', 'committer_name', 'committer_email', 'status', 'directory')
+
     def __init__(self):
-        self.nodes = {}
-        self.sha_id_map = bidict()
-        self.unique_id_generator = UniqueIdGenerator()
-
-    def add_node(self, node):
-        if node.get_hash() in self.sha_id_map:
-            print(f"Node {node.get_hash()} is already recorded.")
-            print(f"ID is {self.sha_id_map[node.get_hash()]}")
-            return
-        id = self.unique_id_generator.generate_unique_id(node.get_hash())
-        self.sha_id_map[node.get_hash()] = id
-        node_data = node.to_dict().copy()
+        self.records = {} # id: NodeRecord (追加順)
+        self.id_allocator = IdAllocator()
+        self.sha_id_map = self.id_allocator.key_ids # hash: id
+        self.labels = LabelTable()
+
+    def __len__(self):
+        return len(self.records)
+
+    def add_node(self, node, id=None, digest=None):
+        id = self.add_record(node.get_hash(), node.to_dict(), id, digest)
+        if id is not None:
+            node.assign_id(id)
+
+    def add_record(self, key, data, id=None, digest=None):
+        """Record a node's data, including its label, and return its id.
+
+        Returns None if a node with the same key is already recorded.
+        """
+        if id is None:
+            id = self.sha_id_map.get(key)
+        if id is not None and id in self.records:
+            metrics.inc('graph_duplicate_nodes_total')
+            return None
+        if id is None:
+            id = self.id_allocator.assign(key, digest)
+        node_data = data.copy()
         label = node_data.pop('label')
-        
-        self.nodes[node.get_hash()] = {
-            "id": id,
-            "label": label,
-            "property": node_data
+        for name in self.interned_properties:
+            if isinstance(node_data.get(name), str):
+                node_data[name] = sys.intern(node_data[name])
+
+        self.records[id] = NodeRecord(id, self.labels.encode(label), node_data)
+        return id
+
+    def add_nodes(self, nodes, digests=None):
+        nodes = list(nodes)
+        ids = self.id_allocator.assign_many((node.get_hash() for node in nodes), digests)
+        for node, id in zip(nodes, ids):
+            self.add_node(node, id)
+
+    def to_node_dict(self, record):
+        return {
+            "id": record.id,
+            "label": self.labels.decode(record.label),
+            "property": record.property
         }
-        node.assign_id(id)
 
-    def add_nodes(self, nodes):
-        for node in nodes:
-            self.add_node(node)
+    def iter_nodes(self):
+        for record in self.records.values():
+            yield self.to_node_dict(record)
 
     def get_nodes(self):
-        return self.nodes
-    
+        # 互換のため hash をキーにした辞書を作って返す．出力には iter_nodes を使う
+        shas = {id: sha for sha, id in self.sha_id_map.items()}
+        return {shas[record.id]: self.to_node_dict(record) for record in self.records.values()}
+
     def get_id(self, sha):
-        if sha in self.sha_id_map:
-            return self.sha_id_map[sha]
-        else:
-            id = self.unique_id_generator.generate_unique_id(sha)
-            self.sha_id_map[sha] = id
-            return id
+        id = self.sha_id_map.get(sha)
+        if id is None:
+            id = self.id_allocator.assign(sha)
+        return id
+
+    def load_id_map(self, filepath):
+        self.id_allocator.load(filepath)
+
+    def save_id_map(self, filepath):
+        self.id_allocator.save(filepath)
+
     def get_sha(self, id):
-        if id in self.sha_id_map.inverse:
-            return self.sha_id_map.inverse[id]
-        else:
-            return None
+        return self.id_allocator.key_of(id)
 
     def load_nodes(self, filepath):
-        try:
-            with open(filepath, 'r') as json_file:
-                print(f"Loading nodes from {filepath}")
-                data = json.load(json_file)
-                for node_data in data:
-                    if 'commit' in node_data['label']:
-                        node = CommitNode(node_data, need_extract=False)
-                    else:
-                        node = FileNode(node_data, need_extract=False)
-                    
-                    self.add_node(node)
-        except Exception as e:
-            print(f"Error loading JSON from {filepath}")
-            print(f"Exception: {e}")
+        """Add the nodes of a nodes file written earlier, keeping their ids.
+
+        Commit nodes are keyed by their sha. File nodes are keyed through the
+        id map, so load it first if they will be looked up again.
+        """
+        print(f"Loading nodes from {filepath}")
+        keys = {id: key for key, id in self.sha_id_map.items()}
+        for record in iter_records(filepath):
+            key = keys.get(record['id'])
+            if key is None and 'commit' in record['label']:
+                key = record['property']['sha']
+            self.id_allocator.register(key, record['id'])
+            self.add_record(key, dict(record['property'], label=record['label']), record['id'])
 
 class Edges:
+    """Edges stored column-wise: endpoints and ids in array('Q'), labels as LabelTable codes.
+
+    An edge is keyed by the hash of its src, dst and label. finalize()
+    freezes the current edges into an EdgeIndex for neighbor queries;
+    adding an edge afterwards drops the index, and the first query after
+    that builds it again.
+    """
     def __init__(self):
-        self.edges = {}
-        self.src_dict = {}
-        self.dst_dict = {}
-        self.unique_id_generator = UniqueIdGenerator()
+        self.src = array('Q')
+        self.dst = array('Q')
+        self.ids = array('Q')
+        self.label_codes = array('I')
+        self.properties = [] # None: {}, dict 以外: {'date': 値}, dict: そのまま
+        self.rows = {} # hash の先頭8バイト: row
+        self.colliding_rows = {} # (src, dst, label code): row  (id が衝突した辺)
+        self.labels = LabelTable()
+        self.index = None
+        self.id_allocator = IdAllocator(keep_keys=False)
 
-    def add_edge(self, edge):
-        if (edge['src'], edge['dst'], tuple(edge['label'])) in self.edges:
+    def __len__(self):
+        return len(self.ids)
+
+    def find_row(self, src, dst, label_code, hash_id):
+        row = self.rows.get(hash_id)
+        if row is not None and (self.src[row], self.dst[row], self.label_codes[row]) == (src, dst, label_code):
+            return row
+        return self.colliding_rows.get((src, dst, label_code))
+
+    def add_edge(self, edge, digest=None):
+        label_code = self.labels.encode(edge['label'])
+        key = str(edge['src'])+str(edge['dst'])+''.join(edge['label'])
+        digest = digest or self.id_allocator.digest(key)
+        hash_id = self.id_allocator.first_id(digest)
+        if self.find_row(edge['src'], edge['dst'], label_code, hash_id) is not None:
             return
-        id = self.unique_id_generator.generate_unique_id(str(edge['src'])+str(edge['dst'])+''.join(edge['label']))
+        id = self.id_allocator.assign(key, digest)
         edge['id'] = id
-        self.edges[(edge['src'], edge['dst'], tuple(edge['label']))] = edge
-        if edge['src'] in self.src_dict:
-            self.src_dict[edge['src']].append(edge['dst'])
+        row = len(self.ids)
+        if hash_id in self.rows:
+            self.colliding_rows[(edge['src'], edge['dst'], label_code)] = row
         else:
-            self.src_dict[edge['src']] = [edge['dst']]
-        if edge['dst'] in self.dst_dict:
-            self.dst_dict[edge['dst']].append(edge['src'])
-        else:
-            self.dst_dict[edge['dst']] = [edge['src']]
+            self.rows[hash_id] = row
+        self.src.append(edge['src'])
+        self.dst.append(edge['dst'])
+        self.ids.append(id)
+        self.label_codes.append(label_code)
+        self.properties.append(self.pack_property(edge.get('property', {})))
+        self.index = None
 
     def add_edges(self, edges):
         for edge in edges:
             self.add_edge(edge)
 
+    def pack_property(self, property):
+        if not property:
+            return None
+        if len(property) == 1 and 'date' in property and not isinstance(property['date'], dict):
+            return property['date']
+        return property
+
+    def unpack_property(self, packed):
+        if packed is None:
+            return {}
+        if isinstance(packed, dict):
+            return packed
+        return {'date': packed}
+
+    def to_edge_dict(self, row):
+        return {
+            'src': self.src[row],
+            'dst': self.dst[row],
+            'label': self.labels.decode(self.label_codes[row]),
+            'property': self.unpack_property(self.properties[row]),
+            'id': self.ids[row],
+        }
+
+    def iter_edges(self):
+        for row in range(len(self.ids)):
+            yield self.to_edge_dict(row)
+
     def get_edges(self):
-        return self.edges
-    
+        # 互換のため (src, dst, label) をキーにした辞書を作って返す．出力には iter_edges を使う
+        return {(edge['src'], edge['dst'], tuple(edge['label'])): edge for edge in self.iter_edges()}
+
+    def finalize(self):
+        # add_edge で None に戻るので，前回から辺が増えていなければ作った索引をそのまま使う
+        if self.index is None:
+            self.index = self.build_index()
+        return self.index
+
+    def build_index(self):
+        return EdgeIndex.from_edges(self)
+
     def get_dsts(self, src_id):
-        if src_id in self.src_dict:
-            return self.src_dict[src_id]
-        else:
-            return []
-    
+        return self.finalize().neighbors(src_id, 'out')
+
     def get_srcs(self, dst_id):
-        if dst_id in self.dst_dict:
-            return self.dst_dict[dst_id]
-        else:
+        return self.finalize().neighbors(dst_id, 'in')
+
+
+class EdgeIndex:
+    """Read-only CSR adjacency built from Edges, in both directions.
+
+    Node ids are mapped to their position in the sorted node_ids array.
+    Each node's row holds its neighbors grouped by label code, so a query
+    only scans the entries of the labels it asks for. save() writes the
+    arrays into one file that load() maps back without copying.
+    """
+    magic = b'PGCSR\x00\x00\x01'
+    array_names = ('node_ids', 'out_offsets', 'out_targets', 'out_codes', 'in_offsets', 'in_targets', 'in_codes')
+
+    def __init__(self, labels, arrays):
+        self.labels = [tuple(label) for label in labels]
+        for name in self.array_names:
+            setattr(self, name, arrays[name])
+        self.edge_count = len(self.out_targets)
+        self.label_specs = {}
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @staticmethod
+    def build_csr(sources, targets, codes, node_count, code_count):
+        # (source, code, target) を1つの整数にして並べ替える
+        keys = sorted([(source * code_count + code) * node_count + target for source, target, code in zip(sources, targets, codes)])
+        counts = [0] * (node_count + 1)
+        for source in sources:
+            counts[source + 1] += 1
+        offsets = array('Q', itertools.accumulate(counts))
+        csr_targets = array('I', [key % node_count for key in keys])
+        csr_codes = array('I', [key // node_count % code_count for key in keys])
+        return offsets, csr_targets, csr_codes
+
+    @classmethod
+    def from_edges(cls, edges):
+        return cls.from_columns(edges.src, edges.dst, edges.label_codes, edges.labels.labels)
+
+    @classmethod
+    def from_columns(cls, src, dst, label_codes, labels):
+        node_ids = array('Q', sorted(set(src) | set(dst)))
+        positions = {id: position for position, id in enumerate(node_ids)}
+        sources = [positions[id] for id in src]
+        targets = [positions[id] for id in dst]
+        node_count, code_count = len(node_ids), max(1, len(labels))
+        arrays = {'node_ids': node_ids}
+        arrays['out_offsets'], arrays['out_targets'], arrays['out_codes'] = cls.build_csr(sources, targets, label_codes, node_count, code_count)
+        arrays['in_offsets'], arrays['in_targets'], arrays['in_codes'] = cls.build_csr(targets, sources, label_codes, node_count, code_count)
+        return cls(labels, arrays)
+
+    def position(self, id):
+        position = bisect.bisect_left(self.node_ids, id)
+        if position < len(self.node_ids) and self.node_ids[position] == id:
+            return position
+        return None
+
+    def label_codes(self, labels):
+        """Return the label codes matching labels, or None for all labels.
+
+        labels is a label name or a list of them; a name matches every label
+        containing it, and a tuple matches that exact label.
+        """
+        if labels is None:
+            return None
+        if isinstance(labels, (str, tuple)):
+            labels = [labels]
+        key = tuple(labels)
+        if key not in self.label_specs:
+            self.label_specs[key] = frozenset(
+                code for code, label in enumerate(self.labels)
+                if any(spec == label if isinstance(spec, tuple) else spec in label for spec in labels)
+            )
+        return self.label_specs[key]
+
+    def csr(self, direction):
+        if direction == 'out':
+            return [(self.out_offsets, self.out_targets, self.out_codes)]
+        if direction == 'in':
+            return [(self.in_offsets, self.in_targets, self.in_codes)]
+        if direction == 'both':
+            return self.csr('out') + self.csr('in')
+        raise ValueError(f"Unknown direction: {direction}")
+
+    def iter_adjacent(self, position, csr, codes):
+        for offsets, targets, target_codes in csr:
+            for entry in range(offsets[position], offsets[position + 1]):
+                if codes is None or target_codes[entry] in codes:
+                    yield targets[entry]
+
+    def neighbors(self, id, direction='out', labels=None):
+        """Return the ids adjacent to id, each once."""
+        return self.k_hop(id, 1, direction, labels)
+
+    def k_hop(self, id, k=1, direction='out', labels=None):
+        """Return the ids within k hops of id (any distance if k is None), nearest first."""
+        start = self.position(id)
+        if start is None:
             return []
-        
+        csr, codes = self.csr(direction), self.label_codes(labels)
+        visited = {start}
+        frontier = [start]
+        result = []
+        depth = 0
+        while frontier and (k is None or depth < k):
+            next_frontier = []
+            for position in frontier:
+                for adjacent in self.iter_adjacent(position, csr, codes):
+                    if adjacent not in visited:
+                        visited.add(adjacent)
+                        next_frontier.append(adjacent)
+            result.extend(self.node_ids[position] for position in next_frontier)
+            frontier = next_frontier
+            depth += 1
+        return result
+
+    def ancestors(self, commit_id, max_depth=None):
+        # isParentOf は親 -> 子 の向き
+        return self.k_hop(commit_id, max_depth, 'in', 'isParentOf')
+
+    def descendants(self, commit_id, max_depth=None):
+        return self.k_hop(commit_id, max_depth, 'out', 'isParentOf')
+
+    def version_chain(self, file_id):
+        """Return the versions of a file node from oldest to newest, including file_id."""
+        start = self.position(file_id)
+        if start is None:
+            return []
+        codes = self.label_codes('isPreviousVersionOf')
+        visited = {start}
+        chain = {}
+        for direction in ('in', 'out'):
+            csr = self.csr(direction)
+            position = start
+            chain[direction] = []
+            while True:
+                position = next((adjacent for adjacent in self.iter_adjacent(position, csr, codes) if adjacent not in visited), None)
+                if position is None:
+                    break
+                visited.add(position)
+                chain[direction].append(position)
+        positions = chain['in'][::-1] + [start] + chain['out']
+        return [self.node_ids[position] for position in positions]
+
+    def save(self, filepath):
+        # ヘッダの後に各配列を8バイト境界に揃えて並べる
+        header = {'labels': self.labels, 'arrays': {}}
+        offset = 0
+        for name in self.array_names:
+            values = getattr(self, name)
+            header['arrays'][name] = [values.format if isinstance(values, memoryview) else values.typecode, offset, len(values)]
+            offset += -(-len(values) * values.itemsize // 8) * 8
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_bytes += b' ' * (-len(header_bytes) % 8)
+        with open(filepath, 'wb') as index_file:
+            index_file.write(struct.pack('<8sQ', self.magic, len(header_bytes)))
+            index_file.write(header_bytes)
+            for name in self.array_names:
+                data = bytes(getattr(self, name))
+                index_file.write(data + b'\x00' * (-len(data) % 8))
+
+    @classmethod
+    def load(cls, filepath):
+        """Map an index written by save(); the arrays are views into the file."""
+        with open(filepath, 'rb') as index_file:
+            buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size = struct.unpack_from('<8sQ', buffer)
+        if magic != cls.magic:
+            raise ValueError(f"{filepath} is not an edge index")
+        header = json.loads(buffer[16:16 + header_size])
+        view = memoryview(buffer)[16 + header_size:]
+        arrays = {}
+        for name, (typecode, offset, length) in header['arrays'].items():
+            arrays[name] = view[offset:offset + length * array(typecode).itemsize].cast(typecode)
+        return cls(header['labels'], arrays)
+
+
+def link_file_versions(shard):
+    """Return (before_id, file_id, status, timestamp) links for each file's versions.
+
+    shard is a list of (filename, versions) as yielded by Files.iter_versions.
+    A renamed version is not linked to older versions of the same name;
+    those are linked across the rename by Files.connect_files instead.
+    """
+    links = []
+    for filename, versions in shard:
+        # コミットの時系列を新しい順に (同時刻は元の順のまま)
+        versions = sorted(versions, key=lambda version: version[0], reverse=True)
+        for version, before in zip(versions, versions[1:]):
+            if version[2] == 'renamed':
+                continue
+            links.append((before[1], version[1], version[2], version[0]))
+    return links
+
+
 class Files:
+    epoch = datetime(1970, 1, 1)
+
     def __init__(self, api_setting):
         self.files = {} # filename: [FileNode]  
         self.file_commit_dict = {} # filename: [(commit_sha, commit_date)] commit_shaは新しい順になっている．
         self.api_setting = api_setting
+        self.dates = {} # 日付の文字列: datetime  同じコミットのファイルで使い回す
+        self.timestamps = {} # datetime: UNIX 時刻 (秒)
+        self.version_dates = {} # UNIX 時刻: datetime
+        self.loaded = {} # filename: load_files で読んだままの (files, commits) のテキスト．デコードしたら None
+        self.loaded_lines = False # 読んだのが JSON Lines か (字下げが違うのでテキストはそのまま書けない)
+        self.linked = {} # filename: 読み込んだ時点の版の数 (つなぎ済み)
 
     def add_file(self, sha, file, date):
-        date_obj = datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
+        self.decode_loaded(file.get_name())
+        date_obj = self.dates.get(date)
+        if date_obj is None:
+            date_obj = self.dates[date] = datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
         if file.get_name() not in self.files:
             self.files[file.get_name()] = {}
             self.files[file.get_name()][sha] = file
@@ -306,49 +811,138 @@ class Files:
             self.file_commit_dict[file.get_name()].append((sha, date_obj))
     
     def get_file(self, filename, sha):
+        self.decode_loaded(filename)
         return self.files[filename][sha]
 
-    def connect_files(self, edges):
-        for filename, commit_sha in tqdm.tqdm(self.file_commit_dict.items()):
-            if len(commit_sha) == 1:
-                continue
-            ind = 0
-            # コミットの時系列を新しい順に
-            commit_sha.sort(key=lambda x: x[1], reverse=True)
-            while ind < len(commit_sha)-1:
-                current_sha = commit_sha[ind][0]
-                current_file = self.files[filename][current_sha]
-                if current_file.get_status() == 'renamed' and current_file.get_name() == filename:
-                    ind += 1
-                    continue
-                before_sha = commit_sha[ind+1][0]
-                before_file = self.files[filename][before_sha]
-                edges.add_edge({'src': before_file.get_id(), 'dst': current_file.get_id(), 'label': ['isPreviousVersionOf', current_file.get_status()], 'property': {'date': commit_sha[ind][1]}})
-                ind += 1
+    def timestamp(self, date_obj):
+        timestamp = self.timestamps.get(date_obj)
+        if timestamp is None:
+            timestamp = self.timestamps[date_obj] = (date_obj - self.epoch) // timedelta(seconds=1)
+        return timestamp
+
+    def version_date(self, timestamp):
+        # 同じ時刻の辺では同じ datetime を共有する
+        date = self.version_dates.get(timestamp)
+        if date is None:
+            date = self.version_dates[timestamp] = self.epoch + timedelta(seconds=timestamp)
+        return date
+
+    def get_versions(self, filename):
+        """Return [(timestamp, file_id, status, commit_sha, previous_filename)] for filename, or None."""
+        self.decode_loaded(filename)
+        commits = self.file_commit_dict.get(filename)
+        if commits is None:
+            return None
+        files = self.files[filename]
+        versions = []
+        for sha, date_obj in commits:
+            data = files[sha].get_data()
+            timestamp = self.timestamps.get(date_obj)
+            if timestamp is None:
+                timestamp = self.timestamp(date_obj)
+            versions.append((timestamp, data['id'], data['status'], sha, data.get('previous_filename')))
+        return versions
+
+    def iter_versions(self):
+        for filename in self.iter_filenames():
+            yield filename, self.get_versions(filename)
+
+    def iter_unlinked_versions(self):
+        # load_files の後は版が増えたファイルだけを返す．デコードしていないファイルは増えていない
+        for filename, commits in self.file_commit_dict.items():
+            if len(commits) > self.linked.get(filename, 0):
+                yield filename, self.get_versions(filename)
+
+    def connect_files(self, edges, max_workers=1, shard_size=1000):
+        """Add isPreviousVersionOf edges between consecutive versions of each file.
+
+        Shards of shard_size files are linked by worker processes when
+        max_workers > 1. The links are added in file order, so the edges do
+        not depend on the number of workers. A renamed version is then
+        linked to the latest older version of its previous_filename.
+
+        Versions read by load_files are already linked. Only the versions
+        added after them are linked, and the oldest of those continues the
+        chain from the latest previous version that is not newer than it.
+        """
+        renamed = [] # (file_id, commit_sha, timestamp, previous_filename)
+        def iter_linkable():
+            for filename, versions in (self.iter_unlinked_versions() if self.loaded else self.iter_versions()):
+                linked = self.linked.get(filename, 0)
+                previous, versions = versions[:linked], versions[linked:]
+                renamed.extend((file_id, sha, timestamp, previous_filename) for timestamp, file_id, status, sha, previous_filename in versions if status == 'renamed' and previous_filename)
+                if previous:
+                    # 前回の鎖の先頭 (新しい版が古い日付なら，それより前で最新の版) を最後に置く
+                    oldest = min(version[0] for version in versions)
+                    head = max((version for version in previous if version[0] <= oldest), key=lambda version: version[0], default=None)
+                    if head is not None:
+                        versions = versions + [head]
+                if len(versions) > 1:
+                    yield filename, versions
+        linkable = iter_linkable()
+        shards = iter(lambda: list(itertools.islice(linkable, shard_size)), [])
+        if max_workers > 1:
+            results = (links for _, links in map_concurrently(link_file_versions, shards, max_workers, processes=True))
+        else:
+            results = map(link_file_versions, shards)
+        for links in results:
+            for before_id, file_id, status, timestamp in links:
+                edges.add_edge({'src': before_id, 'dst': file_id, 'label': ['isPreviousVersionOf', status], 'property': {'date': self.version_date(timestamp)}})
+
+        # 名前が変わったファイルは変更前の名前の直前の版につなぐ
+        for file_id, sha, timestamp, previous_filename in renamed:
+            candidates = [
+                (before_timestamp, before_id)
+                for before_timestamp, before_id, _, before_sha, _ in self.get_versions(previous_filename) or []
+                if before_timestamp <= timestamp and before_sha != sha
+            ]
+            if candidates:
+                before_id = max(candidates, key=lambda candidate: candidate[0])[1]
+                edges.add_edge({'src': before_id, 'dst': file_id, 'label': ['isPreviousVersionOf', 'renamed'], 'property': {'date': self.version_date(timestamp)}})
         return edges
     
     def load_files(self, filepath):
-        try:
-            with open(filepath, 'r') as json_file:
-                print(f"Loading files from {filepath}")
-                data = json.load(json_file)
-                
-                # 復元したデータを Files クラスのインスタンスに設定する
-                for filename, file_data in data['files'].items():
-                    self.files[filename] = {}
-                    for sha, file_info in file_data.items():
-                        file_node = FileNode(file_info, need_extract=False)
-                        self.files[filename][sha] = file_node
-                
-                # ファイルのコミット情報を復元する
-                self.file_commit_dict = data['file_commit_dict']
-        
-        except Exception as e:
-            print(f"Error loading JSON from {filepath}")
-            print(f"Exception: {e}")
+        """Read a files file written by write_as_json; its versions count as linked.
+
+        Each file is kept as the text it was read from until a version is
+        added to it or looked up, so unchanged files are written back
+        without decoding and re-encoding them.
+        """
+        print(f"Loading files from {filepath}")
+        self.loaded_lines = is_json_lines(filepath)
+        with open_records(filepath, 'r') as json_file:
+            if self.loaded_lines:
+                for line in json_file:
+                    if line.strip():
+                        entry = dict(JsonDocumentReader(io.StringIO(line)).iter_items(raw=True))
+                        self.loaded[json.loads(entry['filename'])] = (entry['files'], entry['commits'])
+                return
+            reader = JsonDocumentReader(json_file)
+            members = {key: dict(reader.iter_items(raw=True)) for key in reader.iter_keys()}
+        for filename, commits in members['file_commit_dict'].items():
+            self.loaded[filename] = (members['files'][filename], commits)
+
+    def decode_loaded(self, filename):
+        raw = self.loaded.get(filename)
+        if raw is None:
+            return
+        self.loaded[filename] = None
+        file_infos, commits = json.loads(raw[0]), json.loads(raw[1])
+        files = self.files.setdefault(filename, {})
+        for sha, file_info in file_infos.items():
+            files[sha] = FileNode(file_info, sha, need_extract=False)
+        self.file_commit_dict.setdefault(filename, []).extend((sha, datetime.fromisoformat(date)) for sha, date in commits)
+        self.linked[filename] = len(self.file_commit_dict[filename])
+
+    def iter_filenames(self):
+        # 読み込んだファイルは元の順に，新しいファイルはその後に
+        yield from self.loaded
+        yield from (filename for filename in self.files if filename not in self.loaded)
 
     def to_dict(self):
         # Convert the files and file_commit_dict to a dictionary
+        for filename in list(self.loaded):
+            self.decode_loaded(filename)
         return {
             "files": {
                 filename: {sha: file.get_data() for sha, file in files.items()}
@@ -357,26 +951,491 @@ class Files:
             "file_commit_dict": self.file_commit_dict
         }
 
-    def write_as_json(self, filepath):
+    def iter_file_records(self):
+        for filename in self.iter_filenames():
+            raw = self.loaded.get(filename)
+            if raw is not None:
+                yield filename, raw[0]
+                continue
+            self.decode_loaded(filename)
+            yield filename, {sha: file.get_data() for sha, file in self.files[filename].items()}
+
+    def iter_file_commits(self):
+        for filename in self.iter_filenames():
+            raw = self.loaded.get(filename)
+            if raw is not None:
+                yield filename, raw[1]
+                continue
+            self.decode_loaded(filename)
+            yield filename, self.file_commit_dict[filename]
+
+    def write_as_json(self, filepath, max_workers=1):
+        # 途中で失敗しても前回の files.json を壊さないように別名で書いてから置き換える
+        directory, filename = os.path.split(filepath)
+        temporary = os.path.join(directory, '.writing-' + filename)
+        print(f"Writing files to {filepath}")
+        if self.loaded_lines != is_json_lines(filepath):
+            for filename in list(self.loaded):
+                self.decode_loaded(filename)
+        # ファイルごとに書き出し，全体の辞書はメモリ上に作らない
+        with open_records(temporary, 'w') as json_file:
+            if is_json_lines(filepath):
+                for (filename, files), (_, commits) in zip(self.iter_file_records(), self.iter_file_commits()):
+                    if isinstance(files, RawJson):
+                        # 読み込んだままのファイルは json.dumps と同じ形に並べるだけ
+                        json_file.write(f'{{"filename": {json.dumps(filename)}, "files": {files}, "commits": {commits}}}\n')
+                    else:
+                        json_file.write(json.dumps({"filename": filename, "files": files, "commits": commits}, cls=DateTimeEncoder) + '\n')
+            else:
+                json_file.write('{\n    "files": ')
+                write_json_object(json_file, self.iter_file_records(), level=1, max_workers=max_workers)
+                json_file.write(',\n    "file_commit_dict": ')
+                write_json_object(json_file, self.iter_file_commits(), level=1, max_workers=max_workers)
+                json_file.write('\n}')
+        os.replace(temporary, filepath)
+
+
+class FetchJournal:
+    """Append-only JSON Lines journal of fetched commit details, one commit per line."""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.offsets = {} # sha: 行の先頭のバイト位置
+        self.file = None
+        if os.path.exists(filepath):
+            self.recover()
+
+    def recover(self):
+        # 途中で落ちた場合は最後の不完全な行を切り捨てる
+        valid_size = 0
+        with open(self.filepath, 'rb') as journal_file:
+            for line in journal_file:
+                # 改行のない最後の行は読めても書きかけなので捨てる (次の追記が同じ行に続いてしまう)
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    commit = json.loads(line)
+                except ValueError:
+                    break
+                self.offsets[commit['sha']] = valid_size
+                valid_size += len(line)
+        if valid_size < os.path.getsize(self.filepath):
+            print(f"Truncating incomplete record in {self.filepath}")
+            with open(self.filepath, 'r+b') as journal_file:
+                journal_file.truncate(valid_size)
+        print(f"Recovered {len(self.offsets)} commits from {self.filepath}")
+
+    def seed(self, commits):
+        for commit in commits:
+            if commit['sha'] not in self.offsets:
+                self.append(commit)
+
+    def __contains__(self, sha):
+        return sha in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, commit):
+        if self.file is None:
+            self.file = open(self.filepath, 'ab')
+        self.offsets[commit['sha']] = self.file.tell()
+        self.file.write(json.dumps(commit).encode('utf-8') + b'\n')
+        self.file.flush()
+
+    def iter_details(self, sha_list):
+        # 記録したオフセットから sha_list の順に1件ずつ読み出す
+        if self.file is not None:
+            self.file.flush()
+        with open(self.filepath, 'rb') as journal_file:
+            for sha in sha_list:
+                if sha in self.offsets:
+                    journal_file.seek(self.offsets[sha])
+                    yield json.loads(journal_file.readline())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PatchStore:
+    """Content-addressed store of zlib-compressed patches.
+
+    A patch is referenced by the SHA-256 of its text and stored once.
+    Compressed patches are appended to pack-NNNNN.pack files of up to
+    pack_size bytes, and patches.idx records the pack, offset and length
+    of each reference. Index lines are written index_batch at a time, each
+    batch only after the pack data it points to has been fsynced.
+    """
+    def __init__(self, directory, pack_size=256 * 1024 ** 2, index_batch=1024):
+        self.directory = directory
+        self.pack_size = pack_size
+        self.index_batch = index_batch
+        self.index = {} # ref: (pack, offset, length)
+        self.pending = [] # pack には書いたがまだ patches.idx に書いていない行
+        self.readers = {}
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'patches.idx')
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r', encoding='utf-8') as index_file:
+                for line in index_file:
+                    fields = line.rstrip('\n').split('\t')
+                    # 途中で落ちた場合の不完全な行は読み飛ばす
+                    if len(fields) == 4 and line.endswith('\n'):
+                        self.index[fields[0]] = tuple(map(int, fields[1:]))
+        # pack の末尾より先を指す参照は使えないので捨てる
+        pack_sizes = {}
+        for ref, (pack, offset, length) in list(self.index.items()):
+            if pack not in pack_sizes:
+                pack_sizes[pack] = os.path.getsize(self.pack_path(pack)) if os.path.exists(self.pack_path(pack)) else 0
+            if offset + length > pack_sizes[pack]:
+                del self.index[ref]
+        self.pack = max((pack for pack, _, _ in self.index.values()), default=0)
+        self.pack_file = open(self.pack_path(self.pack), 'ab')
+        self.index_file = open(self.index_path, 'a', encoding='utf-8')
+
+    def __contains__(self, ref):
+        return ref in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def pack_path(self, pack):
+        return os.path.join(self.directory, f"pack-{pack:05d}.pack")
+
+    @staticmethod
+    def pack_patch(patch):
+        # ワーカープロセスでも実行できるように圧縮とハッシュの計算だけを行う
+        content = patch.encode('utf-8')
+        return hashlib.sha256(content).hexdigest(), zlib.compress(content)
+
+    def put(self, patch):
+        ref, blob = self.pack_patch(patch)
+        self.put_packed(ref, blob)
+        return ref
+
+    def put_packed(self, ref, blob):
+        if ref in self.index:
+            return
+        if self.pack_file.tell() + len(blob) > self.pack_size and self.pack_file.tell() > 0:
+            self.sync()
+            self.pack_file.close()
+            self.pack += 1
+            self.pack_file = open(self.pack_path(self.pack), 'ab')
+        offset = self.pack_file.tell()
+        self.pack_file.write(blob)
+        self.index[ref] = (self.pack, offset, len(blob))
+        self.pending.append(f"{ref}\t{self.pack}\t{offset}\t{len(blob)}\n")
+        if len(self.pending) >= self.index_batch:
+            self.sync()
+
+    def sync(self):
+        """Make the packed patches durable, then record them in patches.idx."""
+        if not self.pending:
+            return
+        # 索引より先に pack をディスクに書くので，途中で落ちても索引が pack の外を指すことはない
+        self.pack_file.flush()
+        os.fsync(self.pack_file.fileno())
+        self.index_file.write(''.join(self.pending))
+        self.index_file.flush()
+        self.pending = []
+
+    def get(self, ref):
+        pack, offset, length = self.index[ref]
+        if pack == self.pack:
+            self.pack_file.flush()
+        if pack not in self.readers:
+            self.readers[pack] = open(self.pack_path(pack), 'rb')
+        reader = self.readers[pack]
+        reader.seek(offset)
+        return zlib.decompress(reader.read(length)).decode('utf-8')
+
+    def close(self):
+        self.sync()
+        self.pack_file.close()
+        self.index_file.close()
+        for reader in self.readers.values():
+            reader.close()
+
+
+class ResponseCache:
+    """On-disk cache of API responses.
+
+    Bodies are stored once per content hash under blobs/, and index/ maps a
+    request (url + params) to its body hash and ETag. The least recently used
+    bodies are evicted once the blobs exceed max_bytes.
+    """
+    immutable_pattern = re.compile(r'commits/[0-9a-f]{40}$')
+    stored_headers = ['ETag', 'Link', 'Content-Type']
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.blobs = {} # digest: [size, last_access]
+        self.total_bytes = 0
+        os.makedirs(os.path.join(cache_dir, 'index'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'blobs'), exist_ok=True)
+        for shard in os.scandir(os.path.join(cache_dir, 'blobs')):
+            for blob in os.scandir(shard.path):
+                stat = blob.stat()
+                self.blobs[blob.name] = [stat.st_size, stat.st_mtime]
+                self.total_bytes += stat.st_size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def is_immutable(self, url):
+        return self.immutable_pattern.search(url) is not None
+
+    def request_key(self, url, params=None):
+        query = '&'.join(f"{key}={value}" for key, value in sorted((params or {}).items()))
+        return hashlib.sha256(f"{url}?{query}".encode('utf-8')).hexdigest()
+
+    def index_path(self, key):
+        return os.path.join(self.cache_dir, 'index', key[:2], key + '.json')
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, 'blobs', digest[:2], digest)
+
+    def write_atomic(self, filepath, content):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_path = f"{filepath}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, filepath)
+
+    def get(self, url, params=None):
+        index_path = self.index_path(self.request_key(url, params))
         try:
-            # Convert the dictionary to a JSON string and write it to a file
-            with open(filepath, 'w') as json_file:
-                print(f"Writing files to {filepath}")
-                json.dump(self.to_dict(), json_file, indent=4, cls=DateTimeEncoder)
-        except Exception as e:
-            print(f"Error writing JSON to {filepath}")
-            print(f"Exception: {e}")
-            
-                
-class ApiSetting:
-    def __init__(self, owner_name, repo_name):
-        self.base_url = f"https://api.github.com/repos/{owner_name}/{repo_name}/"
-        self.token = os.getenv('GITHUB_TOKEN')
-        if not self.token:
+            with open(index_path, 'r') as index_file:
+                entry = json.load(index_file)
+            with open(self.blob_path(entry['digest']), 'rb') as blob_file:
+                entry['body'] = blob_file.read()
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            if entry['digest'] in self.blobs:
+                self.blobs[entry['digest']][1] = time.time()
+        return entry
+
+    def put(self, url, params, response):
+        body = response.content
+        digest = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            is_new = digest not in self.blobs
+            self.blobs[digest] = [len(body), time.time()]
+            if is_new:
+                self.total_bytes += len(body)
+        if is_new:
+            self.write_atomic(self.blob_path(digest), body)
+        entry = {
+            'url': url,
+            'digest': digest,
+            'headers': {key: response.headers[key] for key in self.stored_headers if key in response.headers},
+        }
+        self.write_atomic(self.index_path(self.request_key(url, params)), json.dumps(entry).encode('utf-8'))
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # 上限の9割まで古い順に削除する．参照が切れた index はヒットしなくなるだけ
+        with self.lock:
+            target = self.max_bytes * 0.9
+            for digest, (size, _) in sorted(self.blobs.items(), key=lambda item: item[1][1]):
+                if self.total_bytes <= target:
+                    break
+                try:
+                    os.remove(self.blob_path(digest))
+                except OSError:
+                    pass
+                del self.blobs[digest]
+                self.total_bytes -= size
+
+    def to_response(self, entry, headers=None):
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = entry['url']
+        response._content = entry['body']
+        response.headers.update(entry['headers'])
+        if headers:
+            response.headers.update({key: value for key, value in headers.items() if key.startswith('X-RateLimit')})
+        response.encoding = 'utf-8'
+        return response
+
+
+class TokenBudget:
+    """Rate-limit state and usage counters of one API token."""
+    def __init__(self, token):
+        self.token = token
+        self.headers = {"Authorization": f"token {token}"}
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.next_request_time = 0
+        self.graphql_remaining = None
+        self.graphql_reset = None
+        self.requests = 0
+        self.not_modified = 0
+
+    def name(self):
+        return f"...{self.token[-4:]}"
+
+    def headroom(self, now):
+        # リセット後や未使用のトークンは残量不明なので最優先にする
+        if self.reset is None or now >= self.reset:
+            return float('inf')
+        return self.remaining
+
+    def graphql_headroom(self, now):
+        if self.graphql_reset is None or now >= self.graphql_reset:
+            return float('inf')
+        return self.graphql_remaining
+
+    def to_dict(self):
+        return {
+            "token": self.name(),
+            "requests": self.requests,
+            "not_modified": self.not_modified,
+            "limit": self.limit,
+            "remaining": self.remaining,
+            "reset": self.reset,
+            "graphql_remaining": self.graphql_remaining,
+        }
+
+
+class TokenPool:
+    """Routes each request to the token with the most remaining quota.
+
+    A token is paced evenly over the rest of its window once its remaining
+    quota falls below limit * rate_reserve, and the pool only sleeps when
+    every token is exhausted.
+    """
+    def __init__(self, tokens, rate_reserve=0.2):
+        if not tokens:
             raise ValueError("GITHUB_TOKEN is not set")
-        self.headers = {"Authorization": f"token {self.token}"}
+        self.budgets = [TokenBudget(token) for token in tokens]
+        self.rate_reserve = rate_reserve
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, rate_reserve=0.2):
+        # GITHUB_TOKENS にカンマ区切りで複数指定できる
+        tokens = [token.strip() for token in os.getenv('GITHUB_TOKENS', '').split(',') if token.strip()]
+        if not tokens and os.getenv('GITHUB_TOKEN'):
+            tokens = [os.getenv('GITHUB_TOKEN')]
+        return cls(tokens, rate_reserve)
+
+    def acquire(self):
+        """Reserve one request on the best token, sleeping if needed, and return its budget."""
+        while True:
+            with self.lock:
+                now = time.time()
+                budget = max(self.budgets, key=lambda budget: budget.headroom(now))
+                headroom = budget.headroom(now)
+                if headroom == float('inf'):
+                    budget.reset = None
+                    wait_until = now
+                elif headroom <= 0:
+                    # 全てのトークンを使い切った
+                    wait_until = min(budget.reset for budget in self.budgets) + 1  # 余裕を持って1秒追加
+                    budget = None
+                elif headroom <= budget.limit * self.rate_reserve:
+                    interval = (budget.reset - now) / budget.remaining
+                    wait_until = max(now, budget.next_request_time)
+                    budget.next_request_time = wait_until + interval
+                else:
+                    wait_until = now
+                if budget is not None:
+                    budget.requests += 1
+                    if budget.reset is not None:
+                        budget.remaining -= 1
+            wait_time = wait_until - time.time()
+            if budget is None:
+                self.print_rate_limit_wait(wait_until - 1)
+                time.sleep(max(0, wait_time))
+                metrics.inc('github_rate_limit_sleep_seconds_total', max(0, wait_time), reason='exhausted')
+                continue
+            if wait_time > 0:
+                time.sleep(wait_time)
+                metrics.inc('github_rate_limit_sleep_seconds_total', wait_time, reason='paced')
+            return budget
+
+    def acquire_graphql(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                budget = max(self.budgets, key=lambda budget: budget.graphql_headroom(now))
+                if budget.graphql_headroom(now) > 0:
+                    budget.requests += 1
+                    return budget
+                wait_until = min(budget.graphql_reset for budget in self.budgets) + 1  # 余裕を持って1秒追加
+            self.print_rate_limit_wait(wait_until - 1)
+            wait_time = max(0, wait_until - time.time())
+            time.sleep(wait_time)
+            metrics.inc('github_rate_limit_sleep_seconds_total', wait_time, reason='graphql')
+
+    def print_rate_limit_wait(self, reset_time):
+        wait_time = max(0, reset_time - time.time())
+        reset_time_jst = datetime.fromtimestamp(reset_time, timezone.utc) + timedelta(hours=9)
+        wait_hours, remainder = divmod(wait_time, 3600)
+        wait_minutes, wait_seconds = divmod(remainder, 60)
+        print(f"Rate limit exceeded. Waiting for {int(wait_hours)} hours, {int(wait_minutes)} minutes, and {int(wait_seconds)} seconds until {reset_time_jst.strftime('%Y-%m-%d %H:%M:%S %Z%z')} (JST).")
+
+    def update(self, budget, headers):
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        remaining = int(headers['X-RateLimit-Remaining'])
+        reset_time = int(headers.get('X-RateLimit-Reset', time.time() + 60))
+        with self.lock:
+            if budget.reset is None or reset_time > budget.reset:
+                budget.remaining = remaining
+                budget.reset = reset_time
+            else:
+                # 並列リクエストのレスポンスは順不同で返るので小さい方を信用する
+                budget.remaining = min(budget.remaining, remaining)
+            budget.limit = int(headers.get('X-RateLimit-Limit', budget.limit or remaining))
+
+    def update_graphql(self, budget, rate_limit):
+        with self.lock:
+            budget.graphql_remaining = rate_limit['remaining']
+            budget.graphql_reset = datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+
+    def record_not_modified(self, budget):
+        with self.lock:
+            budget.not_modified += 1
+
+    def usage(self):
+        with self.lock:
+            return [budget.to_dict() for budget in self.budgets]
+
+
+class ApiSetting:
+    """REST and GraphQL access to one repository.
+
+    Several ApiSettings can share one token_pool, HTTP session and response
+    cache, so that requests for many repositories draw on the same rate
+    budget and connection pool (see create_session).
+    """
+    def __init__(self, owner_name, repo_name, pool_maxsize=10, rate_reserve=0.2, cache_dir=None, cache_max_bytes=2 * 1024 ** 3, api_root=None, token_pool=None, session=None, cache=None):
+        api_root = api_root or os.getenv('GITHUB_API_URL', 'https://api.github.com')
+        self.base_url = f"{api_root.rstrip('/')}/repos/{owner_name}/{repo_name}/"
+        self.graphql_url = f"{api_root.rstrip('/')}/graphql"
+        self.owner_name = owner_name
+        self.repo_name = repo_name
+        self.token_pool = token_pool or TokenPool.from_env(rate_reserve)
+        self.token = self.token_pool.budgets[0].token
+        self.headers = self.token_pool.budgets[0].headers
         self.count = 0
+        self.count_lock = threading.Lock()
+        self.cache = cache or (ResponseCache(cache_dir, cache_max_bytes) if cache_dir else None)
+        # GraphQL は REST とは別のポイント制のレートリミット
+        self.graphql_cost = 0
+
+        self.http = session or self.create_session(pool_maxsize)
 
+    @staticmethod
+    def create_session(pool_maxsize=10):
         # リトライロジックの設定
         retry_strategy = Retry(
             total=5,
@@ -384,29 +1443,51 @@ class ApiSetting:
             status_forcelist=[429, 500, 502, 503, 504],
             allowed_methods=["HEAD", "GET", "OPTIONS"]
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.http = requests.Session()
-        self.http.mount("https://", adapter)
-        self.http.mount("http://", adapter)
-    
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def usage(self):
+        return self.token_pool.usage()
+
     def get_data(self, api_string="", with_json = True, params=None):
+        url = self.base_url + api_string
+        # sha ごとに系列が増えないように commits/{sha} をまとめる
+        endpoint = re.sub(r'[0-9a-f]{40}', '{sha}', api_string)
+        cached = self.cache.get(url, params) if self.cache else None
+        conditional_headers = {}
+        if cached is not None:
+            if self.cache.is_immutable(api_string):
+                # commits/{sha} は変化しないのでリクエストせずに返す
+                metrics.inc('github_cache_hits_total', endpoint=endpoint, kind='immutable')
+                response = self.cache.to_response(cached)
+                return response.json() if with_json else response
+            if 'ETag' in cached['headers']:
+                conditional_headers = {'If-None-Match': cached['headers']['ETag']}
         while True:
             try:
-                self.count += 1
-                print(f"======== API count: {self.count} ========")
-                response = self.http.get(self.base_url + api_string, headers=self.headers, params=params)
-                
+                budget = self.token_pool.acquire()
+                with self.count_lock:
+                    self.count += 1
+                start = time.perf_counter()
+                response = self.http.get(url, headers=dict(budget.headers, **conditional_headers), params=params)
+                metrics.observe('github_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+                metrics.inc('github_requests_total', endpoint=endpoint, status=response.status_code)
+                self.token_pool.update(budget, response.headers)
                 remaining = int(response.headers.get('X-RateLimit-Remaining', 1))  # デフォルトは1でエラーを避ける
-                reset_time = int(response.headers.get('X-RateLimit-Reset', time.time() + 60))  # デフォルトは現在時刻から1分後
 
+                if response.status_code == 304 and cached is not None:
+                    # 304 はレートリミットに数えられない
+                    self.token_pool.record_not_modified(budget)
+                    metrics.inc('github_cache_hits_total', endpoint=endpoint, kind='not_modified')
+                    response = self.cache.to_response(cached, response.headers)
+                    return response.json() if with_json else response
                 if response.status_code == 200:
-                    if remaining == 0:
-                        wait_time = max(0, reset_time - time.time())
-                        reset_time_jst = datetime.fromtimestamp(reset_time, timezone.utc) + timedelta(hours=9)
-                        wait_hours, remainder = divmod(wait_time, 3600)
-                        wait_minutes, wait_seconds = divmod(remainder, 60)
-                        print(f"Rate limit exceeded. Waiting for {int(wait_hours)} hours, {int(wait_minutes)} minutes, and {int(wait_seconds)} seconds until {reset_time_jst.strftime('%Y-%m-%d %H:%M:%S %Z%z')} (JST).")
-                        time.sleep(wait_time + 1)  # 余裕を持って1秒追加
+                    if self.cache:
+                        self.cache.put(url, params, response)
+                    # 残量が0の場合は次のリクエストの acquire で別のトークンに切り替えるかリセットまで待機する
                     if with_json:
                         return response.json()
                     else:
@@ -416,13 +1497,8 @@ class ApiSetting:
                     print("Error 403: Access Forbidden. You may have hit a rate limit or the token is invalid.")
                     print(f"Response: {response.text}")
                     if remaining == 0:
-                        wait_time = max(0, reset_time - time.time())
-                        reset_time_jst = datetime.fromtimestamp(reset_time, timezone.utc) + timedelta(hours=9)
-                        wait_hours, remainder = divmod(wait_time, 3600)
-                        wait_minutes, wait_seconds = divmod(remainder, 60)
-                        print(f"Rate limit exceeded. Waiting for {int(wait_hours)} hours, {int(wait_minutes)} minutes, and {int(wait_seconds)} seconds until {reset_time_jst.strftime('%Y-%m-%d %H:%M:%S %Z%z')} (JST).")
-                        time.sleep(wait_time + 1)  # 余裕を持って1秒追加
-                        continue  # リトライする
+                        metrics.inc('github_retries_total', endpoint=endpoint, reason='rate_limit')
+                        continue  # 別のトークンか，全て使い切った場合はリセットまで待ってリトライする
                     return None
                 else:
                     print(f"Error {response.status_code}: {response.reason}")
@@ -430,4 +1506,40 @@ class ApiSetting:
                     return None
             except requests.exceptions.RequestException as e:
                 print(f"Request failed: {e}")
-                time.sleep(5)  # 失敗した場合は5秒待機して再試行
\ No newline at end of file
+                metrics.inc('github_retries_total', endpoint=endpoint, reason='error')
+                time.sleep(5)  # 失敗した場合は5秒待機して再試行
+
+    def post_graphql(self, query, variables=None):
+        """Run a GraphQL query that selects rateLimit { cost remaining resetAt } and return its data."""
+        while True:
+            budget = self.token_pool.acquire_graphql()
+            try:
+                with self.count_lock:
+                    self.count += 1
+                start = time.perf_counter()
+                response = self.http.post(self.graphql_url, headers=budget.headers, json={'query': query, 'variables': variables or {}})
+                metrics.observe('github_request_seconds', time.perf_counter() - start, endpoint='graphql')
+                metrics.inc('github_requests_total', endpoint='graphql', status=response.status_code)
+                if response.status_code != 200:
+                    print(f"Error {response.status_code}: {response.reason}")
+                    print(f"Response: {response.text}")
+                    if response.status_code in (403, 429, 502):
+                        metrics.inc('github_retries_total', endpoint='graphql', reason='rate_limit' if response.status_code in (403, 429) else 'error')
+                        time.sleep(5)
+                        continue
+                    return None
+                result = response.json()
+                data = result.get('data') or {}
+                rate_limit = data.get('rateLimit')
+                if rate_limit:
+                    with self.count_lock:
+                        self.graphql_cost += rate_limit['cost']
+                    metrics.inc('github_graphql_cost_total', rate_limit['cost'])
+                    self.token_pool.update_graphql(budget, rate_limit)
+                if 'errors' in result:
+                    print(f"GraphQL errors: {result['errors']}")
+                return data
+            except requests.exceptions.RequestException as e:
+                print(f"Request failed: {e}")
+                metrics.inc('github_retries_total', endpoint='graphql', reason='error')
+                time.sleep(5)  # 失敗した場合は5秒待機して再試行
@@ -0,0 +1,292 @@
+import os
+import csv
+import argparse
+from array import array
+import numpy as np
+import tqdm
+from scipy import sparse
+from records import iter_records, output_path
+
+WINDOWS = ['none', 'year', 'quarter', 'month', 'week']
+TABLES = ['cochange', 'churn', 'authors']
+TARGETS = {'csv': '.csv', 'parquet': '.parquet'}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Compute co-change, directory churn and author-file activity tables from a built graph.')
+    current_directory = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('-d', '--out_dir', type=str, default=current_directory, help='The directory holding nodes and edges')
+    parser.add_argument('-f', '--format', type=str, default='json', choices=['json', 'jsonl'], help='The format of nodes and edges')
+    parser.add_argument('-z', '--compress', type=str, default='none', choices=['none', 'gz', 'zst'], help='The compression of nodes and edges')
+    parser.add_argument('-a', '--analytics_dir', type=str, default=None, help='The directory of the result tables (default: out_dir/analytics)')
+    parser.add_argument('-t', '--target', type=str, default='csv', choices=list(TARGETS), help='The format of the result tables')
+    parser.add_argument('--tables', type=str, nargs='+', default=TABLES, choices=TABLES, help='The tables to compute')
+    parser.add_argument('--window', type=str, default='none', choices=WINDOWS, help='Aggregate per time window of the author date')
+    parser.add_argument('--depth', type=int, default=None, help='Aggregate churn over directories cut to this many path components')
+    parser.add_argument('--max_files', type=int, default=100, help='Leave commits touching more files than this out of the co-change counts')
+    parser.add_argument('--min_cochange', type=int, default=2, help='Only write file pairs changed together at least this many times')
+    return parser.parse_args()
+
+
+class Codebook:
+    """Assigns consecutive integer codes to strings."""
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+        self.array = None # decode 用の values の配列 (encode で増えたら作り直す)
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def decode(self, codes):
+        if self.array is None or len(self.array) != len(self.values):
+            self.array = np.array(self.values, dtype=object)
+        return self.array[codes]
+
+
+def group(*columns):
+    """Group rows by integer columns and return (the first row of each group, the group of each row)."""
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        values, codes = np.unique(column, return_inverse=True)
+        # 毎回詰め直して key が行数を超えないようにする
+        _, key = np.unique(key * len(values) + codes, return_inverse=True)
+    _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+    return first, inverse
+
+def lookup(sorted_ids, order, ids):
+    """Return the positions of ids in the unsorted id array, and whether each one was found."""
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+    positions = np.searchsorted(sorted_ids, ids)
+    found = positions < len(sorted_ids)
+    found[found] = sorted_ids[positions[found]] == ids[found]
+    return order[np.minimum(positions, len(sorted_ids) - 1)], found
+
+def window_labels(dates, window):
+    """Return the window code of every date and the label of every code."""
+    if window == 'none':
+        return np.zeros(len(dates), dtype=np.int64), np.array(['all'], dtype=object)
+    if window == 'year':
+        codes = dates.astype('datetime64[Y]').astype(np.int64)
+        label = lambda code: str(1970 + code)
+    elif window == 'quarter':
+        codes = dates.astype('datetime64[M]').astype(np.int64) // 3
+        label = lambda code: f"{1970 + code // 4}Q{code % 4 + 1}"
+    elif window == 'month':
+        codes = dates.astype('datetime64[M]').astype(np.int64)
+        label = lambda code: str(np.datetime64(code, 'M'))
+    else:
+        # 1970-01-01 は木曜日なので月曜日に始まる週に揃える
+        codes = (dates.astype('datetime64[D]').astype(np.int64) - 4) // 7
+        label = lambda code: str(np.datetime64(code * 7 + 4, 'D'))
+    values, codes = np.unique(codes, return_inverse=True)
+    return codes, np.array([label(int(value)) for value in values], dtype=object)
+
+
+class ChangeLog:
+    """Every commit-file edge of a graph as integer-encoded NumPy columns, one row per changed file.
+
+    Commits, file names, directories and authors are encoded as integers
+    while the nodes and edges are streamed, so only the arrays and the
+    code tables stay in memory. Files are identified by name, so a renamed
+    file starts a new one.
+    """
+    def __init__(self, nodes, edges, window='none', depth=None):
+        self.filenames = Codebook()
+        self.directories = Codebook()
+        self.authors = Codebook()
+        commit_ids, commit_authors, commit_dates = array('Q'), array('q'), []
+        file_ids, file_names, file_directories, file_additions, file_deletions = array('Q'), array('q'), array('q'), array('q'), array('q')
+        directory_codes = {} # directory: depth で切った directory の code
+        for node in nodes:
+            property = node['property']
+            if 'commit' in node['label']:
+                commit_ids.append(node['id'])
+                commit_authors.append(self.authors.encode(property.get('author_email') or property.get('author_name') or ''))
+                commit_dates.append((property.get('author_date') or property['committer_date']).rstrip('Z'))
+            elif 'file' in node['label']:
+                file_ids.append(node['id'])
+                file_names.append(self.filenames.encode(property['filename']))
+                directory = property.get('directory', os.path.dirname(property['filename']))
+                code = directory_codes.get(directory)
+                if code is None:
+                    code = directory_codes[directory] = self.directories.encode('/'.join(directory.split('/')[:depth]) if depth else directory)
+                file_directories.append(code)
+                file_additions.append(property.get('additions') or 0)
+                file_deletions.append(property.get('deletions') or 0)
+        sources, destinations = array('Q'), array('Q')
+        for edge in edges:
+            # ファイル -> コミットの辺だけを使う (label は [status, 'commit'])
+            if edge['label'][-1] == 'commit':
+                sources.append(edge['src'])
+                destinations.append(edge['dst'])
+
+        commit_ids = np.frombuffer(commit_ids, dtype=np.uint64)
+        file_ids = np.frombuffer(file_ids, dtype=np.uint64)
+        commit_order, file_order = np.argsort(commit_ids), np.argsort(file_ids)
+        commits, found_commits = lookup(commit_ids[commit_order], commit_order, np.frombuffer(destinations, dtype=np.uint64))
+        files, found_files = lookup(file_ids[file_order], file_order, np.frombuffer(sources, dtype=np.uint64))
+        found = found_commits & found_files
+        commits, files = commits[found], files[found]
+        commit_windows, self.window_labels = window_labels(np.array(commit_dates, dtype='datetime64[s]'), window)
+
+        self.commit = commits
+        self.author = np.frombuffer(commit_authors, dtype=np.int64)[commits]
+        self.window = commit_windows[commits]
+        self.file = np.frombuffer(file_names, dtype=np.int64)[files]
+        self.directory = np.frombuffer(file_directories, dtype=np.int64)[files]
+        self.additions = np.frombuffer(file_additions, dtype=np.int64)[files]
+        self.deletions = np.frombuffer(file_deletions, dtype=np.int64)[files]
+
+    def __len__(self):
+        return len(self.commit)
+
+    def sums(self, inverse, count):
+        additions = np.bincount(inverse, weights=self.additions, minlength=count).astype(np.int64)
+        deletions = np.bincount(inverse, weights=self.deletions, minlength=count).astype(np.int64)
+        return additions, deletions
+
+    def distinct(self, inverse, column, count):
+        # 各グループに現れる column の値の種類数
+        first, _ = group(inverse, column)
+        return np.bincount(inverse[first], minlength=count)
+
+    def directory_churn(self):
+        first, inverse = group(self.window, self.directory)
+        additions, deletions = self.sums(inverse, len(first))
+        return {
+            'window': self.window_labels[self.window[first]],
+            'directory': self.directories.decode(self.directory[first]),
+            'commits': self.distinct(inverse, self.commit, len(first)),
+            'files': self.distinct(inverse, self.file, len(first)),
+            'changes': np.bincount(inverse, minlength=len(first)),
+            'additions': additions,
+            'deletions': deletions,
+            'churn': additions + deletions,
+        }
+
+    def author_activity(self):
+        first, inverse = group(self.window, self.author, self.file)
+        additions, deletions = self.sums(inverse, len(first))
+        return {
+            'window': self.window_labels[self.window[first]],
+            'author': self.authors.decode(self.author[first]),
+            'filename': self.filenames.decode(self.file[first]),
+            'commits': self.distinct(inverse, self.commit, len(first)),
+            'additions': additions,
+            'deletions': deletions,
+        }
+
+    def cochange(self, max_files=100, min_count=2, block_size=4096):
+        """Yield tables of the file pairs changed together in at least min_count commits, per window.
+
+        Each window's commit x file incidence matrix M gives the counts as
+        M^T M, computed block_size files at a time to bound the memory.
+        commits_a and commits_b count the commits of each file that were
+        not left out for touching more than max_files files.
+        """
+        first, _ = group(self.commit, self.file)
+        commits, files, windows = self.commit[first], self.file[first], self.window[first]
+        sizes = np.bincount(commits)
+        keep = sizes[commits] <= max_files
+        commits, files, windows = commits[keep], files[keep], windows[keep]
+        empty = True
+        for window in np.unique(windows):
+            in_window = windows == window
+            window_commits, rows = np.unique(commits[in_window], return_inverse=True)
+            window_files, columns = np.unique(files[in_window], return_inverse=True)
+            incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)), shape=(len(window_commits), len(window_files)))
+            transposed = incidence.T.tocsr()
+            support = np.asarray(incidence.sum(axis=0)).ravel()
+            for start in range(0, len(window_files), block_size):
+                # 上三角 (file_a < file_b) だけを残す
+                counts = sparse.triu(transposed[start:start + block_size] @ incidence, k=start + 1).tocoo()
+                keep = counts.data >= min_count
+                file_a, file_b, count = counts.row[keep] + start, counts.col[keep], counts.data[keep]
+                if len(count) == 0:
+                    continue
+                empty = False
+                yield {
+                    'window': np.full(len(count), self.window_labels[window], dtype=object),
+                    'file_a': self.filenames.decode(window_files[file_a]),
+                    'file_b': self.filenames.decode(window_files[file_b]),
+                    'count': count.astype(np.int64),
+                    'commits_a': support[file_a].astype(np.int64),
+                    'commits_b': support[file_b].astype(np.int64),
+                }
+        if empty:
+            # 組がなくても列名だけのテーブルを書く
+            strings, integers = np.array([], dtype=object), np.array([], dtype=np.int64)
+            yield {'window': strings, 'file_a': strings, 'file_b': strings, 'count': integers, 'commits_a': integers, 'commits_b': integers}
+
+
+class TableWriter:
+    """Writes dicts of equally long columns to one CSV or Parquet file."""
+    def __init__(self, filepath, target='csv'):
+        self.filepath = filepath
+        self.target = target
+        self.writer = None
+        self.file = None
+        self.rows = 0
+        if target == 'parquet':
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("pyarrow is required to write Parquet tables (pip install pyarrow)")
+            self.pa, self.pq = pa, pq
+
+    def write(self, columns):
+        if self.target == 'parquet':
+            table = self.pa.table({name: self.pa.array(values) for name, values in columns.items()})
+            if self.writer is None:
+                self.writer = self.pq.ParquetWriter(self.filepath, table.schema)
+            self.writer.write_table(table)
+        else:
+            if self.writer is None:
+                self.file = open(self.filepath, 'w', encoding='utf-8', newline='')
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(list(columns))
+            self.writer.writerows(zip(*(values.tolist() for values in columns.values())))
+        self.rows += len(next(iter(columns.values())))
+
+    def close(self):
+        if self.target == 'parquet' and self.writer is not None:
+            self.writer.close()
+        elif self.file is not None:
+            self.file.close()
+
+
+def write_table(filepath, tables, target='csv'):
+    writer = TableWriter(filepath, target)
+    for columns in tables:
+        writer.write(columns)
+    writer.close()
+    print(f"Wrote {writer.rows} rows to {filepath}")
+
+def analyze_graph(nodes, edges, analytics_dir, target='csv', tables=TABLES, window='none', depth=None, max_files=100, min_cochange=2):
+    """Compute the co-change, directory churn and author-file activity tables from nodes and edges."""
+    os.makedirs(analytics_dir, exist_ok=True)
+    change_log = ChangeLog(tqdm.tqdm(nodes, desc='nodes'), tqdm.tqdm(edges, desc='edges'), window, depth)
+    print(f"Read {len(change_log)} file changes")
+    extension = TARGETS[target]
+    if 'churn' in tables:
+        write_table(os.path.join(analytics_dir, 'directory_churn' + extension), [change_log.directory_churn()], target)
+    if 'authors' in tables:
+        write_table(os.path.join(analytics_dir, 'author_file' + extension), [change_log.author_activity()], target)
+    if 'cochange' in tables:
+        write_table(os.path.join(analytics_dir, 'cochange' + extension), change_log.cochange(max_files, min_cochange), target)
+
+def main(out_dir, file_format='json', compress='none', analytics_dir=None, target='csv', tables=TABLES, window='none', depth=None, max_files=100, min_cochange=2):
+    nodes = iter_records(output_path(out_dir, 'nodes', file_format, compress))
+    edges = iter_records(output_path(out_dir, 'edges', file_format, compress))
+    analyze_graph(nodes, edges, analytics_dir or os.path.join(out_dir, 'analytics'), target, tables, window, depth, max_files, min_cochange)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args.out_dir, args.format, args.compress, args.analytics_dir, args.target, args.tables, args.window, args.depth, args.max_files, args.min_cochange)
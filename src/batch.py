@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import argparse
+import threading
+import contextlib
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from Classes import ApiSetting, ResponseCache, Scope, TokenPool
+import construct_pg
+import get_commit_data
+from metrics import metrics
+from records import is_json_lines, iter_records, output_path
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Fetch and build the graphs of many repositories with one rate budget.')
+    current_directory = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('-m', '--manifest', type=str, required=True, help='The repositories: owner/repo per line, or JSON/JSONL objects with owner, repo and optionally priority, size, since, until, paths, extensions and git_dir')
+    parser.add_argument('-d', '--out_dir', type=str, default=current_directory, help='The output directory (each repository goes to out_dir/owner/repo)')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='The number of concurrent API requests per repository')
+    parser.add_argument('--fetch_jobs', type=int, default=4, help='The number of repositories fetched at the same time')
+    parser.add_argument('--build_jobs', type=int, default=max(1, (os.cpu_count() or 2) - 1), help='The number of worker processes building graphs')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Cache API responses of all repositories in this directory')
+    parser.add_argument('--cache_max_mb', type=int, default=2048, help='The maximum size of the response cache in MB')
+    parser.add_argument('-f', '--format', type=str, default='json', choices=['json', 'jsonl'], help='The output format')
+    parser.add_argument('-z', '--compress', type=str, default='none', choices=['none', 'gz', 'zst'], help='Compress the output files')
+    parser.add_argument('--index', action='store_true', help='Also write the CSR adjacency index of each graph')
+    parser.add_argument('--export', type=str, default=None, choices=['parquet', 'arrow', 'csv'], help='Also export nodes and edges per label')
+    parser.add_argument('--metrics', type=str, default=None, help='Write metrics to this file periodically (JSON if it ends with .json, otherwise Prometheus text)')
+    parser.add_argument('--metrics_interval', type=float, default=10, help='Seconds between metrics writes')
+    return parser.parse_args()
+
+
+def read_manifest(filepath):
+    """Return the repositories listed in a manifest as dicts, dropping duplicates."""
+    if filepath.endswith(('.json', '.gz', '.zst')) or is_json_lines(filepath):
+        entries = list(iter_records(filepath))
+    else:
+        with open(filepath, 'r', encoding='utf-8') as manifest_file:
+            lines = [line.split('#', 1)[0].strip() for line in manifest_file]
+        entries = [dict(zip(('owner', 'repo'), line.split('/', 1))) for line in lines if line]
+    repositories = {}
+    for entry in entries:
+        if 'repo' not in entry:
+            raise ValueError(f"The manifest entry {entry} does not have owner and repo")
+        name = f"{entry['owner']}/{entry['repo']}"
+        repositories[name] = {
+            'name': name,
+            'owner': entry['owner'],
+            'repo': entry['repo'],
+            'priority': entry.get('priority', 0),
+            'size': entry.get('size'),
+            'since': entry.get('since'),
+            'until': entry.get('until'),
+            'paths': entry.get('paths'),
+            'extensions': entry.get('extensions'),
+            'git_dir': entry.get('git_dir'),
+        }
+    return list(repositories.values())
+
+
+class BatchState:
+    """The result of the last fetch and build of every repository, kept in out_dir/batch_state.json."""
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(filepath):
+            with open(filepath, 'r', encoding='utf-8') as state_file:
+                self.records = json.load(state_file)
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.records.get(name, {}))
+
+    def update(self, name, **fields):
+        with self.lock:
+            self.records.setdefault(name, {}).update(fields)
+            # 途中で止まっても次回の優先度に使えるように毎回保存する
+            temporary = self.filepath + '.tmp'
+            with open(temporary, 'w', encoding='utf-8') as state_file:
+                json.dump(self.records, state_file, indent=4)
+            os.replace(temporary, self.filepath)
+
+
+def priority_key(repository, record):
+    # priority が小さい順，次に一度も作っていないものと前回から日が経ったもの，最後にコミットの少ないもの
+    stale_days = int(record.get('built', 0) // 86400)
+    size = record.get('commits', repository['size'] or 0)
+    return (repository['priority'], stale_days, size)
+
+def repository_dir(out_dir, repository):
+    return os.path.join(out_dir, repository['owner'], repository['repo'])
+
+def fetch_repository(repository, repo_dir, update, api_options, max_workers=1, file_format='json', compress='none'):
+    if repository['git_dir']:
+        get_commit_data.main_from_git(repository['git_dir'], repository['owner'], repository['repo'], repo_dir, repository['since'], repository['until'], file_format, compress, repository['paths'])
+        return 0
+    api_setting = ApiSetting(repository['owner'], repository['repo'], **api_options)
+    get_commit_data.main(api_setting, repo_dir, max_workers, since=repository['since'], until=repository['until'], update=update, file_format=file_format, compress=compress, paths=repository['paths'])
+    return api_setting.count
+
+def build_repository(task):
+    """Build one graph in a worker process, writing its output to repo_dir/build.log."""
+    repo_dir, update, scope, file_format, compress, index, export = task
+    json_path = output_path(repo_dir, 'commit_details', file_format, compress)
+    with open(os.path.join(repo_dir, 'build.log'), 'w', encoding='utf-8') as log_file, \
+            contextlib.redirect_stdout(log_file), contextlib.redirect_stderr(log_file):
+        construct_pg.main(None, json_path, repo_dir, file_format, compress, index=index, export=export, update=update, scope=scope)
+    state = construct_pg.load_state(repo_dir)
+    return {'nodes': state['nodes'], 'edges': state['edges'], 'commits': len(state['commits'])}
+
+def main(repositories, out_dir, token_pool=None, max_workers=4, fetch_jobs=4, build_jobs=1, cache_dir=None, cache_max_bytes=2 * 1024 ** 3, api_root=None, file_format='json', compress='none', index=False, export=None):
+    """Fetch and build every repository, returning the batch state.
+
+    Repositories are fetched fetch_jobs at a time in priority order, with
+    one token pool, HTTP session and response cache shared by all of them.
+    Each fetched repository is built in a pool of build_jobs processes, so
+    builds go on while other fetches are waiting for the rate limit.
+    A repository built before is updated with its new commits only.
+    A failed repository is recorded in batch_state.json and does not stop
+    the others.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    state = BatchState(os.path.join(out_dir, 'batch_state.json'))
+    repositories = sorted(repositories, key=lambda repository: priority_key(repository, state.get(repository['name'])))
+    api_options = {
+        'pool_maxsize': max_workers,
+        'api_root': api_root,
+        'token_pool': token_pool or TokenPool.from_env(),
+        'session': ApiSetting.create_session(fetch_jobs * max_workers),
+        'cache': ResponseCache(cache_dir, cache_max_bytes) if cache_dir else None,
+    }
+    # fork だとフェッチ中のスレッドが持つロックを引き継ぐので spawn で起動する
+    builders = ProcessPoolExecutor(build_jobs, mp_context=multiprocessing.get_context('spawn'))
+
+    def record_build(name, started, future):
+        seconds = time.perf_counter() - started
+        metrics.observe('batch_repository_seconds', seconds, stage='build')
+        try:
+            result = future.result()
+        except BaseException:
+            metrics.inc('batch_repositories_total', stage='build', status='failed')
+            state.update(name, status='build_failed', error=traceback.format_exc())
+            print(f"[{name}] build failed, see {name}/build.log")
+            return
+        metrics.inc('batch_repositories_total', stage='build', status='ok')
+        state.update(name, status='built', built=time.time(), error=None, **result)
+        print(f"[{name}] built {result['nodes']} nodes and {result['edges']} edges in {seconds:.1f}s")
+
+    def run(repository):
+        name = repository['name']
+        repo_dir = repository_dir(out_dir, repository)
+        # 前回作ったグラフがあれば新しいコミットだけを取得して追加する
+        update = os.path.exists(construct_pg.state_path(repo_dir))
+        started = time.perf_counter()
+        try:
+            requests_count = fetch_repository(repository, repo_dir, update, api_options, max_workers, file_format, compress)
+        except BaseException:
+            metrics.inc('batch_repositories_total', stage='fetch', status='failed')
+            state.update(name, status='fetch_failed', error=traceback.format_exc())
+            print(f"[{name}] fetch failed")
+            return None
+        seconds = time.perf_counter() - started
+        metrics.observe('batch_repository_seconds', seconds, stage='fetch')
+        metrics.inc('batch_repositories_total', stage='fetch', status='ok')
+        state.update(name, status='fetched', fetched=time.time(), requests=requests_count)
+        print(f"[{name}] fetched with {requests_count} requests in {seconds:.1f}s")
+        submitted = time.perf_counter()
+        scope = Scope(repository['paths'], repository['extensions'], repository['since'], repository['until'])
+        build = builders.submit(build_repository, (repo_dir, update, scope, file_format, compress, index, export))
+        build.add_done_callback(lambda future: record_build(name, submitted, future))
+        return build
+
+    try:
+        with ThreadPoolExecutor(fetch_jobs) as fetchers:
+            # 投入した順に取り出されるので優先度の高いものから取得が始まる
+            fetches = [fetchers.submit(run, repository) for repository in repositories]
+            builds = [future.result() for future in as_completed(fetches)]
+        for build in builds:
+            if build is not None:
+                with contextlib.suppress(BaseException):
+                    build.result()
+    finally:
+        builders.shutdown()
+
+    records = [state.get(repository['name']) for repository in repositories]
+    built = sum(record.get('status') == 'built' for record in records)
+    print(f"Built {built} of {len(repositories)} repositories")
+    for repository, record in zip(repositories, records):
+        if record.get('status') != 'built':
+            print(f"  {repository['name']}: {record.get('status')}")
+    return state.records
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    with metrics.reporting(args.metrics, args.metrics_interval):
+        main(read_manifest(args.manifest), args.out_dir, None, args.concurrency, args.fetch_jobs, args.build_jobs, args.cache_dir, args.cache_max_mb * 1024 ** 2, None, args.format, args.compress, args.index, args.export)
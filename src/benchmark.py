@@ -0,0 +1,314 @@
+import contextlib
+import gc
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+import argparse
+from datetime import datetime, timezone
+from synthetic import generate_commit_details
+
+STAGES = ['fetch', 'construct', 'structures']
+# 比べる指標 (どれも小さいほど良い)
+METRICS = ['seconds', 'peak_rss_mb', 'bytes_per_node', 'bytes_per_edge']
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark fetching and building the graph on a synthetic history, and compare with earlier runs.')
+    current_directory = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('-n', '--commits', type=int, default=5000, help='The number of synthetic commits')
+    parser.add_argument('-p', '--files_per_commit', type=int, default=5, help='The number of files changed per commit')
+    parser.add_argument('--file_count', type=int, default=None, help='The number of distinct files (default: commits * files_per_commit / 10)')
+    parser.add_argument('--merge_rate', type=float, default=0.1, help='The share of merge commits')
+    parser.add_argument('--rename_rate', type=float, default=0.02, help='The share of changed files that are renamed')
+    parser.add_argument('--patch_lines', type=int, default=20, help='The number of lines in each patch')
+    parser.add_argument('--skew', type=float, default=1.0, help='How strongly changes concentrate on a few hot files (0: uniform)')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed of the synthetic history')
+    parser.add_argument('-s', '--stages', type=str, nargs='+', default=STAGES, choices=STAGES, help='The stages to run')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='The number of concurrent API requests in the fetch stage')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the stub server waits before each response')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='The number of worker processes in the construct stage')
+    parser.add_argument('-f', '--format', type=str, default='json', choices=['json', 'jsonl'], help='The format of the intermediate and output files')
+    parser.add_argument('-z', '--compress', type=str, default='none', choices=['none', 'gz', 'zst'], help='The compression of the intermediate and output files')
+    parser.add_argument('--repeat', type=int, default=1, help='Run each stage this many times and keep the fastest run')
+    parser.add_argument('--work_dir', type=str, default=None, help='Keep the generated files in this directory (default: a temporary directory)')
+    parser.add_argument('--history', type=str, default=os.path.join(current_directory, 'benchmark_history.jsonl'), help='Append the results to this file and compare with its last matching run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Report a regression when a metric grows by more than this share')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if a regression is found')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the benchmarked code')
+    return parser.parse_args()
+
+
+class StageTimer:
+    """Accumulates the wall time spent in functions it wraps, per stage name."""
+    def __init__(self):
+        self.seconds = {}
+
+    def wrap(self, owner, name, stage):
+        function = getattr(owner, name)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+        setattr(owner, name, timed)
+
+    def result(self, total):
+        # ラップしていない部分 (コミットの読み込みとノード・辺の追加) は build にまとめる
+        stages = {stage: round(seconds, 3) for stage, seconds in self.seconds.items()}
+        stages['build'] = round(total - sum(self.seconds.values()), 3)
+        return stages
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # Linux の ru_maxrss は KiB，macOS はバイト
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+def run_fetch(options):
+    import get_commit_data
+    from Classes import ApiSetting, TokenPool
+    timer = StageTimer()
+    timer.wrap(get_commit_data, 'get_commits', 'list')
+    timer.wrap(get_commit_data, 'get_commit', 'details')
+    timer.wrap(get_commit_data, 'write_records', 'write')
+    out_dir = options['out_dir']
+    shutil.rmtree(out_dir, ignore_errors=True)
+    api_setting = ApiSetting('owner', 'repo', pool_maxsize=options['concurrency'], api_root=options['api_root'], token_pool=TokenPool(['benchmark']))
+    start = time.perf_counter()
+    get_commit_data.main(api_setting, out_dir, options['concurrency'], file_format=options['format'], compress=options['compress'])
+    total = time.perf_counter() - start
+    return {'seconds': round(total, 3), 'stages': timer.result(total), 'requests': api_setting.count}
+
+def run_construct(options):
+    import construct_pg
+    from Classes import Files, Edges
+    timer = StageTimer()
+    timer.wrap(Files, 'connect_files', 'connect')
+    timer.wrap(Files, 'write_as_json', 'write')
+    timer.wrap(construct_pg, 'write_records', 'write')
+    timer.wrap(Edges, 'finalize', 'index')
+    out_dir = options['out_dir']
+    shutil.rmtree(out_dir, ignore_errors=True)
+    start = time.perf_counter()
+    construct_pg.main(None, options['details_path'], out_dir, options['format'], options['compress'], index=True, max_workers=options['workers'])
+    total = time.perf_counter() - start
+    return {'seconds': round(total, 3), 'stages': timer.result(total)}
+
+def run_structures(options):
+    # Nodes と Edges だけの時間とメモリ (パッチは含めない)
+    from Classes import Nodes, Edges, CommitNode, FileNode
+    commits = list(generate_commit_details(**dict(options['history'], patch_lines=0)))
+    def build_nodes():
+        nodes = Nodes()
+        for commit in commits:
+            nodes.add_node(CommitNode(commit))
+        for commit in commits:
+            for file in commit['files']:
+                nodes.add_node(FileNode(file, commit['sha']))
+        return nodes
+    def build_edges(nodes):
+        edges = Edges()
+        for commit in commits:
+            dst = nodes.get_id(commit['sha'])
+            for parent in commit['parents']:
+                edges.add_edge({'src': nodes.get_id(parent['sha']), 'dst': dst, 'label': ['isParentOf'], 'property': {'date': commit['commit']['author']['date']}})
+            for file in commit['files']:
+                file_data = FileNode(file, commit['sha'])
+                edges.add_edge({'src': nodes.get_id(file_data.get_hash()), 'dst': dst, 'label': [file_data.get_status(), 'commit'], 'property': {}})
+        return edges
+    def measure(build, *args):
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = build(*args)
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0] - before, elapsed
+    tracemalloc.start()
+    nodes, node_bytes, node_time = measure(build_nodes)
+    edges, edge_bytes, edge_time = measure(build_edges, nodes)
+    tracemalloc.stop()
+    return {
+        'seconds': round(node_time + edge_time, 3),
+        'stages': {'nodes': round(node_time, 3), 'edges': round(edge_time, 3)},
+        'nodes': len(nodes),
+        'edges': len(edges),
+        'bytes_per_node': round(node_bytes / len(nodes)),
+        'bytes_per_edge': round(edge_bytes / len(edges)),
+    }
+
+RUNNERS = {'fetch': run_fetch, 'construct': run_construct, 'structures': run_structures}
+
+def run_stage(connection, stage, options):
+    # 別プロセスで1回だけ実行し，このプロセスの最大 RSS を測る
+    try:
+        with contextlib.ExitStack() as stack:
+            if not options['verbose']:
+                devnull = stack.enter_context(open(os.devnull, 'w'))
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+                stack.enter_context(contextlib.redirect_stderr(devnull))
+            result = RUNNERS[stage](options)
+        result['peak_rss_mb'] = peak_rss_mb()
+        children_peak = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        if children_peak:
+            result['workers_peak_rss_mb'] = children_peak
+        connection.send(result)
+    except BaseException:
+        connection.send({'error': traceback.format_exc()})
+    finally:
+        connection.close()
+
+def run_in_process(stage, options):
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_stage, args=(sender, stage, options))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(f"The {stage} stage failed:\n{result['error']}")
+    return result
+
+def git_revision():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+def config_id(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def last_matching_run(history_path, run_config_id):
+    previous = None
+    if os.path.exists(history_path):
+        with open(history_path, 'r', encoding='utf-8') as history_file:
+            for line in history_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    if entry['config_id'] == run_config_id:
+                        previous = entry
+    return previous
+
+def compare(results, previous, threshold):
+    """Print each stage's metrics next to the previous run and return the regressions found."""
+    regressions = []
+    for stage, result in results.items():
+        commits_per_second = result.get('commits_per_second')
+        line = f"{stage:<11} {result['seconds']:8.2f} s"
+        if commits_per_second:
+            line += f" {commits_per_second:9.0f} commits/s"
+        line += f" {result['peak_rss_mb']:8.1f} MiB peak"
+        print(line)
+        print('            ' + ', '.join(f"{name} {seconds:.2f} s" for name, seconds in result['stages'].items()))
+        if 'bytes_per_node' in result:
+            print(f"            {result['bytes_per_node']} B/node, {result['bytes_per_edge']} B/edge")
+        before = (previous or {}).get('results', {}).get(stage)
+        if before is None:
+            continue
+        for metric in METRICS:
+            if metric not in result or not before.get(metric):
+                continue
+            change = result[metric] / before[metric] - 1
+            flag = ''
+            if change > threshold:
+                flag = '  <- regression'
+                regressions.append((stage, metric, before[metric], result[metric]))
+            print(f"            {metric}: {before[metric]} -> {result[metric]} ({change:+.1%}){flag}")
+    return regressions
+
+def main(history, stages=STAGES, concurrency=4, latency=0.0, workers=1, file_format='json', compress='none', repeat=1,
+         work_dir=None, history_path=None, threshold=0.1, verbose=False):
+    """Run the selected stages on the synthetic history described by history (generate_commit_details arguments).
+
+    Each run happens in a fresh process so its peak RSS is its own. The
+    fetch stage talks to a StubGitHub serving the history; the construct
+    stage reads the fetched commit_details, or the history written out
+    directly if fetch is not run. Results are appended to history_path
+    and compared with the last run of the same configuration.
+    """
+    from records import output_path, write_records
+    from stub_github import StubGitHub
+    temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+    # 実行する段階を変えても同じ設定の結果とは比べられるように stages は含めない
+    config = {'history': history, 'concurrency': concurrency, 'latency': latency, 'workers': workers,
+              'format': file_format, 'compress': compress}
+    options = dict(config, verbose=verbose, out_dir=None)
+    print(f"Generating {history['commits']} synthetic commits")
+    commits = list(generate_commit_details(**history))
+    results = {}
+    try:
+        fetch_dir = os.path.join(work_dir, 'fetch')
+        details_path = output_path(fetch_dir, 'commit_details', file_format, compress)
+        for stage in stages:
+            if stage == 'construct' and 'fetch' not in results:
+                write_records(details_path, commits, key=None if file_format == 'jsonl' else lambda commit: commit['sha'])
+            runs = []
+            for _ in range(repeat):
+                print(f"Running {stage}")
+                stage_options = dict(options, out_dir=os.path.join(work_dir, stage), details_path=details_path)
+                if stage == 'fetch':
+                    stage_options['out_dir'] = fetch_dir
+                    with StubGitHub(commits, latency=latency) as stub:
+                        stage_options['api_root'] = stub.url()
+                        runs.append(run_in_process(stage, stage_options))
+                else:
+                    runs.append(run_in_process(stage, stage_options))
+            result = min(runs, key=lambda run: run['seconds'])
+            if stage != 'structures':
+                result['commits_per_second'] = round(len(commits) / result['seconds'], 1)
+            results[stage] = result
+    finally:
+        if temporary:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    entry = {
+        'time': datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': f"{platform.machine()} {os.cpu_count()} cpus",
+        'config_id': config_id(config),
+        'config': config,
+        'results': results,
+    }
+    previous = last_matching_run(history_path, entry['config_id']) if history_path else None
+    if previous is not None:
+        print(f"Compared with {previous['revision']} at {previous['time']}")
+    regressions = compare(results, previous, threshold)
+    if history_path:
+        with open(history_path, 'a', encoding='utf-8') as history_file:
+            history_file.write(json.dumps(entry) + '\n')
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    history = {
+        'commits': args.commits,
+        'files_per_commit': args.files_per_commit,
+        'file_count': args.file_count,
+        'merge_rate': args.merge_rate,
+        'rename_rate': args.rename_rate,
+        'patch_lines': args.patch_lines,
+        'skew': args.skew,
+        'seed': args.seed,
+    }
+    regressions = main(history, args.stages, args.concurrency, args.latency, args.workers, args.format, args.compress,
+                       args.repeat, args.work_dir, args.history, args.threshold, args.verbose)
+    if regressions and args.check:
+        sys.exit(1)
@@ -0,0 +1,30 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def map_concurrently(func, items, max_workers=1, ordered=True, processes=False):
+    """Yield (item, func(item)) using a thread pool with a bounded number of queued calls.
+
+    With ordered=False results are yielded as soon as they complete. With
+    processes=True a process pool is used, so func must be picklable.
+    """
+    items = iter(items)
+    window = max(1, max_workers) * 2
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=max(1, max_workers)) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= window:
+                break
+        while pending:
+            if ordered:
+                item, future = pending.popleft()
+            else:
+                wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                index = next(i for i, (_, future) in enumerate(pending) if future.done())
+                item, future = pending[index]
+                del pending[index]
+            yield item, future.result()
+            for next_item in items:
+                pending.append((next_item, executor.submit(func, next_item)))
+                break
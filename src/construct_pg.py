@@ -1,8 +1,15 @@
-import json
 import os
+import json
+import hashlib
 import argparse
+import itertools
 import tqdm
-from Classes import Nodes, Edges, CommitNode, FileNode, Files, ApiSetting
+from Classes import Nodes, Edges, CommitNode, FileNode, Files, ApiSetting, PatchStore, Scope
+from concurrency import map_concurrently
+from sqlite_store import SqliteGraphStore
+from export_graph import export_graph
+from metrics import metrics
+from records import append_records, is_json_lines, iter_records, open_records, write_records, output_path
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Process some parameters.')
@@ -11,59 +18,288 @@ def parse_arguments():
     parser.add_argument('-r', '--repo_name', type=str, default='spark', help='The name of the repository')
     parser.add_argument('-j', '--json_path', type=str, default=os.path.join(current_directory,'commit_details.json'), help='The output directory')
     parser.add_argument('-d', '--out_dir', type=str, default=current_directory, help='The output directory')
+    parser.add_argument('-f', '--format', type=str, default='json', choices=['json', 'jsonl'], help='The output format')
+    parser.add_argument('-z', '--compress', type=str, default='none', choices=['none', 'gz', 'zst'], help='Compress the output files')
+    parser.add_argument('--id_map', type=str, default=None, help='Reuse and extend the node ids saved in this file')
+    parser.add_argument('--index', action='store_true', help='Also write the CSR adjacency index to out_dir/edge_index.bin')
+    parser.add_argument('--store', type=str, default='memory', choices=['memory', 'sqlite'], help='Where the graph is kept while it is built')
+    parser.add_argument('--db', type=str, default=None, help='The SQLite database used with --store sqlite (default: out_dir/graph.sqlite, replaced if it exists)')
+    parser.add_argument('--patch_store', type=str, default=None, help='Keep patches in a compressed store in this directory and put only patch_ref in the nodes')
+    parser.add_argument('--export', type=str, default=None, choices=['parquet', 'arrow', 'csv'], help='Also export nodes and edges per label to out_dir/export')
+    parser.add_argument('--partition_by', type=str, default='none', choices=['none', 'year', 'month'], help='With --export, partition dated tables by commit/edge date')
+    parser.add_argument('--analytics', type=str, default=None, choices=['csv', 'parquet'], help='Also write co-change, directory churn and author-file tables to out_dir/analytics')
+    parser.add_argument('--analytics_window', type=str, default='none', choices=['none', 'year', 'quarter', 'month', 'week'], help='With --analytics, aggregate per time window')
+    parser.add_argument('-u', '--update', action='store_true', help='Add only the commits that are not in the graph already in out_dir, and write them to *_delta files')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='The number of worker processes used to build the graph')
+    parser.add_argument('--path', type=str, action='append', default=None, help='Only keep files under this path prefix, and the commits touching them (can be given more than once)')
+    parser.add_argument('--extension', type=str, action='append', default=None, help='Only keep files with this extension, e.g. .py (can be given more than once)')
+    parser.add_argument('--since', type=str, default=None, help='Only keep commits committed at or after this date (YYYY-MM-DDTHH:MM:SSZ)')
+    parser.add_argument('--until', type=str, default=None, help='Only keep commits committed at or before this date (YYYY-MM-DDTHH:MM:SSZ)')
+    parser.add_argument('--metrics', type=str, default=None, help='Write metrics to this file periodically (JSON if it ends with .json, otherwise Prometheus text)')
+    parser.add_argument('--metrics_interval', type=float, default=10, help='Seconds between metrics writes')
+    parser.add_argument('--profile', type=str, default=None, help='Profile each stage into this directory')
+    parser.add_argument('--profile_mode', type=str, default='cprofile', choices=['cprofile', 'sample'], help='cProfile (.prof) or a sampling profiler writing folded stacks (.folded)')
     return parser.parse_args()
 
-        
-def load_json(file_name):
-    with open(file_name, 'rb') as file:
-        return json.load(file)
 
-def write_as_json(data, file_name):
-    print(f"Writing data to {file_name}")
-    # もしディレクトリが存在しない場合は作成
-    os.makedirs(os.path.dirname(file_name), exist_ok=True)
-    with open(file_name, 'w') as file:
-        json.dump(data, file, indent=4)
+def id_digest(key):
+    return hashlib.sha256(key.encode('utf-8')).digest()
+
+def prepare_commit_node(commit):
+    # ワーカープロセスでも実行できるように，ここでは Nodes を触らない
+    commit_data = CommitNode(commit)
+    return commit_data.get_hash(), id_digest(commit_data.get_hash()), commit_data.get_data()
+
+def prepare_commit_edges(commit, detach_patches=False):
+    """Extract a commit's file nodes and precompute the digests of its ids and edges.
+
+    Edge digests assume every node gets the first id of its digest; the
+    merge recomputes the ones whose endpoints were resolved differently.
+    With detach_patches the patches are compressed here and replaced by
+    their PatchStore references.
+    """
+    sha = commit['sha']
+    dst = int.from_bytes(id_digest(sha)[:8], byteorder='big')
+    parents = []
+    for parent in commit['parents']:
+        src = int.from_bytes(id_digest(parent['sha'])[:8], byteorder='big')
+        parents.append((parent['sha'], src, id_digest(str(src)+str(dst)+'isParentOf')))
+    file_nodes = []
+    for file in commit['files']:
+        file_data = FileNode(file, sha)
+        patch = file_data.detach_patch() if detach_patches else None
+        digest = id_digest(file_data.get_hash())
+        src = int.from_bytes(digest[:8], byteorder='big')
+        file_nodes.append((file_data.get_data(), digest, src, id_digest(str(src)+str(dst)+file_data.get_status()+'commit'), patch))
+    return sha, commit['commit']['author']['date'], dst, parents, file_nodes
+
+def merge_commit_node(nodes, prepared):
+    key, digest, data = prepared
+    nodes.add_record(key, data, digest=digest)
+
+def merge_commit_edges(nodes, edges, files, prepared, patch_store=None):
+    sha, date, expected_dst, parents, file_entries = prepared
+    dst = nodes.get_id(sha)
+    for parent_sha, expected_src, digest in parents:
+        src = nodes.get_id(parent_sha)
+        edges.add_edge({'src': src, 'dst': dst, 'label': ['isParentOf'], 'property': {'date': date}}, digest if (src, dst) == (expected_src, expected_dst) else None)
+
+    file_nodes = [FileNode(data, sha, need_extract=False) for data, _, _, _, _ in file_entries]
+    nodes.add_nodes(file_nodes, [digest for _, digest, _, _, _ in file_entries])
+    for file_data, (_, _, expected_src, digest, patch) in zip(file_nodes, file_entries):
+        if patch is not None:
+            patch_store.put_packed(*patch)
+        try:
+            file_data.get_id()
+        except:
+            raise Exception(f"Error: {file_data.get_data()}")
+        src = nodes.get_id(file_data.get_hash())
+        edges.add_edge({'src': src, 'dst': dst, 'label': [file_data.get_status(), 'commit'], 'property': {}}, digest if (src, dst) == (expected_src, expected_dst) else None)
+        files.add_file(sha, file_data, date)
+    metrics.inc('graph_file_versions_total', len(file_nodes))
+
+def add_commit_node(nodes, commit):
+    merge_commit_node(nodes, prepare_commit_node(commit))
+
+def add_commit_edges(nodes, edges, files, commit, patch_store=None):
+    merge_commit_edges(nodes, edges, files, prepare_commit_edges(commit, patch_store is not None), patch_store)
+
+def prepare_batch(task):
+    stage, batch, detach_patches, scope = task
+    commits = [json.loads(commit) if isinstance(commit, str) else commit for commit in batch]
+    if scope:
+        commits = list(scope.filter(commits))
+    if stage == 'nodes':
+        return [prepare_commit_node(commit) for commit in commits]
+    return [prepare_commit_edges(commit, detach_patches) for commit in commits]
+
+def iter_batches(json_path, batch_size):
+    # JSON Lines は行のまま渡してワーカー側でデコードする
+    if is_json_lines(json_path):
+        with open_records(json_path, 'r') as file:
+            commits = (line for line in file if line.strip())
+            yield from iter(lambda: list(itertools.islice(commits, batch_size)), [])
+    else:
+        commits = iter_records(json_path)
+        yield from iter(lambda: list(itertools.islice(commits, batch_size)), [])
+
+def iter_prepared(stage, json_path, max_workers, detach_patches=False, batch_size=500, scope=None):
+    """Yield prepare_commit_node/prepare_commit_edges results in input order, computed by worker processes."""
+    # 範囲外のコミットはワーカー側で落とす
+    tasks = ((stage, batch, detach_patches, scope) for batch in iter_batches(json_path, batch_size))
+    for _, prepared in map_concurrently(prepare_batch, tasks, max_workers, processes=True):
+        yield from prepared
 
+def write_graph(nodes, edges, files, out_dir, file_format='json', compress='none', index=False, max_workers=1):
+    with metrics.stage('write_nodes'):
+        write_records(output_path(out_dir, 'nodes', file_format, compress), nodes.iter_nodes(), max_workers=max_workers)
+    with metrics.stage('write_files'):
+        files.write_as_json(output_path(out_dir, 'files', file_format, compress), max_workers)
 
-def main(api_setting, json_path, out_dir):
-    nodes = Nodes()
-    edges = Edges()
-    commits = load_json(json_path)
-    files = Files(api_setting)
+    print("connect file nodes")
+    with metrics.stage('connect_files'):
+        edges = files.connect_files(edges, max_workers)
+    metrics.set('graph_edges', len(edges))
+
+    with metrics.stage('write_edges'):
+        write_records(output_path(out_dir, 'edges', file_format, compress), edges.iter_edges(), max_workers=max_workers)
+    if index:
+        print("build edge index")
+        with metrics.stage('index'):
+            edges.finalize().save(os.path.join(out_dir, 'edge_index.bin'))
+
+def write_update(nodes, edges, files, out_dir, file_format='json', compress='none', index=False, max_workers=1):
+    """Append the new nodes and edges to the previous graph and also write them to nodes_delta and edges_delta."""
+    with metrics.stage('write_files'):
+        files.write_as_json(output_path(out_dir, 'files', file_format, compress), max_workers)
+
+    print("connect file nodes")
+    with metrics.stage('connect_files'):
+        edges = files.connect_files(edges, max_workers)
+    metrics.set('graph_edges', len(edges))
+
+    for name, iter_new in (('nodes', nodes.iter_nodes), ('edges', edges.iter_edges)):
+        with metrics.stage(f"write_{name}"):
+            write_records(output_path(out_dir, f"{name}_delta", file_format, compress), iter_new(), max_workers=max_workers)
+            append_records(output_path(out_dir, name, file_format, compress), iter_new(), max_workers=max_workers)
+    if index:
+        # 索引は前回の辺も含めて作り直す
+        print("build edge index")
+        with metrics.stage('index'):
+            all_edges = Edges()
+            all_edges.add_edges(iter_records(output_path(out_dir, 'edges', file_format, compress)))
+            all_edges.finalize().save(os.path.join(out_dir, 'edge_index.bin'))
+
+def state_path(out_dir):
+    return os.path.join(out_dir, 'graph_state.json')
+
+def load_state(out_dir):
+    if not os.path.exists(state_path(out_dir)):
+        raise FileNotFoundError(f"{state_path(out_dir)} is not found. Build the graph once without --update first.")
+    with open(state_path(out_dir), 'r', encoding='utf-8') as state_file:
+        return json.load(state_file)
+
+def save_state(out_dir, state):
+    # 次回の --update で使う
+    with open(state_path(out_dir), 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, indent=4)
+
+def main(api_setting, json_path, out_dir, file_format='json', compress='none', id_map_path=None, index=False, max_workers=1, store='memory', db_path=None, patch_dir=None, export=None, partition_by='none', update=False, scope=None, analytics=None, analytics_window='none'):
+    """Build the graph from the commit details, or add new commits to the previous build with update.
+
+    Every build saves graph_state.json and an id map (out_dir/id_map.tsv
+    unless id_map_path is given), and reuses the ids already in that map.
+    An update reuses both, adds only the commits that were not built
+    before and extends the previous output with them instead of
+    rebuilding it.
+    With a scope, only the commits and files in it are built.
+    """
+    state = load_state(out_dir) if update else None
+    scope = scope or Scope()
+    if update:
+        if store != 'memory':
+            raise ValueError("--update needs the memory store; the SQLite store keeps its graph in the database instead")
+        previous_scope = Scope.from_dict(state.get('scope'))
+        if scope and scope != previous_scope:
+            raise ValueError(f"The graph in {out_dir} was built with the scope {previous_scope.to_dict()}")
+        scope = previous_scope
+        file_format, compress = state['format'], state['compress']
+        id_map_path = id_map_path or state['id_map']
+        patch_dir = patch_dir or state['patch_store']
+    elif not id_map_path:
+        # 指定がなくても前回 out_dir に保存した id をそのまま使う
+        id_map_path = os.path.join(out_dir, 'id_map.tsv')
+    # commit_details は全体を読み込まず，2回ストリームで読む
+    patch_store = PatchStore(patch_dir) if patch_dir else None
+    graph_store = None
+    if store == 'sqlite':
+        os.makedirs(out_dir, exist_ok=True)
+        db_path = db_path or os.path.join(out_dir, 'graph.sqlite')
+        # 前回のグラフが残っていると全てのノードが登録済みとして扱われるので作り直す
+        for path in (db_path, db_path + '-wal', db_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        graph_store = SqliteGraphStore(db_path)
+        nodes, edges, files = graph_store.open_graph(api_setting)
+    else:
+        nodes, edges, files = Nodes(), Edges(), Files(api_setting)
+    if id_map_path and os.path.exists(id_map_path):
+        nodes.load_id_map(id_map_path)
+    if update:
+        with metrics.stage('load_previous'):
+            files.load_files(output_path(out_dir, 'files', file_format, compress))
+            known_shas = set(state['commits'])
+            # 新しいコミットは少ないのでリストにして2回使う
+            commits = [commit for commit in scope.filter(iter_records(json_path)) if commit['sha'] not in known_shas]
+        print(f"Found {len(commits)} new commits")
+    else:
+        commits = None
+    shas = []
     print("add commit nodes")
-    for sha, commit in tqdm.tqdm(commits.items()):
-        commit_data = CommitNode(commit)
-        nodes.add_node(commit_data)
+    with metrics.stage('add_nodes'):
+        if max_workers > 1 and commits is None:
+            # 抽出と digest の計算はワーカーで行い，ID の割り当てと追加は入力順にここで行う
+            for prepared in tqdm.tqdm(iter_prepared('nodes', json_path, max_workers, scope=scope)):
+                merge_commit_node(nodes, prepared)
+                shas.append(prepared[0])
+        else:
+            for commit in tqdm.tqdm(commits if commits is not None else scope.filter(iter_records(json_path))):
+                add_commit_node(nodes, commit)
+                shas.append(commit['sha'])
+    metrics.inc('graph_commits_total', len(shas))
     print("add commit-commit edges and commit-file edges")
-    for sha, commit in tqdm.tqdm(commits.items()):
-        dst = nodes.get_id(sha)
-        for parent in commit['parents']:
-            src = nodes.get_id(parent['sha'])
-            edges.add_edge({'src': src, 'dst': dst, 'label': ['isParentOf'], 'property': {'date': commit['commit']['author']['date']}})
-        
-        for file in commit['files']:
-            file_data = FileNode(file, sha)
-            nodes.add_node(file_data)
-            try:
-                file_data.get_id()
-            except:
-                raise Exception(f"Error: {file_data.get_data()}")
-            edges.add_edge({'src': nodes.get_id(file_data.get_hash()), 'dst': dst, 'label': [file_data.get_status(), 'commit'], 'property': {}})
-            files.add_file(sha, file_data, commit['commit']['author']['date'])
-
-    write_as_json(list(nodes.get_nodes().values()), os.path.join(out_dir, 'nodes.json'))
-    files.write_as_json(os.path.join(out_dir, 'files.json'))
+    with metrics.stage('add_edges'):
+        if max_workers > 1 and commits is None:
+            for prepared in tqdm.tqdm(iter_prepared('edges', json_path, max_workers, patch_store is not None, scope=scope)):
+                merge_commit_edges(nodes, edges, files, prepared, patch_store)
+        else:
+            for commit in tqdm.tqdm(commits if commits is not None else scope.filter(iter_records(json_path))):
+                add_commit_edges(nodes, edges, files, commit, patch_store)
+    if patch_store is not None:
+        patch_store.close()
+    metrics.set('graph_nodes', len(nodes))
+    metrics.set('graph_edges', len(edges))
 
-    print("connect file nodes")
-    edges = files.connect_files(edges)
-            
-    write_as_json(list(edges.get_edges().values()), os.path.join(out_dir, 'edges.json'))
+    if update:
+        write_update(nodes, edges, files, out_dir, file_format, compress, index, max_workers)
+        read_nodes = lambda: iter_records(output_path(out_dir, 'nodes', file_format, compress))
+        read_edges = lambda: iter_records(output_path(out_dir, 'edges', file_format, compress))
+    else:
+        write_graph(nodes, edges, files, out_dir, file_format, compress, index, max_workers)
+        read_nodes, read_edges = nodes.iter_nodes, edges.iter_edges
+    if export:
+        with metrics.stage('export'):
+            export_graph(read_nodes(), read_edges(), os.path.join(out_dir, 'export'), export, partition_by)
+    if analytics:
+        # numpy と scipy は --analytics のときだけ読み込む
+        try:
+            from analytics import analyze_graph
+        except ImportError:
+            raise ImportError("numpy and scipy are required for --analytics (pip install numpy scipy)")
+        with metrics.stage('analytics'):
+            analyze_graph(read_nodes(), read_edges(), os.path.join(out_dir, 'analytics'), analytics, window=analytics_window)
+    nodes.save_id_map(id_map_path)
+    save_state(out_dir, {
+        'format': file_format,
+        'compress': compress,
+        'id_map': os.path.abspath(id_map_path),
+        'patch_store': patch_dir and os.path.abspath(patch_dir),
+        'nodes': len(nodes) + (state['nodes'] if update else 0),
+        'edges': len(edges) + (state['edges'] if update else 0),
+        'commits': shas + (state['commits'] if update else []),
+        'scope': scope.to_dict(),
+    })
+    if graph_store is not None:
+        graph_store.close()
     return
 
 
 if __name__ == '__main__':
     args = parse_arguments()
     api_setting = ApiSetting(args.owner_name, args.repo_name)
-    main(api_setting, args.json_path, args.out_dir)
+    scope = Scope(args.path, args.extension, args.since, args.until)
+    if args.profile:
+        metrics.enable_profiling(args.profile, args.profile_mode)
+    with metrics.reporting(args.metrics, args.metrics_interval):
+        main(api_setting, args.json_path, args.out_dir, args.format, args.compress, args.id_map, args.index, args.workers, args.store, args.db, args.patch_store, args.export, args.partition_by, args.update, scope, args.analytics, args.analytics_window)
 
@@ -0,0 +1,267 @@
+import os
+import re
+import csv
+import shutil
+import argparse
+from datetime import datetime, timezone
+import tqdm
+from Classes import CommitNode, FileNode
+from records import iter_records, output_path
+
+TARGETS = {'parquet': '.parquet', 'arrow': '.arrow', 'csv': '.csv'}
+# 抽出されるキーは最初のバッチに現れなくても列として持つ
+COMMIT_COLUMNS = [new_key for _, new_key in CommitNode.extract_keys_for_commit]
+FILE_COLUMNS = [new_key for _, new_key in FileNode.extract_keys_for_file] + ['patch_ref', 'directory']
+INTEGER_COLUMNS = {'total', 'additions', 'deletions', 'changes'}
+ID_COLUMNS = {'id', 'src', 'dst'}
+# neo4j-admin import のヘッダで使う型
+CSV_TYPES = {'int64': ':long', 'float64': ':double', 'bool': ':boolean', 'timestamp': ':datetime'}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Export nodes and edges as columnar tables or bulk-import CSV files.')
+    current_directory = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('-d', '--out_dir', type=str, default=current_directory, help='The directory holding nodes and edges')
+    parser.add_argument('-f', '--format', type=str, default='json', choices=['json', 'jsonl'], help='The format of nodes and edges')
+    parser.add_argument('-z', '--compress', type=str, default='none', choices=['none', 'gz', 'zst'], help='The compression of nodes and edges')
+    parser.add_argument('-e', '--export_dir', type=str, default=None, help='The export directory (default: out_dir/export)')
+    parser.add_argument('-t', '--target', type=str, default='parquet', choices=list(TARGETS), help='The export format')
+    parser.add_argument('-p', '--partition_by', type=str, default='none', choices=['none', 'year', 'month'], help='Partition dated tables by commit/edge date')
+    parser.add_argument('-b', '--batch_size', type=int, default=65536, help='The number of rows per written batch')
+    return parser.parse_args()
+
+
+def table_name(label):
+    # 例: ['file', '.py'] -> file_py, ['isPreviousVersionOf', 'modified'] -> isPreviousVersionOf_modified
+    return re.sub(r'[^0-9A-Za-z]+', '_', '_'.join(label)).strip('_') or 'unlabeled'
+
+def to_timestamp(value):
+    if value is None or isinstance(value, datetime):
+        date = value
+    else:
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date is not None and date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+def column_type(name, value):
+    if name in ID_COLUMNS:
+        return 'uint64'
+    if name == 'label':
+        return 'list'
+    if name == 'date' or name.endswith('_date'):
+        return 'timestamp'
+    if name in INTEGER_COLUMNS:
+        return 'int64'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int64'
+    if isinstance(value, float):
+        return 'float64'
+    return 'string'
+
+def to_row(record):
+    row = {key: value for key, value in record.items() if key != 'property'}
+    row.update(record.get('property') or {})
+    return row
+
+def partition_of(row, partition_by):
+    date = to_timestamp(row.get('author_date', row.get('date')))
+    if partition_by == 'none' or date is None:
+        return ()
+    if partition_by == 'year':
+        return (f"year={date.year:04d}",)
+    return (f"year={date.year:04d}", f"month={date.month:02d}")
+
+
+class TableSchema:
+    """Column names and types of one exported table, fixed by its first batch."""
+    def __init__(self, kind, label, rows):
+        names = ['id', 'src', 'dst', 'label'] if kind == 'edges' else ['id', 'label']
+        if kind == 'nodes':
+            names += COMMIT_COLUMNS if 'commit' in label else FILE_COLUMNS if 'file' in label else []
+        for row in rows:
+            names += [name for name in row if name not in names]
+        names = list(dict.fromkeys(names))
+        samples = {name: next((row[name] for row in rows if row.get(name) is not None), None) for name in names}
+        self.kind = kind
+        self.columns = [(name, column_type(name, samples[name])) for name in names]
+        self.names = set(names)
+        self.dropped = set()
+
+    def columns_of(self, rows):
+        # 最初のバッチになかったキーは出力できないので一度だけ知らせる
+        for row in rows:
+            for name in row.keys() - self.names - self.dropped:
+                self.dropped.add(name)
+                print(f"Column {name} is not in the schema of this table and is not exported.")
+        columns = []
+        for name, type in self.columns:
+            values = [row.get(name) for row in rows]
+            if type == 'timestamp':
+                values = [to_timestamp(value) for value in values]
+            elif type == 'string':
+                values = [None if value is None else str(value) for value in values]
+            columns.append(values)
+        return columns
+
+
+class ArrowTableWriter:
+    def __init__(self, filepath, schema, target):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required to export Parquet or Arrow files (pip install pyarrow)")
+        self.pa = pa
+        self.schema = schema
+        types = {'uint64': pa.uint64(), 'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_(),
+                 'string': pa.string(), 'timestamp': pa.timestamp('s', tz='UTC'), 'list': pa.list_(pa.string())}
+        self.arrow_schema = pa.schema([(name, types[type]) for name, type in schema.columns])
+        if target == 'parquet':
+            self.writer = pq.ParquetWriter(filepath, self.arrow_schema)
+        else:
+            self.writer = pa.ipc.new_file(filepath, self.arrow_schema)
+
+    def write(self, rows):
+        arrays = [self.pa.array(values, type=field.type) for values, field in zip(self.schema.columns_of(rows), self.arrow_schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.arrow_schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class CsvTableWriter:
+    """CSV with a neo4j-admin import style header (id:ID, :LABEL, :START_ID, :END_ID, :TYPE)."""
+    def __init__(self, filepath, schema, table):
+        self.file = open(filepath, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.schema = schema
+        self.table = table
+        header = []
+        for name, type in schema.columns:
+            if schema.kind == 'nodes' and name == 'id':
+                header.append('id:ID')
+            elif schema.kind == 'nodes' and name == 'label':
+                header.append(':LABEL')
+            elif schema.kind == 'edges' and name in ('src', 'dst', 'label'):
+                header.append({'src': ':START_ID', 'dst': ':END_ID', 'label': ':TYPE'}[name])
+            else:
+                header.append(name + CSV_TYPES.get(type, ''))
+        self.writer.writerow(header)
+
+    def to_cell(self, name, type, value):
+        if value is None:
+            return ''
+        if name == 'label':
+            return self.table if self.schema.kind == 'edges' else ';'.join(label for label in value if label)
+        if type == 'timestamp':
+            return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+        if type == 'bool':
+            return 'true' if value else 'false'
+        return value
+
+    def write(self, rows):
+        columns = self.schema.columns_of(rows)
+        for values in zip(*columns):
+            self.writer.writerow([self.to_cell(name, type, value) for (name, type), value in zip(self.schema.columns, values)])
+
+    def close(self):
+        self.file.close()
+
+
+class GraphExporter:
+    """Streams nodes and edges into one file per label (and partition), batch_size rows at a time.
+
+    Tables go to export_dir/{nodes,edges}/<label>/[year=YYYY/[month=MM/]]part-NNNNN.<ext>.
+    At most max_open_files writers stay open; a partition whose writer was
+    closed continues in the next part file. The nodes and edges of an
+    earlier export are removed first, so no stale part files are left.
+    """
+    def __init__(self, export_dir, target='parquet', partition_by='none', batch_size=65536, max_open_files=128):
+        self.export_dir = export_dir
+        self.target = target
+        self.partition_by = partition_by
+        self.batch_size = batch_size
+        self.max_open_files = max_open_files
+        self.buffers = {} # (kind, table, partition): [row]
+        self.labels = {} # (kind, table): label
+        self.schemas = {} # (kind, table): TableSchema
+        self.writers = {} # (kind, table, partition): writer  (最後に使った順)
+        self.parts = {} # (kind, table, partition): 次の part 番号
+        self.counts = {'nodes': 0, 'edges': 0}
+        # part 番号は毎回 0 から振るので，前回の part や別の partition_by のディレクトリを残さない
+        for kind in ('nodes', 'edges'):
+            shutil.rmtree(os.path.join(export_dir, kind), ignore_errors=True)
+
+    def add(self, kind, record):
+        row = to_row(record)
+        table = table_name(row['label'])
+        self.labels.setdefault((kind, table), row['label'])
+        key = (kind, table, partition_of(row, self.partition_by))
+        buffer = self.buffers.setdefault(key, [])
+        buffer.append(row)
+        self.counts[kind] += 1
+        if len(buffer) >= self.batch_size:
+            self.flush(key)
+
+    def add_nodes(self, nodes):
+        for node in nodes:
+            self.add('nodes', node)
+
+    def add_edges(self, edges):
+        for edge in edges:
+            self.add('edges', edge)
+
+    def open_writer(self, key, schema):
+        kind, table, partition = key
+        directory = os.path.join(self.export_dir, kind, table, *partition)
+        os.makedirs(directory, exist_ok=True)
+        part = self.parts.get(key, 0)
+        self.parts[key] = part + 1
+        filepath = os.path.join(directory, f"part-{part:05d}{TARGETS[self.target]}")
+        if self.target == 'csv':
+            return CsvTableWriter(filepath, schema, table)
+        return ArrowTableWriter(filepath, schema, self.target)
+
+    def flush(self, key):
+        rows = self.buffers.pop(key, None)
+        if not rows:
+            return
+        kind, table, _ = key
+        if (kind, table) not in self.schemas:
+            self.schemas[(kind, table)] = TableSchema(kind, self.labels[(kind, table)], rows)
+        writer = self.writers.pop(key, None)
+        if writer is None:
+            if len(self.writers) >= self.max_open_files:
+                oldest = next(iter(self.writers))
+                self.writers.pop(oldest).close()
+            writer = self.open_writer(key, self.schemas[(kind, table)])
+        self.writers[key] = writer
+        writer.write(rows)
+
+    def close(self):
+        for key in list(self.buffers):
+            self.flush(key)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        tables = sorted({(kind, table) for kind, table, _ in self.parts})
+        print(f"Exported {self.counts['nodes']} nodes and {self.counts['edges']} edges into {len(tables)} tables under {self.export_dir}")
+
+
+def export_graph(nodes, edges, export_dir, target='parquet', partition_by='none', batch_size=65536):
+    exporter = GraphExporter(export_dir, target, partition_by, batch_size)
+    exporter.add_nodes(tqdm.tqdm(nodes, desc='nodes'))
+    exporter.add_edges(tqdm.tqdm(edges, desc='edges'))
+    exporter.close()
+
+def main(out_dir, file_format='json', compress='none', export_dir=None, target='parquet', partition_by='none', batch_size=65536):
+    nodes = iter_records(output_path(out_dir, 'nodes', file_format, compress))
+    edges = iter_records(output_path(out_dir, 'edges', file_format, compress))
+    export_graph(nodes, edges, export_dir or os.path.join(out_dir, 'export'), target, partition_by, batch_size)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args.out_dir, args.format, args.compress, args.export_dir, args.target, args.partition_by, args.batch_size)
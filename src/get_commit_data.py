@@ -1,9 +1,13 @@
-import json
 import os
 import tqdm
-import time
 import argparse
-from Classes import ApiSetting
+import subprocess
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlparse, parse_qs
+from Classes import ApiSetting, FetchJournal
+from concurrency import map_concurrently
+from metrics import metrics
+from records import iter_records, write_records, output_path
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Process some parameters.')
@@ -11,11 +15,29 @@ def parse_arguments():
     parser.add_argument('-o', '--owner_name', type=str, default='apache', help='The name of the owner')
     parser.add_argument('-r', '--repo_name', type=str, default='spark', help='The name of the repository')
     parser.add_argument('-d', '--out_dir', type=str, default=current_directory, help='The output directory')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='The number of concurrent API requests')
+    parser.add_argument('-w', '--windows', type=int, default=1, help='The number of time windows listed in parallel')
+    parser.add_argument('--since', type=str, default=None, help='Only list commits after this date (YYYY-MM-DDTHH:MM:SSZ)')
+    parser.add_argument('--until', type=str, default=None, help='Only list commits before this date (YYYY-MM-DDTHH:MM:SSZ)')
+    parser.add_argument('--path', type=str, action='append', default=None, help='Only list commits touching this file or directory (can be given more than once)')
+    parser.add_argument('-u', '--update', action='store_true', help='Fetch only commits newer than the ones already in out_dir')
+    parser.add_argument('-g', '--git_dir', type=str, default=None, help='Read commits from this local clone instead of the API')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Cache API responses in this directory')
+    parser.add_argument('--cache_max_mb', type=int, default=2048, help='The maximum size of the response cache in MB')
+    parser.add_argument('--graphql', action='store_true', help='With --commits_only, fetch commit metadata in batches through the GraphQL API')
+    parser.add_argument('--commits_only', action='store_true', help='Fetch commits without their files')
+    parser.add_argument('-f', '--format', type=str, default='json', choices=['json', 'jsonl'], help='The output format')
+    parser.add_argument('-z', '--compress', type=str, default='none', choices=['none', 'gz', 'zst'], help='Compress the output files')
+    parser.add_argument('--restart', action='store_true', help='Discard the journal in out_dir and fetch everything again')
+    parser.add_argument('--metrics', type=str, default=None, help='Write metrics to this file periodically (JSON if it ends with .json, otherwise Prometheus text)')
+    parser.add_argument('--metrics_interval', type=float, default=10, help='Seconds between metrics writes')
     return parser.parse_args()
 
-def get_total_pages(api_setting, per_page=100):
-    response = api_setting.get_data("commits", with_json=False, params={'per_page': per_page})
+PER_PAGE = 100 # GitHub の最大ページサイズ
+PAGE_RETRIES = 2
+UPDATE_OVERLAP = timedelta(days=7)
 
+def parse_total_pages(response):
     link_header = response.headers.get('Link', None)
     if link_header:
         # get last page number
@@ -23,53 +45,386 @@ def get_total_pages(api_setting, per_page=100):
         for link in links:
             if 'rel="last"' in link:
                 last_page_url = link.split(';')[0].strip('<> ')
-                last_page_number = last_page_url.split('page=')[-1]
-                return int(last_page_number)
+                return int(parse_qs(urlparse(last_page_url).query)['page'][0])
     return 1 # if there is only one page
 
-def get_commits(api_setting):
-    total_pages = get_total_pages(api_setting)
+def get_total_pages(api_setting, per_page=PER_PAGE, params=None):
+    response = api_setting.get_data("commits", with_json=False, params=dict(params or {}, per_page=per_page))
+    return parse_total_pages(response)
+
+def fetch_commit_page(api_setting, params, page):
+    response = api_setting.get_data("commits", with_json=False, params=dict(params, page=page))
+    if response is None or response.status_code != 200:
+        print(f"Error[page: {page}]: {getattr(response, 'status_code', None)}")
+        return None
+    return response.json()
+
+def list_commit_pages(api_setting, params=None, max_workers=1):
+    """List every page of commits, newest first, without duplicate shas.
+
+    A page that still fails after PAGE_RETRIES more tries raises
+    RuntimeError, so a partial listing is never taken for the full history.
+    """
+    # 1ページ目のレスポンスから総ページ数を取り，残りのページを並列に取得する
+    params = dict(params or {}, per_page=PER_PAGE)
+    response = api_setting.get_data("commits", with_json=False, params=params)
+    if response is None:
+        raise RuntimeError(f"Failed to list page 1 of the commits ({params})")
+    total_pages = parse_total_pages(response)
     print(f"Total pages: {total_pages}")
+    pages = [response.json()]
+    fetched = map_concurrently(lambda page: fetch_commit_page(api_setting, params, page), range(2, total_pages+1), max_workers)
+    for page, page_commits in tqdm.tqdm(fetched, total=total_pages-1):
+        for _ in range(PAGE_RETRIES):
+            if page_commits is not None:
+                break
+            page_commits = fetch_commit_page(api_setting, params, page)
+        if page_commits is None:
+            raise RuntimeError(f"Failed to list page {page} of {total_pages} of the commits ({params})")
+        pages.append(page_commits)
+    # 取得中に push されるとページの境界がずれて同じコミットが2回現れるので最初のものだけ残す
     commits = []
-    for page in tqdm.tqdm(range(1, total_pages+1)):
-        response = api_setting.get_data("commits?page=" + str(page), with_json=False)
-        if response.status_code == 200:
-            commits.extend(response.json())
-        else:
-            print(f"Error[page: {page}]: {response.status_code}")
-            break
-        time.sleep(0.5)
+    seen = set()
+    for page_commits in pages:
+        for commit in page_commits:
+            if commit['sha'] not in seen:
+                seen.add(commit['sha'])
+                commits.append(commit)
     return commits
 
-def write_as_json(data, file_name):
-    print(f"Writing data to {file_name}")
-    with open(file_name, 'w') as file:
-        json.dump(data, file, indent=4)
+def get_oldest_commit_date(api_setting, params=None):
+    total_pages = get_total_pages(api_setting, params=params)
+    last_page = fetch_commit_page(api_setting, dict(params or {}, per_page=PER_PAGE), total_pages)
+    if not last_page:
+        return None
+    return last_page[-1]['commit']['committer']['date']
+
+def parse_date(date):
+    return datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+def format_date(date):
+    return date.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
+def split_time_windows(since, until, windows):
+    # [since, until] を新しい順に windows 個の区間に分割する (境界は両方の区間に含まれる)
+    since, until = parse_date(since), parse_date(until)
+    step = (until - since) / windows
+    bounds = [since + step * i for i in range(windows)] + [until]
+    return [(format_date(bounds[i]), format_date(bounds[i+1])) for i in reversed(range(windows))]
 
-def get_commit(api_setting, sha_list):
+def get_commits(api_setting, max_workers=1, windows=1, since=None, until=None, paths=None):
+    """List the commits newest first, only the ones touching one of paths if it is given."""
+    if not paths:
+        return list_commits(api_setting, max_workers, windows, since, until)
+    if len(paths) == 1:
+        # path が1つなら API の並び (トポロジカル順) をそのまま使う
+        return list_commits(api_setting, max_workers, windows, since, until, paths[0])
+    # API は path を1つしか取らないので path ごとに列挙して新しい順にまとめる
     commits = {}
-    for sha in tqdm.tqdm(sha_list):
-        response = api_setting.get_data("commits/" + sha, with_json=False)
-        if response.status_code == 200:
-            commits[sha] = response.json()
-        else:
-            print(f"Error[sha: {sha}]: {response.status_code}")
-        time.sleep(0.5)
+    for path in paths:
+        for commit in list_commits(api_setting, max_workers, windows, since, until, path):
+            commits.setdefault(commit['sha'], commit)
+    return sorted(commits.values(), key=lambda commit: commit['commit']['committer']['date'], reverse=True)
+
+def list_commits(api_setting, max_workers=1, windows=1, since=None, until=None, path=None):
+    params = {key: value for key, value in (('since', since), ('until', until), ('path', path)) if value}
+    if windows <= 1:
+        return list_commit_pages(api_setting, params, max_workers)
+
+    until = until or format_date(datetime.now(timezone.utc))
+    since = since or get_oldest_commit_date(api_setting, params)
+    if since is None:
+        return []
+    time_windows = split_time_windows(since, until, windows)
+    print(f"Listing {len(time_windows)} time windows from {since} to {until}")
+    window_workers = max(1, max_workers // len(time_windows))
+    listed = map_concurrently(
+        lambda window: list_commit_pages(api_setting, dict(params, since=window[0], until=window[1]), window_workers),
+        time_windows, len(time_windows))
+
+    # 新しい区間から順に連結し，境界で重複したコミットを除く
+    commits = []
+    seen = set()
+    for _, window_commits in listed:
+        for commit in window_commits:
+            if commit['sha'] not in seen:
+                seen.add(commit['sha'])
+                commits.append(commit)
     return commits
 
-def main(api_setting, out_dir):
-    commits = get_commits(api_setting)
+def fetch_commit(api_setting, sha):
+    response = api_setting.get_data("commits/" + sha, with_json=False)
+    if response is None or response.status_code != 200:
+        print(f"Error[sha: {sha}]: {getattr(response, 'status_code', None)}")
+        return None
+    return response.json()
+
+
+def get_commit(api_setting, sha_list, max_workers=1, journal=None):
+    # 取得済みのコミットは飛ばし，完了したものから順に journal に追記する
+    # journal を渡した場合はメモリに残さず journal から読み出す
+    commits = {}
+    pending = [sha for sha in sha_list if journal is None or sha not in journal]
+    if journal is not None:
+        print(f"Skipping {len(sha_list) - len(pending)} commits already in the journal")
+    fetched = map_concurrently(lambda sha: fetch_commit(api_setting, sha), pending, max_workers, ordered=False)
+    for sha, commit in tqdm.tqdm(fetched, total=len(pending)):
+        if commit is None:
+            metrics.inc('github_commits_failed_total')
+            continue
+        metrics.inc('github_commits_fetched_total')
+        if journal is not None:
+            journal.append(commit)
+        else:
+            commits[sha] = commit
+    return {sha: commits[sha] for sha in pending if sha in commits}
+
+GRAPHQL_COMMIT_FIELDS = """
+fragment CommitFields on Commit {
+  oid
+  url
+  message
+  additions
+  deletions
+  author { name email date }
+  committer { name email date }
+  parents(first: 100) { nodes { oid } }
+}
+"""
+
+def build_graphql_query(sha_list):
+    objects = '\n'.join(f'    c{i}: object(oid: "{sha}") {{ ...CommitFields }}' for i, sha in enumerate(sha_list))
+    return ("query($owner: String!, $name: String!) {\n"
+            "  rateLimit { cost remaining resetAt }\n"
+            "  repository(owner: $owner, name: $name) {\n"
+            f"{objects}\n"
+            "  }\n"
+            "}\n" + GRAPHQL_COMMIT_FIELDS)
+
+def to_api_date(date):
+    # GitTimestamp はタイムゾーン付きなので REST と同じ UTC 形式に揃える
+    return format_date(datetime.fromisoformat(date.replace('Z', '+00:00')))
+
+def graphql_to_commit(api_setting, node):
+    actor = lambda person: {'name': person['name'], 'email': person['email'], 'date': to_api_date(person['date'])}
+    return {
+        'sha': node['oid'],
+        'commit': {
+            'author': actor(node['author']),
+            'committer': actor(node['committer']),
+            'message': node['message'],
+        },
+        'url': api_setting.base_url + 'commits/' + node['oid'],
+        'parents': [{'sha': parent['oid'], 'url': api_setting.base_url + 'commits/' + parent['oid']} for parent in node['parents']['nodes']],
+        'stats': {'total': node['additions'] + node['deletions'], 'additions': node['additions'], 'deletions': node['deletions']},
+        'files': [],
+    }
+
+def fetch_commits_graphql(api_setting, sha_list):
+    data = api_setting.post_graphql(build_graphql_query(sha_list), {'owner': api_setting.owner_name, 'name': api_setting.repo_name})
+    repository = (data or {}).get('repository') or {}
+    return {sha: repository.get(f"c{i}") for i, sha in enumerate(sha_list)}
+
+def get_commit_graphql(api_setting, sha_list, max_workers=1, batch_size=50, journal=None):
+    """Fetch the metadata and line counts of batch_size commits per GraphQL query, without files.
+
+    GraphQL has no per-file information, and REST returns the files only
+    together with the whole commit, so this only saves requests when the
+    files are not needed.
+    """
+    commits = {}
+    pending = [sha for sha in sha_list if journal is None or sha not in journal]
+    if journal is not None:
+        print(f"Skipping {len(sha_list) - len(pending)} commits already in the journal")
+    batches = [pending[start:start+batch_size] for start in range(0, len(pending), batch_size)]
+    missing = []
+    for _, nodes in tqdm.tqdm(map_concurrently(lambda batch: fetch_commits_graphql(api_setting, batch), batches, max_workers), total=len(batches)):
+        for sha, node in nodes.items():
+            if node is None:
+                # GraphQL で取れなかったものは REST で取り直す
+                missing.append(sha)
+            else:
+                commit = graphql_to_commit(api_setting, node)
+                if journal is not None:
+                    journal.append(commit)
+                else:
+                    commits[sha] = commit
+    print(f"GraphQL cost: {api_setting.graphql_cost} points, {len(missing)} commits fetched again through REST")
+    commits.update(get_commit(api_setting, missing, max_workers, journal))
+    return {sha: commits[sha] for sha in pending if sha in commits}
+
+def get_new_commits(api_setting, known_commits, max_workers=1, paths=None):
+    # 既知の最新コミット以降だけを列挙する．マージされたブランチの古い日付のコミットを拾うため少し遡る
+    newest = max(parse_date(commit['commit']['committer']['date']) for commit in known_commits)
+    since = format_date(newest - UPDATE_OVERLAP)
+    known_shas = {commit['sha'] for commit in known_commits}
+    listed = get_commits(api_setting, max_workers, since=since, paths=paths)
+    return [commit for commit in listed if commit['sha'] not in known_shas]
+
+GIT_LOG_FORMAT = '%x1e%H%x1f%P%x1f%an%x1f%ae%x1f%ad%x1f%cn%x1f%ce%x1f%cd%x1f%B%x1f'
+GIT_FILE_STATUS = {'A': 'added', 'D': 'removed', 'M': 'modified', 'R': 'renamed', 'C': 'copied', 'T': 'changed'}
+NULL_SHA = '0' * 40
+
+def run_git_log(git_dir, revisions):
+    # 日付は API と同じ UTC の "%Y-%m-%dT%H:%M:%SZ" で出力させる
+    command = ['git', '-C', git_dir, '-c', 'core.quotePath=false', 'log', '--no-abbrev', '--no-color', '--no-ext-diff',
+               '--diff-merges=first-parent', '-M', '--raw', '--numstat', '-p',
+               '--date=format-local:%Y-%m-%dT%H:%M:%SZ', '--format=' + GIT_LOG_FORMAT] + revisions
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=dict(os.environ, TZ='UTC'))
+    chunk = []
+    for line in process.stdout:
+        line = line.decode('utf-8', errors='replace')
+        if line.startswith('\x1e') and chunk:
+            yield ''.join(chunk)
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield ''.join(chunk)
+    if process.wait() != 0:
+        raise RuntimeError(f"git log failed in {git_dir} with exit code {process.returncode}")
+
+def parse_git_patch(section):
+    # API の patch は最初の @@ から始まり末尾の改行を含まない
+    for i, line in enumerate(section):
+        if line.startswith('@@'):
+            return '\n'.join(section[i:])
+    return None
+
+def parse_git_commit(chunk, owner_name, repo_name):
+    fields = chunk[1:].split('\x1f', 9)
+    sha, parents, author_name, author_email, author_date, committer_name, committer_email, committer_date, message, diff = fields
+    raw_entries, numstats, sections = [], [], []
+    for line in diff.split('\n'):
+        if line.startswith('diff --git '):
+            sections.append([])
+        elif sections:
+            sections[-1].append(line)
+        elif line.startswith(':'):
+            raw_entries.append(line)
+        elif line:
+            numstats.append(line)
+    # 空行で区切られた最後のセクション末尾の空行を取り除く
+    for section in sections:
+        while section and section[-1] == '':
+            section.pop()
+
+    files = []
+    for i, raw_entry in enumerate(raw_entries):
+        meta, *paths = raw_entry.split('\t')
+        _, _, old_sha, new_sha, status = meta.split(' ')
+        additions, deletions = numstats[i].split('\t')[:2] if i < len(numstats) else ('0', '0')
+        additions = int(additions) if additions != '-' else 0
+        deletions = int(deletions) if deletions != '-' else 0
+        filename = paths[-1]
+        file = {
+            'sha': new_sha if new_sha != NULL_SHA else old_sha,
+            'filename': filename,
+            'status': GIT_FILE_STATUS.get(status[0], 'modified'),
+            'additions': additions,
+            'deletions': deletions,
+            'changes': additions + deletions,
+            'blob_url': f"https://github.com/{owner_name}/{repo_name}/blob/{sha}/{filename}",
+        }
+        patch = parse_git_patch(sections[i]) if i < len(sections) else None
+        if patch is not None:
+            file['patch'] = patch
+        if len(paths) > 1:
+            file['previous_filename'] = paths[0]
+        files.append(file)
+
+    api_url = f"https://api.github.com/repos/{owner_name}/{repo_name}/commits/"
+    additions = sum(file['additions'] for file in files)
+    deletions = sum(file['deletions'] for file in files)
+    return {
+        'sha': sha,
+        'commit': {
+            'author': {'name': author_name, 'email': author_email, 'date': author_date},
+            'committer': {'name': committer_name, 'email': committer_email, 'date': committer_date},
+            'message': message.rstrip('\n'),
+        },
+        'url': api_url + sha,
+        'parents': [{'sha': parent, 'url': api_url + parent} for parent in parents.split()],
+        'stats': {'total': additions + deletions, 'additions': additions, 'deletions': deletions},
+        'files': files,
+    }
+
+def git_revisions(since=None, until=None, paths=None):
+    # HEAD から辿り，日付と path の範囲は git log に絞らせる
+    revisions = ['HEAD'] + [f"--{key}={value}" for key, value in (('since', since), ('until', until)) if value]
+    if paths:
+        revisions += ['--'] + list(paths)
+    return revisions
+
+def iter_git_commits(git_dir, owner_name, repo_name, revisions=('HEAD',)):
+    for chunk in run_git_log(git_dir, list(revisions)):
+        yield parse_git_commit(chunk, owner_name, repo_name)
+
+def main_from_git(git_dir, owner_name, repo_name, out_dir, since=None, until=None, file_format='json', compress='none', paths=None):
+    # API の代わりにローカルのクローンから commits.json と commit_details.json を作る
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-    write_as_json(commits, os.path.join(out_dir, 'commits.json'))
+    revisions = git_revisions(since, until, paths)
+    commits = []
+    def commit_details():
+        for commit in tqdm.tqdm(iter_git_commits(git_dir, owner_name, repo_name, revisions)):
+            commits.append({key: value for key, value in commit.items() if key not in ('stats', 'files')})
+            yield commit
+    write_records(output_path(out_dir, 'commit_details', file_format, compress), commit_details(), key=lambda commit: commit['sha'])
+    write_records(output_path(out_dir, 'commits', file_format, compress), commits)
+
+def main(api_setting, out_dir, max_workers=1, windows=1, since=None, until=None, update=False, restart=False, graphql=False, with_files=True, file_format='json', compress='none', paths=None):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    commits_path = output_path(out_dir, 'commits', file_format, compress)
+    details_path = output_path(out_dir, 'commit_details', file_format, compress)
+    journal_path = os.path.join(out_dir, 'fetch_journal.jsonl')
+    if restart and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = FetchJournal(journal_path)
+
+    if (update or len(journal) > 0) and os.path.exists(commits_path):
+        known_commits = list(iter_records(commits_path))
+        if len(journal) == 0 and os.path.exists(details_path):
+            # 以前の実行で journal が残っていない場合は commit_details から作り直す
+            journal.seed(iter_records(details_path))
+    else:
+        known_commits = []
+
+    with metrics.stage('list_commits'):
+        if update and known_commits:
+            new_commits = get_new_commits(api_setting, known_commits, max_workers, paths)
+            print(f"Found {len(new_commits)} new commits")
+            commits = new_commits + known_commits
+            write_records(commits_path, commits)
+        elif known_commits:
+            print(f"Resuming with {len(known_commits)} listed commits")
+            commits = known_commits
+        else:
+            commits = get_commits(api_setting, max_workers, windows, since, until, paths)
+            write_records(commits_path, commits)
+
     sha_list = [commit['sha'] for commit in commits]
-    commit_details = get_commit(api_setting, sha_list)
-    write_as_json(commit_details, os.path.join(out_dir, 'commit_details.json'))
+    with metrics.stage('fetch_details'):
+        if graphql and not with_files:
+            get_commit_graphql(api_setting, sha_list, max_workers, journal=journal)
+        else:
+            if graphql:
+                # ファイルは commits/{sha} でしか取れないので GraphQL を挟んでもリクエストは減らない
+                print("Files need one REST request per commit, so --graphql is used only with --commits_only")
+            get_commit(api_setting, sha_list, max_workers, journal)
+    journal.close()
+    with metrics.stage('write_details'):
+        write_records(details_path, journal.iter_details(sha_list), key=lambda commit: commit['sha'])
+    for usage in api_setting.usage():
+        print(f"Token {usage['token']}: {usage['requests']} requests, {usage['not_modified']} not modified, {usage['remaining']} remaining")
 
 
 
 if __name__ == '__main__':
     args = parse_arguments()
-    api_setting = ApiSetting(args.owner_name, args.repo_name)
-    main(api_setting, args.out_dir)
\ No newline at end of file
+    with metrics.reporting(args.metrics, args.metrics_interval):
+        if args.git_dir:
+            main_from_git(args.git_dir, args.owner_name, args.repo_name, args.out_dir, args.since, args.until, args.format, args.compress, args.path)
+        else:
+            api_setting = ApiSetting(args.owner_name, args.repo_name, pool_maxsize=args.concurrency, cache_dir=args.cache_dir, cache_max_bytes=args.cache_max_mb * 1024 ** 2)
+            main(api_setting, args.out_dir, args.concurrency, args.windows, args.since, args.until, args.update, args.restart, args.graphql, not args.commits_only, args.format, args.compress, args.path)
\ No newline at end of file
@@ -0,0 +1,216 @@
+import bisect
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# 秒単位の既定のバケット (API のレイテンシから段階の時間まで)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class StageProfiler:
+    """Profiles stages into directory/<stage>.prof (cProfile) or <stage>.folded (sampling).
+
+    The sampling mode records the stack of the thread running the stage
+    every interval seconds, in the folded format read by flamegraph.pl
+    and speedscope. Stages started inside a profiled stage are not
+    profiled separately.
+    """
+    def __init__(self, directory, mode='cprofile', interval=0.005):
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError(f"Unknown profile mode {mode}")
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.active = False
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def profile(self, stage):
+        if self.active:
+            yield
+            return
+        self.active = True
+        try:
+            if self.mode == 'cprofile':
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+                    profiler.dump_stats(os.path.join(self.directory, f"{stage}.prof"))
+            else:
+                stacks = Counter()
+                done = threading.Event()
+                sampler = threading.Thread(target=self.sample, args=(threading.get_ident(), stacks, done), daemon=True)
+                sampler.start()
+                try:
+                    yield
+                finally:
+                    done.set()
+                    sampler.join()
+                    with open(os.path.join(self.directory, f"{stage}.folded"), 'w', encoding='utf-8') as folded_file:
+                        for stack, count in stacks.most_common():
+                            folded_file.write(f"{stack} {count}\n")
+        finally:
+            self.active = False
+
+    def sample(self, thread_id, stacks, done):
+        while not done.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if names:
+                stacks[';'.join(reversed(names))] += 1
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms, keyed by name and labels.
+
+    snapshot() returns them as a dict, to_prometheus() in the Prometheus
+    text format, and write() saves either one depending on the file name.
+    stage() times a stage into stage_seconds and, once enable_profiling()
+    has been called, also profiles it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels): value
+        self.gauges = {} # (name, labels): value
+        self.histograms = {} # (name, labels): Histogram
+        self.profiler = None
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        with self.timer('stage_seconds', stage=name):
+            if self.profiler is None:
+                yield
+            else:
+                with self.profiler.profile(name):
+                    yield
+
+    def enable_profiling(self, directory, mode='cprofile', interval=0.005):
+        self.profiler = StageProfiler(directory, mode, interval)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'uptime_seconds': time.time() - self.started,
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.counters.items()],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self.gauges.items()],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                     'buckets': {('+Inf' if bound == float('inf') else str(bound)): count for bound, count in histogram.cumulative()}}
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            escaped = ((key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in tuple(labels) + tuple(extra))
+            pairs = [f'{key}="{value}"' for key, value in escaped]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+        lines = []
+        with self.lock:
+            # 同じ名前の系列はまとめて TYPE を1回だけ書く
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.extend(f"{name}{format_labels(labels)} {value}" for (series_name, labels), value in series.items() if series_name == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (series_name, labels), histogram in self.histograms.items():
+                    if series_name != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf' if bound == float('inf') else bound)])} {count}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filepath):
+        """Write a JSON snapshot if filepath ends with .json, otherwise the Prometheus text format."""
+        text = json.dumps(self.snapshot(), indent=4) if filepath.endswith('.json') else self.to_prometheus()
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 読み手が書きかけのファイルを見ないように置き換える
+        temporary = filepath + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(text)
+        os.replace(temporary, filepath)
+
+    @contextlib.contextmanager
+    def reporting(self, filepath, interval=10):
+        """Write the metrics to filepath every interval seconds while the block runs, and once at the end."""
+        if not filepath:
+            yield
+            return
+        done = threading.Event()
+        def report():
+            while not done.wait(interval):
+                self.write(filepath)
+        reporter = threading.Thread(target=report, daemon=True)
+        reporter.start()
+        try:
+            yield
+        finally:
+            done.set()
+            reporter.join()
+            self.write(filepath)
+
+
+metrics = Metrics()
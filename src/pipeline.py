@@ -0,0 +1,116 @@
+import os
+import queue
+import threading
+import argparse
+import tqdm
+from Classes import Nodes, Edges, Files, ApiSetting, FetchJournal, PatchStore, Scope
+from concurrency import map_concurrently
+from get_commit_data import get_commits, fetch_commit, git_revisions, iter_git_commits
+from construct_pg import add_commit_node, add_commit_edges, write_graph
+from metrics import metrics
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Fetch commit details and build the graph in one pass.')
+    current_directory = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('-o', '--owner_name', type=str, default='apache', help='The name of the owner')
+    parser.add_argument('-r', '--repo_name', type=str, default='spark', help='The name of the repository')
+    parser.add_argument('-d', '--out_dir', type=str, default=current_directory, help='The output directory')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='The number of concurrent API requests')
+    parser.add_argument('-q', '--queue_size', type=int, default=256, help='The maximum number of fetched commits waiting to be built')
+    parser.add_argument('-g', '--git_dir', type=str, default=None, help='Read commits from this local clone instead of the API')
+    parser.add_argument('--since', type=str, default=None, help='Only list commits after this date (YYYY-MM-DDTHH:MM:SSZ)')
+    parser.add_argument('--until', type=str, default=None, help='Only list commits before this date (YYYY-MM-DDTHH:MM:SSZ)')
+    parser.add_argument('--path', type=str, action='append', default=None, help='Only fetch commits touching this file or directory and keep only the files under it (can be given more than once)')
+    parser.add_argument('--extension', type=str, action='append', default=None, help='Only keep files with this extension, e.g. .py (can be given more than once)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Cache API responses in this directory')
+    parser.add_argument('--keep_details', action='store_true', help='Also keep the fetched commit details in out_dir/fetch_journal.jsonl')
+    parser.add_argument('-f', '--format', type=str, default='json', choices=['json', 'jsonl'], help='The output format')
+    parser.add_argument('-z', '--compress', type=str, default='none', choices=['none', 'gz', 'zst'], help='Compress the output files')
+    parser.add_argument('--id_map', type=str, default=None, help='Reuse and extend the node ids saved in this file')
+    parser.add_argument('--index', action='store_true', help='Also write the CSR adjacency index to out_dir/edge_index.bin')
+    parser.add_argument('--patch_store', type=str, default=None, help='Keep patches in a compressed store in this directory and put only patch_ref in the nodes')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='The number of worker processes used to link file versions and write the output')
+    parser.add_argument('--metrics', type=str, default=None, help='Write metrics to this file periodically (JSON if it ends with .json, otherwise Prometheus text)')
+    parser.add_argument('--metrics_interval', type=float, default=10, help='Seconds between metrics writes')
+    return parser.parse_args()
+
+
+def fetch_from_api(api_setting, max_workers=1, since=None, until=None, paths=None):
+    commits = get_commits(api_setting, max_workers, since=since, until=until, paths=paths)
+    sha_list = [commit['sha'] for commit in commits]
+    # 一覧の順に流してグラフの出力順を毎回同じにする
+    for _, commit in tqdm.tqdm(map_concurrently(lambda sha: fetch_commit(api_setting, sha), sha_list, max_workers), total=len(sha_list)):
+        if commit is not None:
+            yield commit
+
+def fetch_from_git(git_dir, owner_name, repo_name, since=None, until=None, paths=None):
+    yield from tqdm.tqdm(iter_git_commits(git_dir, owner_name, repo_name, git_revisions(since, until, paths)))
+
+def produce(commits, commit_queue, errors, journal=None):
+    try:
+        for commit in commits:
+            if journal is not None:
+                journal.append(commit)
+            commit_queue.put(commit)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        commit_queue.put(None)
+
+def main(commits, api_setting, out_dir, queue_size=256, keep_details=False, file_format='json', compress='none', id_map_path=None, index=False, max_workers=1, patch_dir=None, scope=None):
+    """Build the graph while commits are still being fetched.
+
+    Fetched commits are handed to the builder through a bounded queue, so a
+    slow builder throttles the fetch instead of buffering the history. Each
+    commit's node, edges and file nodes are added as it arrives, so nodes.json
+    interleaves commits and their files rather than listing all commits first.
+    With a scope, the commits and files outside it are dropped before they
+    are added, while the journal keeps the fetched details as they are.
+    """
+    scope = scope or Scope()
+    os.makedirs(out_dir, exist_ok=True)
+    journal = FetchJournal(os.path.join(out_dir, 'fetch_journal.jsonl')) if keep_details else None
+    commit_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    producer = threading.Thread(target=produce, args=(commits, commit_queue, errors, journal), daemon=True)
+    producer.start()
+
+    patch_store = PatchStore(patch_dir) if patch_dir else None
+    nodes = Nodes()
+    if id_map_path and os.path.exists(id_map_path):
+        nodes.load_id_map(id_map_path)
+    edges = Edges()
+    files = Files(api_setting)
+    with metrics.stage('build'):
+        for commit in iter(commit_queue.get, None):
+            # 0 に近ければ取得が，queue_size に近ければ構築が律速している
+            metrics.set('pipeline_queue_depth', commit_queue.qsize())
+            commit = scope.apply(commit)
+            if commit is None:
+                continue
+            add_commit_node(nodes, commit)
+            add_commit_edges(nodes, edges, files, commit, patch_store)
+            metrics.inc('graph_commits_total')
+    producer.join()
+    if patch_store is not None:
+        patch_store.close()
+    if journal is not None:
+        journal.close()
+    if errors:
+        raise errors[0]
+
+    write_graph(nodes, edges, files, out_dir, file_format, compress, index, max_workers)
+    if id_map_path:
+        nodes.save_id_map(id_map_path)
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.git_dir:
+        api_setting = None
+        commits = fetch_from_git(args.git_dir, args.owner_name, args.repo_name, args.since, args.until, args.path)
+    else:
+        api_setting = ApiSetting(args.owner_name, args.repo_name, pool_maxsize=args.concurrency, cache_dir=args.cache_dir)
+        commits = fetch_from_api(api_setting, args.concurrency, args.since, args.until, args.path)
+    with metrics.reporting(args.metrics, args.metrics_interval):
+        main(commits, api_setting, args.out_dir, args.queue_size, args.keep_details, args.format, args.compress, args.id_map, args.index, args.workers, args.patch_store, Scope(args.path, args.extension, args.since, args.until))
@@ -0,0 +1,238 @@
+import gzip
+import io
+import itertools
+import json
+import os
+from datetime import datetime
+from concurrency import map_concurrently
+
+JSON_LINES_EXTENSIONS = ('.jsonl', '.ndjson')
+COMPRESSIONS = {'none': '', 'gz': '.gz', 'zst': '.zst'}
+
+
+class RawJson(str):
+    """JSON text that was already dumped at the level it is written at, written as is."""
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def strip_compression(filepath):
+    for extension in ('.gz', '.zst'):
+        if filepath.endswith(extension):
+            return filepath[:-len(extension)]
+    return filepath
+
+def is_json_lines(filepath):
+    return strip_compression(filepath).endswith(JSON_LINES_EXTENSIONS)
+
+def output_path(out_dir, name, file_format='json', compress='none'):
+    # 例: output_path(out_dir, 'nodes', 'jsonl', 'gz') -> out_dir/nodes.jsonl.gz
+    return os.path.join(out_dir, f"{name}.{file_format}{COMPRESSIONS[compress]}")
+
+def open_records(filepath, mode='r'):
+    """Open a text file, transparently (de)compressing .gz and .zst files."""
+    if filepath.endswith('.gz'):
+        return gzip.open(filepath, mode + 't', encoding='utf-8')
+    if filepath.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("zstandard is required to read or write .zst files (pip install zstandard)")
+        if 'r' in mode:
+            stream = zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(open(filepath, 'wb'), closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(filepath, mode, encoding='utf-8')
+
+
+def dump_value(value, level):
+    # json.dump(..., indent=4) と同じ出力になるように入れ子の深さ分だけ字下げする
+    return json.dumps(value, indent=4, cls=DateTimeEncoder).replace('\n', '\n' + '    ' * level)
+
+def dump_batch(task):
+    # プロセスプールで実行するので引数はまとめて1つで受け取る
+    batch, level, keyed = task
+    if keyed:
+        return [json.dumps(key) + ': ' + (value if isinstance(value, RawJson) else dump_value(value, level)) for key, value in batch]
+    return [value if isinstance(value, RawJson) else dump_value(value, level) for value in batch]
+
+def iter_dumped(values, level, keyed=False, max_workers=1, batch_size=1000):
+    """Yield dump_value(value, level) for each value, in order, using max_workers processes."""
+    if max_workers <= 1:
+        yield from dump_batch((values, level, keyed))
+        return
+    values = iter(values)
+    tasks = iter(lambda: (list(itertools.islice(values, batch_size)), level, keyed), ([], level, keyed))
+    for _, dumped in map_concurrently(dump_batch, tasks, max_workers, processes=True):
+        yield from dumped
+
+def write_json_array(file, values, level=0, max_workers=1):
+    count = 0
+    for dumped in iter_dumped(values, level + 1, max_workers=max_workers):
+        file.write(('[\n' if count == 0 else ',\n') + '    ' * (level + 1) + dumped)
+        count += 1
+    file.write('[]' if count == 0 else '\n' + '    ' * level + ']')
+    return count
+
+def write_json_object(file, items, level=0, max_workers=1):
+    count = 0
+    for dumped in iter_dumped(items, level + 1, keyed=True, max_workers=max_workers):
+        file.write(('{\n' if count == 0 else ',\n') + '    ' * (level + 1) + dumped)
+        count += 1
+    file.write('{}' if count == 0 else '\n' + '    ' * level + '}')
+    return count
+
+def write_records(filepath, records, key=None, max_workers=1):
+    """Stream records to filepath and return how many were written.
+
+    JSON Lines files get one record per line. Legacy .json files get an
+    indented array, or an object keyed by key(record) when key is given;
+    with max_workers > 1 the indentation is done by worker processes.
+    """
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    print(f"Writing data to {filepath}")
+    with open_records(filepath, 'w') as file:
+        if is_json_lines(filepath):
+            count = 0
+            for record in records:
+                file.write(json.dumps(record, cls=DateTimeEncoder) + '\n')
+                count += 1
+            return count
+        if key is None:
+            return write_json_array(file, records, max_workers=max_workers)
+        return write_json_object(file, ((key(record), record) for record in records), max_workers=max_workers)
+
+def append_records(filepath, records, max_workers=1):
+    """Append records to a file written by write_records.
+
+    Uncompressed files and gzip JSON Lines files are extended in place.
+    Other files are rewritten with their previous records first.
+    """
+    if not os.path.exists(filepath):
+        write_records(filepath, records, max_workers=max_workers)
+        return
+    if is_json_lines(filepath) and not filepath.endswith('.zst'):
+        # gzip は新しいメンバーを後ろに足しても続けて読める
+        print(f"Appending data to {filepath}")
+        with open_records(filepath, 'a') as file:
+            for record in records:
+                file.write(json.dumps(record, cls=DateTimeEncoder) + '\n')
+        return
+    if strip_compression(filepath) == filepath:
+        with open(filepath, 'rb+') as file:
+            size = file.seek(0, os.SEEK_END)
+            file.seek(max(0, size - 2))
+            if file.read() == b'\n]':
+                # 閉じ括弧を外して write_json_array と同じ区切りで続きを書く
+                print(f"Appending data to {filepath}")
+                file.seek(size - 2)
+                file.truncate()
+                text = io.TextIOWrapper(file, encoding='utf-8')
+                for dumped in iter_dumped(records, 1, max_workers=max_workers):
+                    text.write(',\n    ' + dumped)
+                text.write('\n]')
+                text.flush()
+                text.detach()
+                return
+    directory, filename = os.path.split(filepath)
+    temporary = os.path.join(directory, '.appending-' + filename)
+    write_records(temporary, itertools.chain(iter_records(filepath), records), max_workers=max_workers)
+    os.replace(temporary, filepath)
+
+
+class JsonDocumentReader:
+    """Incrementally decodes the members of a top-level JSON array or object."""
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.start = 0 # 最後に decode した値の先頭
+        self.eof = False
+
+    def read_more(self):
+        # 大きな値の再デコードを繰り返さないよう読み込み量を倍々に増やす
+        chunk = self.file.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return not self.eof
+
+    def next_char(self, skip=' \t\r\n'):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return None
+
+    def decode(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # 数値はバッファの末尾で途切れている可能性があるので区切り文字まで確認する
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in ' \t\r\n,:]}'):
+                    self.start = self.pos
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+    def iter_keys(self):
+        """Yield the key of each member of the array (None) or object at the current position.
+
+        The caller reads each value, with decode or a nested iter_keys or
+        iter_items, before asking for the next key.
+        """
+        container = self.next_char()
+        if container not in ('[', '{'):
+            raise ValueError(f"Expected a JSON array or object, got {container!r}")
+        self.pos += 1
+        while True:
+            char = self.next_char(' \t\r\n,')
+            if char in (']', '}'):
+                self.pos += 1
+                return
+            if char is None:
+                raise ValueError("Unexpected end of JSON document")
+            if container == '[':
+                yield None
+                continue
+            key = self.decode()
+            if self.next_char() != ':':
+                raise ValueError(f"Expected ':' after key {key!r}")
+            self.pos += 1
+            self.next_char()
+            yield key
+
+    def iter_items(self, raw=False):
+        """Yield (key, value) for the members at the current position; with raw, the value's text as RawJson."""
+        for key in self.iter_keys():
+            value = self.decode()
+            yield key, (RawJson(self.buffer[self.start:self.pos]) if raw else value)
+
+    def __iter__(self):
+        for _, value in self.iter_items():
+            yield value
+
+def iter_records(filepath):
+    """Yield records from a JSON Lines file or the members of a legacy .json array/object."""
+    with open_records(filepath, 'r') as file:
+        if is_json_lines(filepath):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from JsonDocumentReader(file)
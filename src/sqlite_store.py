@@ -0,0 +1,279 @@
+import itertools
+import json
+import sqlite3
+from array import array
+from datetime import datetime, timedelta
+from Classes import IdAllocator, LabelTable, Nodes, Edges, Files, FileNode, EdgeIndex
+from metrics import metrics
+from records import DateTimeEncoder
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS nodes (seq INTEGER PRIMARY KEY, id INTEGER NOT NULL UNIQUE, label INTEGER NOT NULL, property TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS edges (seq INTEGER PRIMARY KEY, id INTEGER NOT NULL, src INTEGER NOT NULL, dst INTEGER NOT NULL, label INTEGER NOT NULL, property TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS edges_src_dst_label ON edges (src, dst, label);
+CREATE TABLE IF NOT EXISTS filenames (seq INTEGER PRIMARY KEY, filename TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS file_versions (
+    seq INTEGER PRIMARY KEY, filename TEXT NOT NULL, sha TEXT NOT NULL, date TEXT NOT NULL, timestamp INTEGER NOT NULL,
+    file_id INTEGER, status TEXT, previous_filename TEXT, data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_versions_filename ON file_versions (filename, seq);
+CREATE INDEX IF NOT EXISTS file_versions_sha ON file_versions (sha);
+'''
+
+
+def to_sql_id(id):
+    # SQLite の INTEGER は符号付き64ビットなので，上位ビットが立っている ID は負の値で保存する
+    return id - (1 << 64) if id >= 1 << 63 else id
+
+def from_sql_id(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class SqliteGraphStore:
+    """A SQLite database holding the nodes, edges, ids and file versions of one graph.
+
+    Writes are grouped into transactions of batch_size statements, and
+    reads that stream while the graph is still being written go through a
+    second connection that only sees committed rows.
+    """
+    def __init__(self, filepath, batch_size=10000):
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.pending = 0
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.executescript(SCHEMA)
+        self.reader = sqlite3.connect(filepath)
+
+    def execute(self, sql, parameters=()):
+        return self.connection.execute(sql, parameters)
+
+    def write(self, sql, parameters=()):
+        cursor = self.connection.execute(sql, parameters)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+        return cursor
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def stream(self, sql, parameters=()):
+        """Iterate over the committed rows of a query without blocking further writes."""
+        self.commit()
+        return self.reader.execute(sql, parameters)
+
+    def open_graph(self, api_setting):
+        return SqliteNodes(self), SqliteEdges(self), SqliteFiles(api_setting, self)
+
+    def close(self):
+        self.commit()
+        self.reader.close()
+        self.connection.close()
+
+
+class SqliteIdAllocator(IdAllocator):
+    """IdAllocator whose issued ids and key -> id map are kept in a SQLite table."""
+    def __init__(self, store, table, keep_keys=True):
+        self.store = store
+        self.table_name = table
+        self.keep_keys = keep_keys
+        store.execute(f"CREATE TABLE IF NOT EXISTS {table} (seq INTEGER PRIMARY KEY, id INTEGER NOT NULL UNIQUE, key TEXT UNIQUE)")
+        self.saved = self.last_seq()
+
+    def last_seq(self):
+        return self.store.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {self.table_name}").fetchone()[0]
+
+    def __len__(self):
+        return self.store.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+
+    def __contains__(self, id):
+        return self.store.execute(f"SELECT 1 FROM {self.table_name} WHERE id = ?", (to_sql_id(id),)).fetchone() is not None
+
+    def insert_id(self, id, key=None):
+        cursor = self.store.write(f"INSERT OR IGNORE INTO {self.table_name} (id, key) VALUES (?, ?)", (to_sql_id(id), key))
+        return cursor.rowcount == 1
+
+    def get(self, key):
+        row = self.store.execute(f"SELECT id FROM {self.table_name} WHERE key = ?", (key,)).fetchone()
+        return None if row is None else from_sql_id(row[0])
+
+    def assign(self, key, digest=None):
+        if self.keep_keys:
+            id = self.get(key)
+            if id is not None:
+                return id
+        for id in self.candidate_ids(key, digest or self.digest(key)):
+            if self.insert_id(id, key if self.keep_keys else None):
+                return id
+
+    def load(self, filepath):
+        print(f"Loading ids from {filepath}")
+        with open(filepath, 'r', encoding='utf-8') as id_file:
+            for line in id_file:
+                id, key = line.rstrip('\n').split('\t', 1)
+                self.insert_id(int(id), json.loads(key))
+        self.saved = self.last_seq()
+
+    def save(self, filepath):
+        # 前回の保存以降に割り当てたものだけを追記する
+        rows = self.store.execute(f"SELECT id, key FROM {self.table_name} WHERE seq > ? AND key IS NOT NULL ORDER BY seq", (self.saved,))
+        with open(filepath, 'a', encoding='utf-8') as id_file:
+            for id, key in rows:
+                id_file.write(f"{from_sql_id(id)}\t{json.dumps(key)}\n")
+        self.saved = self.last_seq()
+
+
+class SqliteLabelTable(LabelTable):
+    """LabelTable that also records its labels in a SQLite table."""
+    def __init__(self, store, table):
+        super().__init__()
+        self.store = store
+        self.table_name = table
+        store.execute(f"CREATE TABLE IF NOT EXISTS {table} (code INTEGER PRIMARY KEY, label TEXT NOT NULL)")
+        for code, label in store.execute(f"SELECT code, label FROM {table} ORDER BY code"):
+            super().encode(json.loads(label))
+
+    def encode(self, label):
+        code = self.codes.get(tuple(label))
+        if code is None:
+            code = super().encode(label)
+            self.store.write(f"INSERT INTO {self.table_name} (code, label) VALUES (?, ?)", (code, json.dumps(list(label))))
+        return code
+
+
+class SqliteNodes(Nodes):
+    def __init__(self, store):
+        self.store = store
+        self.id_allocator = SqliteIdAllocator(store, 'node_ids')
+        self.labels = SqliteLabelTable(store, 'node_labels')
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def add_record(self, key, data, id=None, digest=None):
+        if id is None:
+            id = self.id_allocator.get(key)
+        if id is not None and self.store.execute("SELECT 1 FROM nodes WHERE id = ?", (to_sql_id(id),)).fetchone() is not None:
+            metrics.inc('graph_duplicate_nodes_total')
+            return None
+        if id is None:
+            id = self.id_allocator.assign(key, digest)
+        node_data = data.copy()
+        label = node_data.pop('label')
+        self.store.write("INSERT INTO nodes (id, label, property) VALUES (?, ?, ?)", (to_sql_id(id), self.labels.encode(label), json.dumps(node_data, cls=DateTimeEncoder)))
+        return id
+
+    def iter_nodes(self):
+        for id, label, property in self.store.stream("SELECT id, label, property FROM nodes ORDER BY seq"):
+            yield {"id": from_sql_id(id), "label": self.labels.decode(label), "property": json.loads(property)}
+
+    def get_nodes(self):
+        return {self.get_sha(node['id']): node for node in self.iter_nodes()}
+
+    def get_id(self, sha):
+        return self.id_allocator.assign(sha)
+
+    def get_sha(self, id):
+        row = self.store.execute("SELECT key FROM node_ids WHERE id = ?", (to_sql_id(id),)).fetchone()
+        return None if row is None else row[0]
+
+
+class SqliteEdges(Edges):
+    def __init__(self, store):
+        self.store = store
+        self.id_allocator = SqliteIdAllocator(store, 'edge_ids', keep_keys=False)
+        self.labels = SqliteLabelTable(store, 'edge_labels')
+        self.index = None
+
+    def __len__(self):
+        return self.store.execute("SELECT COUNT(*) FROM edges").fetchone()[0]
+
+    def add_edge(self, edge, digest=None):
+        label_code = self.labels.encode(edge['label'])
+        src, dst = to_sql_id(edge['src']), to_sql_id(edge['dst'])
+        if self.store.execute("SELECT 1 FROM edges WHERE src = ? AND dst = ? AND label = ?", (src, dst, label_code)).fetchone() is not None:
+            return
+        key = str(edge['src'])+str(edge['dst'])+''.join(edge['label'])
+        id = self.id_allocator.assign(key, digest)
+        edge['id'] = id
+        property = edge.get('property', {})
+        self.store.write(
+            "INSERT INTO edges (id, src, dst, label, property) VALUES (?, ?, ?, ?, ?)",
+            (to_sql_id(id), src, dst, label_code, json.dumps(property, cls=DateTimeEncoder) if property else None)
+        )
+        self.index = None
+
+    def iter_edges(self):
+        for src, dst, label, property, id in self.store.stream("SELECT src, dst, label, property, id FROM edges ORDER BY seq"):
+            yield {
+                'src': from_sql_id(src),
+                'dst': from_sql_id(dst),
+                'label': self.labels.decode(label),
+                'property': json.loads(property) if property else {},
+                'id': from_sql_id(id),
+            }
+
+    def build_index(self):
+        src, dst, label_codes = array('Q'), array('Q'), array('I')
+        for source, target, label in self.store.stream("SELECT src, dst, label FROM edges ORDER BY seq"):
+            src.append(from_sql_id(source))
+            dst.append(from_sql_id(target))
+            label_codes.append(label)
+        return EdgeIndex.from_columns(src, dst, label_codes, self.labels.labels)
+
+
+class SqliteFiles(Files):
+    """Files whose versions, including their patches, are kept in SQLite instead of FileNodes."""
+    def __init__(self, api_setting, store):
+        super().__init__(api_setting)
+        self.store = store
+        self.last_date = (None, None)
+
+    def add_file(self, sha, file, date):
+        # 同じコミットのファイルは日付が同じなので直前の結果だけを使い回す
+        if self.last_date[0] != date:
+            date_obj = datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
+            self.last_date = (date, (date_obj.isoformat(), (date_obj - self.epoch) // timedelta(seconds=1)))
+        date_iso, timestamp = self.last_date[1]
+        data = file.get_data()
+        self.store.write("INSERT OR IGNORE INTO filenames (filename) VALUES (?)", (file.get_name(),))
+        self.store.write(
+            "INSERT INTO file_versions (filename, sha, date, timestamp, file_id, status, previous_filename, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (file.get_name(), sha, date_iso, timestamp, to_sql_id(data['id']), data['status'], data.get('previous_filename'), json.dumps(data, cls=DateTimeEncoder))
+        )
+
+    def get_file(self, filename, sha):
+        row = self.store.execute("SELECT data FROM file_versions WHERE filename = ? AND sha = ? ORDER BY seq DESC LIMIT 1", (filename, sha)).fetchone()
+        return None if row is None else FileNode(json.loads(row[0]), sha, need_extract=False)
+
+    def to_versions(self, rows):
+        # 同じ sha が2回追加されていれば Files.files と同じく後のものを使う
+        latest = {row[0]: row for row in rows}
+        return [(timestamp, from_sql_id(latest[sha][2]), latest[sha][3], sha, latest[sha][4]) for sha, timestamp, _, _, _ in rows]
+
+    def get_versions(self, filename):
+        rows = self.store.execute("SELECT sha, timestamp, file_id, status, previous_filename FROM file_versions WHERE filename = ? ORDER BY seq", (filename,)).fetchall()
+        return self.to_versions(rows) if rows else None
+
+    def iter_grouped(self, columns):
+        rows = self.store.stream(f"SELECT v.filename, {columns} FROM filenames f JOIN file_versions v ON v.filename = f.filename ORDER BY f.seq, v.seq")
+        for filename, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield filename, [row[1:] for row in group]
+
+    def iter_versions(self):
+        for filename, rows in self.iter_grouped("v.sha, v.timestamp, v.file_id, v.status, v.previous_filename"):
+            yield filename, self.to_versions(rows)
+
+    def version_date(self, timestamp):
+        return self.epoch + timedelta(seconds=timestamp)
+
+    def iter_file_records(self):
+        for filename, rows in self.iter_grouped("v.sha, v.data"):
+            yield filename, {sha: json.loads(data) for sha, data in rows}
+
+    def iter_file_commits(self):
+        for filename, rows in self.iter_grouped("v.sha, v.date"):
+            yield filename, rows
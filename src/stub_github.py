@@ -0,0 +1,189 @@
+import json
+import re
+import hashlib
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote
+
+MAX_PER_PAGE = 100
+
+
+class StubGitHubHandler(BaseHTTPRequestHandler):
+    # keep-alive で requests のコネクションプールを使い回せるようにする
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        match = re.fullmatch(r'/repos/[^/]+/[^/]+/commits(?:/([0-9a-f]{40}))?', url.path)
+        if match is None:
+            self.send_body(404, b'{"message": "Not Found"}', {})
+            return
+        if stub.latency:
+            time.sleep(stub.latency)
+        if match.group(1):
+            body = stub.detail_body(match.group(1))
+            headers = {}
+        else:
+            body, headers = stub.list_body(url.path, parse_qs(url.query))
+        if body is None:
+            self.send_body(404, b'{"message": "Not Found"}', stub.rate_limit_headers(count=True))
+            return
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            # GitHub と同じく 304 はレートリミットに数えない
+            self.send_body(304, b'', dict(stub.rate_limit_headers(count=False), ETag=etag))
+            return
+        rate_limit_headers = stub.rate_limit_headers(count=True)
+        if rate_limit_headers['X-RateLimit-Remaining'] == '0':
+            self.send_body(403, b'{"message": "API rate limit exceeded"}', rate_limit_headers)
+            return
+        self.send_body(200, body, dict(rate_limit_headers, ETag=etag, **headers))
+
+    def do_POST(self):
+        stub = self.server.stub
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/graphql':
+            self.send_body(404, b'{"message": "Not Found"}', {})
+            return
+        if stub.latency:
+            time.sleep(stub.latency)
+        rate_limit_headers = stub.rate_limit_headers(count=True)
+        if rate_limit_headers['X-RateLimit-Remaining'] == '0':
+            self.send_body(403, b'{"message": "API rate limit exceeded"}', rate_limit_headers)
+            return
+        self.send_body(200, stub.graphql_body(json.loads(payload)['query']), rate_limit_headers)
+
+    def send_body(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+
+class StubGitHub:
+    """A local server answering the REST endpoints ApiSetting uses, from a list of commit details.
+
+    It serves the paginated commits listing (per_page, page, since, until,
+    path and a Link header) and commits/{sha}, with ETags and X-RateLimit-*
+    headers, and the commit objects of the GraphQL query get_commit_data
+    sends to /graphql. latency adds a delay to every request to stand in for the
+    network. Use it as a context manager, or call start() and stop().
+    """
+    def __init__(self, commit_details, rate_limit=10 ** 9, reset_seconds=3600, latency=0.0):
+        self.details = {} # sha: commit details (新しい順)
+        self.listing = [] # 一覧に載せる項目 (files を除いたもの)
+        for commit in commit_details:
+            self.details[commit['sha']] = commit
+            self.listing.append({key: value for key, value in commit.items() if key not in ('files', 'stats')})
+        self.bodies = {} # sha: commits/{sha} のレスポンス
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.reset_seconds = reset_seconds
+        self.reset_time = int(time.time()) + reset_seconds
+        self.latency = latency
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def rate_limit_headers(self, count=True):
+        with self.lock:
+            self.request_count += 1
+            now = time.time()
+            if now >= self.reset_time:
+                self.remaining = self.rate_limit
+                self.reset_time = int(now) + self.reset_seconds
+            if count and self.remaining > 0:
+                self.remaining -= 1
+            return {
+                'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(self.remaining),
+                'X-RateLimit-Reset': str(self.reset_time),
+            }
+
+    def detail_body(self, sha):
+        body = self.bodies.get(sha)
+        if body is None and sha in self.details:
+            body = self.bodies[sha] = json.dumps(self.details[sha]).encode('utf-8')
+        return body
+
+    def list_body(self, path, query):
+        commits = self.listing
+        since, until = query.get('since', [None])[0], query.get('until', [None])[0]
+        if since or until:
+            # 日付はどちらも "%Y-%m-%dT%H:%M:%SZ" なので文字列のまま比べる
+            commits = [commit for commit in commits if (not since or commit['commit']['committer']['date'] >= since) and (not until or commit['commit']['committer']['date'] <= until)]
+        path_filter = query.get('path', [''])[0].strip('/')
+        if path_filter:
+            # git log -- path と同じく，path から移動したファイルも path に触れたものとする
+            touches = lambda filename: filename == path_filter or filename.startswith(path_filter + '/')
+            commits = [commit for commit in commits if any(touches(file['filename']) or touches(file.get('previous_filename') or '') for file in self.details[commit['sha']]['files'])]
+        per_page = min(int(query.get('per_page', ['30'])[0]), MAX_PER_PAGE)
+        page = int(query.get('page', ['1'])[0])
+        last_page = max(1, -(-len(commits) // per_page))
+        headers = {}
+        if last_page > 1:
+            params = ''.join(f"&{key}={quote(values[0], safe='/')}" for key, values in query.items() if key not in ('page', 'per_page'))
+            links = []
+            if page < last_page:
+                links.append(f'<{self.url(path)}?per_page={per_page}&page={page + 1}{params}>; rel="next"')
+                links.append(f'<{self.url(path)}?per_page={per_page}&page={last_page}{params}>; rel="last"')
+            if page > 1:
+                links.append(f'<{self.url(path)}?per_page={per_page}&page=1{params}>; rel="first"')
+            headers['Link'] = ', '.join(links)
+        return json.dumps(commits[(page - 1) * per_page:page * per_page]).encode('utf-8'), headers
+
+    def graphql_node(self, sha):
+        commit = self.details.get(sha)
+        if commit is None:
+            return None
+        return {
+            'oid': sha,
+            'url': commit['url'],
+            'message': commit['commit']['message'],
+            'additions': commit['stats']['additions'],
+            'deletions': commit['stats']['deletions'],
+            'author': commit['commit']['author'],
+            'committer': commit['commit']['committer'],
+            'parents': {'nodes': [{'oid': parent['sha']} for parent in commit['parents']]},
+        }
+
+    def graphql_body(self, query):
+        # c0: object(oid: "...") の形の別名だけを見て，見つからないコミットは GitHub と同じく null にする
+        repository = {f"c{alias}": self.graphql_node(sha) for alias, sha in re.findall(r'c(\d+): object\(oid: "([0-9a-f]{40})"\)', query)}
+        with self.lock:
+            rate_limit = {'cost': 1, 'remaining': self.remaining, 'resetAt': datetime.fromtimestamp(self.reset_time, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+        return json.dumps({'data': {'rateLimit': rate_limit, 'repository': repository}}).encode('utf-8')
+
+    def url(self, path=''):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def start(self):
+        """Start serving on a free local port and return the API root for ApiSetting."""
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubGitHubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,85 @@
+import bisect
+import hashlib
+import itertools
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+EXTENSIONS = ['.py', '.scala', '.java', '.md', '.sql', '.R', '']
+
+
+def fake_sha(*parts):
+    return hashlib.sha1(':'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+def make_patch(rng, lines):
+    removed = [f"-    old line {rng.randrange(10 ** 6)}" for _ in range(lines // 2)]
+    added = [f"+    new line {rng.randrange(10 ** 6)}" for _ in range(lines - lines // 2)]
+    return '\n'.join([f"@@ -1,{len(removed)} +1,{len(added)} @@"] + removed + added)
+
+def pick_files(rng, file_count, count, cumulative_weights):
+    # 重み付きで重複なく選ぶ (skew が 0 なら一様)
+    if cumulative_weights is None:
+        return rng.sample(range(file_count), count)
+    slots = {}
+    while len(slots) < count:
+        slots.setdefault(bisect.bisect(cumulative_weights, rng.random() * cumulative_weights[-1]), None)
+    return list(slots)
+
+def generate_commit_details(commits=1000, files_per_commit=3, file_count=None, merge_rate=0.1, rename_rate=0.02,
+                            patch_lines=20, owner_name='owner', repo_name='repo', seed=0, skew=0.0):
+    """Yield synthetic commit details shaped like GitHub's commits/{sha} responses, newest first.
+
+    The history is generated oldest first so renames and parents are
+    consistent, which means the whole list is built before yielding.
+    With skew > 0 the k-th file is changed with weight 1 / k ** skew, so a
+    few hot files collect long version chains as in real repositories.
+    """
+    rng = random.Random(seed)
+    file_count = file_count or max(10, commits * files_per_commit // 10)
+    directories = [f"module{i}/src/main" for i in range(max(1, file_count // 50))]
+    filenames = [f"{rng.choice(directories)}/File{i}{rng.choice(EXTENSIONS)}" for i in range(file_count)]
+    base_url = f"https://api.github.com/repos/{owner_name}/{repo_name}/commits/"
+    start = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    cumulative_weights = list(itertools.accumulate(1 / (slot + 1) ** skew for slot in range(file_count))) if skew > 0 else None
+
+    history = []
+    for index in range(commits):
+        sha = fake_sha(seed, index)
+        date = (start + timedelta(minutes=37 * index)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        parents = [history[-1]['sha']] if history else []
+        if len(history) > 2 and rng.random() < merge_rate:
+            parents.append(history[rng.randrange(len(history) - 1)]['sha'])
+        files = []
+        for slot in pick_files(rng, file_count, min(file_count, files_per_commit), cumulative_weights):
+            filename = filenames[slot]
+            additions, deletions = rng.randrange(patch_lines + 1), rng.randrange(patch_lines + 1)
+            file = {
+                'sha': fake_sha(sha, filename),
+                'filename': filename,
+                'status': 'modified' if index else 'added',
+                'additions': additions,
+                'deletions': deletions,
+                'changes': additions + deletions,
+                'blob_url': f"https://github.com/{owner_name}/{repo_name}/blob/{sha}/{filename}",
+                'patch': make_patch(rng, patch_lines),
+            }
+            if rng.random() < rename_rate:
+                new_name = f"{rng.choice(directories)}/Renamed{slot}_{index}{os.path.splitext(filename)[1]}"
+                file.update({'status': 'renamed', 'previous_filename': filename, 'filename': new_name})
+                file['blob_url'] = f"https://github.com/{owner_name}/{repo_name}/blob/{sha}/{new_name}"
+                filenames[slot] = new_name
+            files.append(file)
+        person = {'name': f"dev{index % 17}", 'email': f"dev{index % 17}@example.com", 'date': date}
+        history.append({
+            'sha': sha,
+            'commit': {'author': person, 'committer': dict(person), 'message': f"Change {index}"},
+            'url': base_url + sha,
+            'parents': [{'sha': parent, 'url': base_url + parent} for parent in parents],
+            'stats': {
+                'total': sum(file['changes'] for file in files),
+                'additions': sum(file['additions'] for file in files),
+                'deletions': sum(file['deletions'] for file in files),
+            },
+            'files': files,
+        })
+    yield from reversed(history)
@@ -0,0 +1,51 @@
+import json
+import time
+import pytest
+import batch
+
+
+def test_read_manifest_from_plain_lines(tmp_path):
+    manifest = tmp_path / 'repos.txt'
+    manifest.write_text('# 取得するリポジトリ\napache/spark\n\nowner/repo  # コメント\napache/spark\n', encoding='utf-8')
+    repositories = batch.read_manifest(str(manifest))
+    assert [repository['name'] for repository in repositories] == ['apache/spark', 'owner/repo']
+    assert repositories[1] == {'name': 'owner/repo', 'owner': 'owner', 'repo': 'repo', 'priority': 0, 'size': None, 'since': None, 'until': None, 'paths': None, 'extensions': None, 'git_dir': None}
+
+
+@pytest.mark.parametrize('filename', ['repos.json', 'repos.jsonl'])
+def test_read_manifest_from_json(tmp_path, filename):
+    entries = [
+        {'owner': 'a', 'repo': 'one', 'priority': 2, 'size': 10, 'paths': ['src'], 'extensions': ['py']},
+        {'owner': 'b', 'repo': 'two', 'since': '2020-01-01T00:00:00Z', 'git_dir': '/tmp/two'},
+        {'owner': 'a', 'repo': 'one', 'priority': 1},
+    ]
+    manifest = tmp_path / filename
+    manifest.write_text(json.dumps(entries) if filename.endswith('.json') else ''.join(json.dumps(entry) + '\n' for entry in entries), encoding='utf-8')
+    repositories = {repository['name']: repository for repository in batch.read_manifest(str(manifest))}
+    assert list(repositories) == ['a/one', 'b/two']
+    # 重複したものは後の記述を使う
+    assert (repositories['a/one']['priority'], repositories['a/one']['paths']) == (1, None)
+    assert (repositories['b/two']['since'], repositories['b/two']['git_dir']) == ('2020-01-01T00:00:00Z', '/tmp/two')
+
+
+def test_read_manifest_rejects_an_entry_without_a_repo(tmp_path):
+    manifest = tmp_path / 'repos.jsonl'
+    manifest.write_text(json.dumps({'owner': 'a'}) + '\n', encoding='utf-8')
+    with pytest.raises(ValueError):
+        batch.read_manifest(str(manifest))
+
+
+def test_priority_key_orders_by_priority_then_staleness_then_size():
+    now = time.time()
+    def repository(name, priority=0, size=None):
+        return {'name': name, 'priority': priority, 'size': size}
+    repositories = [
+        (repository('built_today'), {'built': now, 'commits': 5}),
+        (repository('urgent', priority=-1, size=10 ** 6), {'built': now}),
+        (repository('never_built_large', size=500), {}),
+        (repository('never_built_small', size=50), {}),
+        (repository('built_long_ago'), {'built': now - 30 * 86400, 'commits': 10 ** 5}),
+        (repository('low', priority=5), {}),
+    ]
+    ordered = sorted(repositories, key=lambda pair: batch.priority_key(*pair))
+    assert [repository['name'] for repository, _ in ordered] == ['urgent', 'never_built_small', 'never_built_large', 'built_long_ago', 'built_today', 'low']
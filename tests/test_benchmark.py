@@ -0,0 +1,30 @@
+import json
+import benchmark
+from synthetic import generate_commit_details
+
+
+def test_synthetic_history_is_reproducible():
+    assert list(generate_commit_details(commits=30, seed=3)) == list(generate_commit_details(commits=30, seed=3))
+    assert list(generate_commit_details(commits=30, seed=3)) != list(generate_commit_details(commits=30, seed=4))
+
+
+def test_runs_are_recorded_and_compared_with_the_same_configuration(tmp_path, capsys):
+    history_path = str(tmp_path / 'history.jsonl')
+    history = {'commits': 20, 'seed': 1}
+    assert benchmark.main(history, ['construct', 'structures'], history_path=history_path, threshold=100) == []
+    benchmark.main(history, ['construct'], history_path=history_path, threshold=100)
+    assert 'Compared with' in capsys.readouterr().out
+    benchmark.main(dict(history, commits=21), ['construct'], history_path=history_path, threshold=100)
+    assert 'Compared with' not in capsys.readouterr().out
+    with open(history_path, 'r', encoding='utf-8') as history_file:
+        entries = [json.loads(line) for line in history_file]
+    assert [sorted(entry['results']) for entry in entries] == [['construct', 'structures'], ['construct'], ['construct']]
+    assert entries[0]['config_id'] == entries[1]['config_id'] != entries[2]['config_id']
+    assert entries[0]['results']['structures']['nodes'] > 20
+
+
+def test_compare_reports_metrics_that_grew_past_the_threshold():
+    previous = {'results': {'construct': {'seconds': 1.0, 'peak_rss_mb': 100.0, 'stages': {}}}}
+    results = {'construct': {'seconds': 1.05, 'peak_rss_mb': 130.0, 'stages': {}}}
+    assert benchmark.compare(results, previous, 0.1) == [('construct', 'peak_rss_mb', 100.0, 130.0)]
+    assert benchmark.compare(results, None, 0.1) == []
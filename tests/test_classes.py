@@ -0,0 +1,137 @@
+import time
+import pytest
+from Classes import Edges, FileNode, Files, Nodes, PatchStore, TokenBudget, TokenPool
+
+
+def test_neighbor_queries_rebuild_the_index_only_after_new_edges():
+    edges = Edges()
+    edges.add_edge({'src': 1, 'dst': 2, 'label': ['parent']})
+    assert list(edges.get_dsts(1)) == [2]
+    index = edges.index
+    assert list(edges.get_srcs(2)) == [1]
+    assert edges.index is index
+    edges.add_edge({'src': 1, 'dst': 3, 'label': ['parent']})
+    assert sorted(edges.get_dsts(1)) == [2, 3]
+    assert edges.index is not index
+    # 既にある辺を足しても索引は作り直さない
+    index = edges.index
+    edges.add_edge({'src': 1, 'dst': 3, 'label': ['parent']})
+    assert list(edges.get_srcs(3)) == [1]
+    assert edges.index is index
+
+
+def test_get_sha_follows_ids_assigned_before_and_after_the_first_lookup(tmp_path):
+    nodes = Nodes()
+    first = nodes.get_id('a' * 40)
+    assert nodes.get_sha(first) == 'a' * 40
+    second = nodes.get_id('b' * 40)
+    assert nodes.get_sha(second) == 'b' * 40
+    id_map = str(tmp_path / 'id_map.tsv')
+    with open(id_map, 'w', encoding='utf-8') as id_file:
+        id_file.write('12345\t"' + 'c' * 40 + '"\n')
+    nodes.load_id_map(id_map)
+    assert nodes.get_sha(12345) == 'c' * 40
+    assert nodes.get_sha(1) is None
+
+
+def test_patch_index_lines_are_written_after_their_pack_data(tmp_path):
+    store = PatchStore(str(tmp_path), index_batch=2)
+    refs = [store.put(f"@@ -1 +1 @@\n-{i}\n+{i + 1}") for i in range(3)]
+    # 2 件目で pack を fsync してから索引に書き，3 件目はまだ書かない
+    assert len((tmp_path / 'patches.idx').read_text().splitlines()) == 2
+    store.close()
+    reopened = PatchStore(str(tmp_path))
+    assert [reopened.get(ref) for ref in refs] == [f"@@ -1 +1 @@\n-{i}\n+{i + 1}" for i in range(3)]
+    reopened.close()
+
+
+def test_patch_index_entries_past_the_end_of_the_pack_are_dropped(tmp_path):
+    store = PatchStore(str(tmp_path))
+    first, second = store.put('first'), store.put('second')
+    store.close()
+    pack = tmp_path / 'pack-00000.pack'
+    pack.write_bytes(pack.read_bytes()[:-1])
+    reopened = PatchStore(str(tmp_path))
+    assert first in reopened and second not in reopened
+    assert reopened.get(first) == 'first'
+    reopened.close()
+
+
+def token_pool(*remaining, limit=100, reset_in=3600):
+    pool = TokenPool([f"token{i}" for i in range(len(remaining))])
+    for budget, count in zip(pool.budgets, remaining):
+        pool.update(budget, {'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(count), 'X-RateLimit-Reset': str(int(time.time() + reset_in))})
+    return pool
+
+def test_token_pool_spreads_requests_over_the_tokens_with_the_most_quota(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: pytest.fail("should not sleep"))
+    pool = token_pool(60, 90, 70)
+    chosen = [pool.acquire().token for _ in range(50)]
+    # 残量が揃うまで多いものから使い，その後は交互に使う
+    assert chosen[:20] == ['token1'] * 20
+    assert chosen[20:40].count('token1') == chosen[20:40].count('token2') == 10
+    remaining = [usage['remaining'] for usage in pool.usage()]
+    assert sum(remaining) == 220 - 50 and max(remaining) - min(remaining) <= 1
+
+def test_token_pool_prefers_a_token_with_unknown_quota():
+    pool = token_pool(90)
+    pool.budgets.append(TokenBudget('fresh'))
+    assert pool.acquire().token == 'fresh'
+
+def test_token_pool_paces_a_token_below_its_reserve(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    # 残り 10 回を 10 秒で使うので 1 秒ずつ空ける
+    pool = token_pool(10, limit=100, reset_in=10)
+    for _ in range(4):
+        pool.acquire()
+    assert len(sleeps) == 3
+    assert [round(seconds) for seconds in sleeps] == [1, 2, 3]
+
+def test_token_pool_waits_for_the_earliest_reset_when_every_token_is_exhausted(monkeypatch):
+    pool = token_pool(0, 0, reset_in=30)
+    pool.budgets[1].reset -= 20
+    sleeps = []
+    def sleep(seconds):
+        sleeps.append(seconds)
+        # 眠っている間にリセットされたことにする
+        pool.budgets[1].reset = time.time() - 1
+    monkeypatch.setattr(time, 'sleep', sleep)
+    assert pool.acquire().token == 'token1'
+    assert len(sleeps) == 1 and 9 < sleeps[0] <= 11
+
+
+def build_files(history):
+    files = Files(None)
+    for id, (sha, date, filename, status, previous_filename) in enumerate(history, 1):
+        file = {'sha': f"blob{id}", 'filename': filename, 'status': status, 'blob_url': f"https://example.com/{id}"}
+        if previous_filename:
+            file['previous_filename'] = previous_filename
+        node = FileNode(file, sha)
+        node.assign_id(id)
+        files.add_file(sha, node, date)
+    return files
+
+RENAME_HISTORY = [
+    # 新しい順
+    ('c5', '2020-01-05T00:00:00Z', 'a.txt', 'added', None),
+    ('c4', '2020-01-04T00:00:00Z', 'b.txt', 'modified', None),
+    ('c3', '2020-01-03T00:00:00Z', 'b.txt', 'renamed', 'a.txt'),
+    ('c2', '2020-01-02T00:00:00Z', 'a.txt', 'modified', None),
+    ('c1', '2020-01-01T00:00:00Z', 'a.txt', 'added', None),
+]
+
+def version_links(edges):
+    return sorted((edge['src'], edge['dst'], edge['label'][1]) for edge in edges.iter_edges())
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_connect_files_links_a_rename_to_the_latest_older_version_of_its_previous_name(max_workers):
+    files = build_files(RENAME_HISTORY)
+    edges = files.connect_files(Edges(), max_workers, shard_size=1)
+    # id は RENAME_HISTORY の順 (c5 が 1, c1 が 5)
+    assert version_links(edges) == [
+        (3, 2, 'modified'),  # c3 の b.txt -> c4 の b.txt
+        (4, 1, 'added'),     # 消えた a.txt をあとで作り直した版
+        (4, 3, 'renamed'),   # c2 の a.txt -> c3 で a.txt から b.txt に
+        (5, 4, 'modified'),
+    ]
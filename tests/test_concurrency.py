@@ -0,0 +1,44 @@
+import threading
+import time
+import get_commit_data
+from Classes import ApiSetting, TokenPool
+from concurrency import map_concurrently
+from stub_github import StubGitHub
+from synthetic import generate_commit_details
+
+
+def test_map_concurrently_bounds_the_queued_calls_and_keeps_the_order():
+    lock = threading.Lock()
+    consumed = []
+    started = []
+    def func(item):
+        with lock:
+            started.append(item)
+        time.sleep(0.001 * (item % 3))
+        return item * 2
+    results = []
+    for item, result in map_concurrently(func, range(40), max_workers=4):
+        results.append((item, result))
+        consumed.append(item)
+        with lock:
+            # 取り出していない呼び出しは max_workers * 2 を超えない
+            assert len(started) - len(consumed) <= 8
+    assert results == [(item, item * 2) for item in range(40)]
+
+def test_map_concurrently_unordered_yields_every_item_once():
+    results = dict(map_concurrently(lambda item: time.sleep(0.001 * (5 - item % 5)) or item, range(30), max_workers=6, ordered=False))
+    assert results == {item: item for item in range(30)}
+
+def test_concurrent_fetch_overlaps_slow_requests():
+    commits = list(generate_commit_details(commits=40))
+    shas = [commit['sha'] for commit in commits]
+    with StubGitHub(commits, latency=0.05) as stub:
+        api_setting = ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']), pool_maxsize=8)
+        started = time.perf_counter()
+        fetched = get_commit_data.get_commit(api_setting, shas, max_workers=8)
+        seconds = time.perf_counter() - started
+        assert stub.request_count == 40
+    assert list(fetched) == shas
+    assert fetched[shas[0]] == commits[0]
+    # 直列なら 40 * 0.05 = 2 秒かかる
+    assert seconds < 1.0
@@ -0,0 +1,91 @@
+import os
+import json
+import pytest
+import Classes
+import construct_pg
+from records import iter_records, write_records
+from synthetic import generate_commit_details
+
+
+def build(tmp_path, out_dir, **options):
+    json_path = tmp_path / 'commit_details.json'
+    if not json_path.exists():
+        write_records(str(json_path), generate_commit_details(commits=50))
+    construct_pg.main(None, str(json_path), str(out_dir), **options)
+    return list(iter_records(str(out_dir / 'nodes.json'))), list(iter_records(str(out_dir / 'edges.json')))
+
+
+def test_sqlite_store_builds_twice_into_one_directory(tmp_path):
+    first = build(tmp_path, tmp_path / 'out', store='sqlite')
+    second = build(tmp_path, tmp_path / 'out', store='sqlite')
+    assert second == first
+    assert first == build(tmp_path, tmp_path / 'memory')
+
+
+def read_outputs(out_dir):
+    return {name: (out_dir / name).read_bytes() for name in ('nodes.json', 'edges.json', 'files.json')}
+
+def test_workers_write_the_same_bytes_as_a_serial_build(tmp_path):
+    # コミットの束 (500)，ファイルの束 (1000) と書き出しの束 (1000) がどれも複数になる大きさにする
+    write_records(str(tmp_path / 'commit_details.json'), generate_commit_details(commits=1200, file_count=3000))
+    build(tmp_path, tmp_path / 'serial')
+    build(tmp_path, tmp_path / 'parallel', max_workers=4)
+    assert read_outputs(tmp_path / 'parallel') == read_outputs(tmp_path / 'serial')
+
+
+def as_set(records):
+    return {json.dumps(record, sort_keys=True) for record in records}
+
+def test_update_gives_the_same_graph_as_a_full_build(tmp_path):
+    commits = list(generate_commit_details(commits=80))
+    # 新しい順なので後ろの 50 件が先に作ったグラフになる
+    write_records(str(tmp_path / 'old.json'), commits[30:])
+    write_records(str(tmp_path / 'commit_details.json'), commits)
+    construct_pg.main(None, str(tmp_path / 'old.json'), str(tmp_path / 'updated'))
+    updated = build(tmp_path, tmp_path / 'updated', update=True)
+    full = build(tmp_path, tmp_path / 'full')
+    assert as_set(updated[0]) == as_set(full[0])
+    assert as_set(updated[1]) == as_set(full[1])
+    # 更新では新しいコミットが各ファイルの一覧の後ろに足されるので並びは比べない
+    updated_files, full_files = (json.loads((tmp_path / name / 'files.json').read_text()) for name in ('updated', 'full'))
+    for key in ('files', 'file_commit_dict'):
+        assert {filename: as_set(values) for filename, values in updated_files[key].items()} == {filename: as_set(values) for filename, values in full_files[key].items()}
+
+
+def test_a_failed_files_write_keeps_the_previous_graph(tmp_path, monkeypatch):
+    build(tmp_path, tmp_path / 'out')
+    files_before = (tmp_path / 'out' / 'files.json').read_bytes()
+    state_before = (tmp_path / 'out' / 'graph_state.json').read_bytes()
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+    monkeypatch.setattr(Classes, 'write_json_object', fail)
+    with pytest.raises(OSError):
+        build(tmp_path, tmp_path / 'out', update=True)
+    assert (tmp_path / 'out' / 'files.json').read_bytes() == files_before
+    assert (tmp_path / 'out' / 'graph_state.json').read_bytes() == state_before
+
+
+def exported_files(export_dir):
+    return sorted(os.path.relpath(os.path.join(directory, filename), export_dir) for directory, _, filenames in os.walk(export_dir) for filename in filenames)
+
+def test_export_replaces_the_previous_export(tmp_path):
+    build(tmp_path, tmp_path / 'out', export='csv', partition_by='year')
+    assert any(os.sep + 'year=' in path for path in exported_files(tmp_path / 'out' / 'export'))
+    build(tmp_path, tmp_path / 'out', export='csv')
+    paths = exported_files(tmp_path / 'out' / 'export')
+    assert paths and not any('year=' in path for path in paths)
+    build(tmp_path, tmp_path / 'fresh', export='csv')
+    assert paths == exported_files(tmp_path / 'fresh' / 'export')
+
+
+def test_a_rebuild_reuses_the_ids_saved_in_out_dir(tmp_path):
+    nodes, _ = build(tmp_path, tmp_path / 'out')
+    id_map = tmp_path / 'out' / 'id_map.tsv'
+    lines = id_map.read_text(encoding='utf-8').splitlines()
+    # 最初のノードに別の id を割り当てた id map から作り直す
+    key = lines[0].split('\t', 1)[1]
+    id_map.write_text('\n'.join([f"12345\t{key}"] + lines[1:]) + '\n', encoding='utf-8')
+    rebuilt, _ = build(tmp_path, tmp_path / 'out')
+    assert rebuilt[0]['id'] == 12345 and nodes[0]['id'] != 12345
+    assert [node['id'] for node in rebuilt[1:]] == [node['id'] for node in nodes[1:]]
+    assert len(id_map.read_text(encoding='utf-8').splitlines()) == len(lines)
@@ -0,0 +1,99 @@
+import json
+import pytest
+import requests
+import get_commit_data
+from Classes import ApiSetting, FetchJournal, TokenPool
+from records import iter_records
+from stub_github import StubGitHub
+from synthetic import generate_commit_details
+
+
+def test_update_into_a_new_directory_lists_everything(tmp_path):
+    commits = list(generate_commit_details(commits=30))
+    with StubGitHub(commits) as stub:
+        api_setting = ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']))
+        get_commit_data.main(api_setting, str(tmp_path), update=True)
+    details = list(iter_records(str(tmp_path / 'commit_details.json')))
+    assert [commit['sha'] for commit in details] == [commit['sha'] for commit in commits]
+
+
+def test_journal_drops_a_last_line_without_newline(tmp_path):
+    filepath = str(tmp_path / 'fetch_journal.jsonl')
+    with open(filepath, 'w', encoding='utf-8') as journal_file:
+        journal_file.write(json.dumps({'sha': 'a'}) + '\n' + json.dumps({'sha': 'b'}))
+    journal = FetchJournal(filepath)
+    assert 'a' in journal and 'b' not in journal
+    journal.append({'sha': 'c'})
+    journal.close()
+    with open(filepath, 'r', encoding='utf-8') as journal_file:
+        assert [json.loads(line)['sha'] for line in journal_file] == ['a', 'c']
+
+
+def fetch(tmp_path, commits, **options):
+    with StubGitHub(commits) as stub:
+        api_setting = ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']))
+        get_commit_data.main(api_setting, str(tmp_path), **options)
+        return stub.request_count, list(iter_records(str(tmp_path / 'commit_details.json')))
+
+
+def test_graphql_batches_commits_without_files(tmp_path):
+    commits = list(generate_commit_details(commits=120))
+    rest_requests, rest_details = fetch(tmp_path / 'rest', commits, with_files=False)
+    graphql_requests, graphql_details = fetch(tmp_path / 'graphql', commits, graphql=True, with_files=False)
+    # 一覧 2 ページと 50 件ずつの GraphQL 3 回
+    assert graphql_requests == 5 < rest_requests
+    # url は stub のポートを含むので比べない
+    strip = lambda commit: (commit['sha'], commit['commit'], commit['stats'], [parent['sha'] for parent in commit['parents']])
+    assert [strip(commit) for commit in graphql_details] == [strip(commit) for commit in rest_details]
+
+
+def test_graphql_with_files_uses_no_more_requests_than_rest(tmp_path):
+    commits = list(generate_commit_details(commits=60))
+    rest_requests, rest_details = fetch(tmp_path / 'rest', commits)
+    graphql_requests, graphql_details = fetch(tmp_path / 'graphql', commits, graphql=True)
+    assert graphql_requests <= rest_requests
+    assert [commit['files'] for commit in graphql_details] == [commit['files'] for commit in rest_details]
+
+
+def test_a_single_path_keeps_the_api_order(tmp_path):
+    commits = list(generate_commit_details(commits=40))
+    # コミット日時が前後していても API の並びを崩さない
+    commits[0]['commit']['committer']['date'], commits[-1]['commit']['committer']['date'] = commits[-1]['commit']['committer']['date'], commits[0]['commit']['committer']['date']
+    path = commits[0]['files'][0]['filename']
+    with StubGitHub(commits) as stub:
+        api_setting = ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']))
+        listed = get_commit_data.get_commits(api_setting, paths=[path])
+        expected = [commit['sha'] for commit in commits if any(path in (file['filename'], file.get('previous_filename')) for file in commit['files'])]
+    assert [commit['sha'] for commit in listed] == expected
+
+
+def test_a_failing_page_stops_the_listing(tmp_path, monkeypatch):
+    commits = list(generate_commit_details(commits=250))
+    fetch_commit_page = get_commit_data.fetch_commit_page
+    monkeypatch.setattr(get_commit_data, 'fetch_commit_page', lambda api_setting, params, page: None if page == 2 else fetch_commit_page(api_setting, params, page))
+    with StubGitHub(commits) as stub:
+        api_setting = ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']))
+        with pytest.raises(RuntimeError):
+            get_commit_data.main(api_setting, str(tmp_path))
+    assert not (tmp_path / 'commits.json').exists()
+
+
+def test_shifted_pages_are_deduplicated(tmp_path, monkeypatch):
+    commits = list(generate_commit_details(commits=250))
+    fetch_commit_page = get_commit_data.fetch_commit_page
+    # 一覧の途中で push されて2ページ目の先頭に1ページ目の末尾が再び現れた場合
+    monkeypatch.setattr(get_commit_data, 'fetch_commit_page', lambda api_setting, params, page: ([commits[99]] if page == 2 else []) + fetch_commit_page(api_setting, params, page))
+    with StubGitHub(commits) as stub:
+        api_setting = ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']))
+        listed = get_commit_data.get_commits(api_setting, 2)
+    assert [commit['sha'] for commit in listed] == [commit['sha'] for commit in commits]
+
+
+def test_stub_links_point_at_the_listing_endpoint():
+    commits = list(generate_commit_details(commits=250))
+    path = commits[0]['files'][0]['filename'].split('/')[0]
+    with StubGitHub(commits) as stub:
+        response = requests.get(stub.url('/repos/owner/repo/commits'), params={'per_page': 10, 'path': path})
+        next_url = response.links['next']['url']
+        assert next_url.startswith(stub.url('/repos/owner/repo/commits?'))
+        assert requests.get(next_url).json() == requests.get(stub.url('/repos/owner/repo/commits'), params={'per_page': 10, 'page': 2, 'path': path}).json()
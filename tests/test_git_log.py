@@ -0,0 +1,109 @@
+import os
+import subprocess
+import pytest
+import get_commit_data
+import pipeline
+from get_commit_data import iter_git_commits
+from records import iter_records
+
+pytestmark = pytest.mark.skipif(subprocess.run(['git', '--version'], capture_output=True).returncode != 0, reason='git is not installed')
+
+
+def git(repo, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME='dev', GIT_AUTHOR_EMAIL='dev@example.com', GIT_COMMITTER_NAME='dev', GIT_COMMITTER_EMAIL='dev@example.com',
+               GIT_AUTHOR_DATE='2020-01-01T00:00:00Z', GIT_COMMITTER_DATE='2020-01-01T00:00:00Z')
+    return subprocess.run(['git', '-C', str(repo)] + list(args), check=True, capture_output=True, env=env).stdout.decode('utf-8').strip()
+
+def write(repo, filename, content, mode='w'):
+    with open(os.path.join(repo, filename), mode) as file:
+        file.write(content)
+
+def commit(repo, message):
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-q', '-m', message)
+    return git(repo, 'rev-parse', 'HEAD')
+
+@pytest.fixture
+def repo(tmp_path):
+    git(tmp_path, 'init', '-q', '-b', 'main')
+    git(tmp_path, 'config', 'core.fileMode', 'true')
+    return tmp_path
+
+def read_commits(repo):
+    return {commit['sha']: commit for commit in iter_git_commits(str(repo), 'owner', 'repo')}
+
+
+def test_added_file_with_a_space_in_its_path(repo):
+    write(repo, 'a file.txt', 'one\ntwo\n')
+    sha = commit(repo, 'Add a file')
+    (file,) = read_commits(repo)[sha]['files']
+    assert file['filename'] == 'a file.txt'
+    assert (file['status'], file['additions'], file['deletions']) == ('added', 2, 0)
+    assert file['patch'] == '@@ -0,0 +1,2 @@\n+one\n+two'
+    assert file['blob_url'] == f"https://github.com/owner/repo/blob/{sha}/a file.txt"
+
+def test_rename(repo):
+    write(repo, 'old.txt', ''.join(f"line {i}\n" for i in range(20)))
+    commit(repo, 'Add')
+    git(repo, 'mv', 'old.txt', 'new.txt')
+    write(repo, 'new.txt', 'line 20\n', 'a')
+    sha = commit(repo, 'Rename')
+    (file,) = read_commits(repo)[sha]['files']
+    assert (file['filename'], file['previous_filename'], file['status']) == ('new.txt', 'old.txt', 'renamed')
+    assert (file['additions'], file['deletions']) == (1, 0)
+
+def test_binary_file_has_no_patch(repo):
+    write(repo, 'image.bin', b'\x00\x01\x02'.decode('latin-1'), 'w')
+    write(repo, 'text.txt', 'text\n')
+    sha = commit(repo, 'Add a binary file')
+    files = {file['filename']: file for file in read_commits(repo)[sha]['files']}
+    assert 'patch' not in files['image.bin']
+    assert (files['image.bin']['additions'], files['image.bin']['deletions']) == (0, 0)
+    assert files['text.txt']['patch'] == '@@ -0,0 +1 @@\n+text'
+
+def test_mode_only_change(repo):
+    write(repo, 'script.sh', 'echo hi\n')
+    commit(repo, 'Add a script')
+    os.chmod(os.path.join(repo, 'script.sh'), 0o755)
+    write(repo, 'other.txt', 'other\n')
+    sha = commit(repo, 'Make it executable')
+    files = {file['filename']: file for file in read_commits(repo)[sha]['files']}
+    assert (files['script.sh']['status'], files['script.sh']['changes']) == ('modified', 0)
+    assert 'patch' not in files['script.sh']
+    assert files['other.txt']['patch'] == '@@ -0,0 +1 @@\n+other'
+
+def test_merge_is_diffed_against_its_first_parent(repo):
+    write(repo, 'base.txt', 'base\n')
+    base = commit(repo, 'Base')
+    git(repo, 'checkout', '-q', '-b', 'topic')
+    write(repo, 'topic.txt', 'topic\n')
+    topic = commit(repo, 'Topic')
+    git(repo, 'checkout', '-q', 'main')
+    write(repo, 'main.txt', 'main\n')
+    main = commit(repo, 'Main')
+    git(repo, 'merge', '-q', '--no-ff', '-m', 'Merge topic', 'topic')
+    merge = git(repo, 'rev-parse', 'HEAD')
+    commits = read_commits(repo)
+    assert [parent['sha'] for parent in commits[merge]['parents']] == [main, topic]
+    assert [file['filename'] for file in commits[merge]['files']] == ['topic.txt']
+    assert set(commits) == {base, topic, main, merge}
+
+def test_message_containing_a_diff_header(repo):
+    message = 'Explain the diff\n\ndiff --git a/fake.txt b/fake.txt\n:100644 100644 0 0 M\tfake.txt\n1\t1\tfake.txt'
+    write(repo, 'real.txt', 'real\n')
+    sha = commit(repo, message)
+    commit_details = read_commits(repo)[sha]
+    assert commit_details['commit']['message'] == message
+    assert [file['filename'] for file in commit_details['files']] == ['real.txt']
+    assert commit_details['stats'] == {'total': 1, 'additions': 1, 'deletions': 0}
+
+
+def test_the_fetch_and_pipeline_backends_read_the_same_commits(repo, tmp_path):
+    write(repo, 'src.py', 'print(1)\n')
+    commit(repo, 'Add src')
+    write(repo, 'README', 'readme\n')
+    commit(repo, 'Add readme')
+    get_commit_data.main_from_git(str(repo), 'owner', 'repo', str(tmp_path / 'out'), paths=['src.py'])
+    fetched = list(iter_records(str(tmp_path / 'out' / 'commit_details.json')))
+    assert [commit['commit']['message'] for commit in fetched] == ['Add src']
+    assert list(pipeline.fetch_from_git(str(repo), 'owner', 'repo', paths=['src.py'])) == fetched
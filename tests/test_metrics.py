@@ -0,0 +1,49 @@
+import json
+import threading
+from Classes import ApiSetting, TokenPool
+from metrics import Metrics, metrics
+from stub_github import StubGitHub
+from synthetic import generate_commit_details
+
+
+def test_counters_gauges_and_histograms_in_both_formats(tmp_path):
+    registry = Metrics()
+    threads = [threading.Thread(target=lambda: [registry.inc('requests_total', status=200) for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    registry.inc('requests_total', status=404)
+    registry.set('graph_nodes', 42)
+    registry.observe('request_seconds', 0.02, endpoint='commits')
+    registry.observe('request_seconds', 3, endpoint='commits')
+    with registry.stage('build'):
+        pass
+
+    registry.write(str(tmp_path / 'metrics.json'))
+    snapshot = json.loads((tmp_path / 'metrics.json').read_text())
+    counters = {(counter['name'], counter['labels'].get('status')): counter['value'] for counter in snapshot['counters']}
+    assert counters == {('requests_total', 200): 4000, ('requests_total', 404): 1}
+    (histogram,) = [histogram for histogram in snapshot['histograms'] if histogram['name'] == 'request_seconds']
+    assert (histogram['count'], histogram['sum'], histogram['buckets']['0.025'], histogram['buckets']['+Inf']) == (2, 3.02, 1, 2)
+    assert any(histogram['labels'] == {'stage': 'build'} for histogram in snapshot['histograms'])
+
+    registry.write(str(tmp_path / 'metrics.prom'))
+    lines = (tmp_path / 'metrics.prom').read_text().splitlines()
+    assert lines.count('# TYPE requests_total counter') == 1
+    assert 'requests_total{status="200"} 4000' in lines
+    assert 'graph_nodes 42' in lines
+    assert 'request_seconds_bucket{endpoint="commits",le="0.025"} 1' in lines
+    assert 'request_seconds_count{endpoint="commits"} 2' in lines
+
+
+def test_requests_are_counted_instead_of_printed(capsys):
+    commits = list(generate_commit_details(commits=3))
+    before = {counter['labels'].get('status'): counter['value'] for counter in metrics.snapshot()['counters'] if counter['name'] == 'github_requests_total' and counter['labels'].get('endpoint') == 'commits/{sha}'}
+    with StubGitHub(commits) as stub:
+        api_setting = ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']))
+        for commit in commits:
+            api_setting.get_data('commits/' + commit['sha'])
+    after = {counter['labels'].get('status'): counter['value'] for counter in metrics.snapshot()['counters'] if counter['name'] == 'github_requests_total' and counter['labels'].get('endpoint') == 'commits/{sha}'}
+    assert after[200] - before.get(200, 0) == 3
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,47 @@
+import io
+import json
+import pytest
+from records import JsonDocumentReader, append_records, iter_records, write_records
+
+DOCUMENT = {
+    'a': [1, 23456789, -0.5e-3, True, None, 'x'],
+    'b "quoted"': {'nested': {'deep': ['あい', 'back\\\\slash', 'tab\\t', '']}},
+    'c': 1234567890123,
+    'd': [],
+    'e': {},
+}
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64])
+@pytest.mark.parametrize('indent', [None, 4])
+def test_reader_decodes_values_split_across_chunks(chunk_size, indent):
+    text = json.dumps(DOCUMENT, indent=indent, ensure_ascii=False)
+    items = list(JsonDocumentReader(io.StringIO(text), chunk_size).iter_items())
+    assert items == list(DOCUMENT.items())
+    array = json.dumps(list(DOCUMENT.values()), indent=indent)
+    assert list(JsonDocumentReader(io.StringIO(array), chunk_size)) == list(DOCUMENT.values())
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 64])
+def test_reader_keeps_raw_values_and_reads_nested_containers(chunk_size):
+    text = json.dumps(DOCUMENT, indent=4)
+    reader = JsonDocumentReader(io.StringIO(text), chunk_size)
+    raw = dict(reader.iter_items(raw=True))
+    assert {key: json.loads(value) for key, value in raw.items()} == DOCUMENT
+    assert raw['c'] == '1234567890123'
+    reader = JsonDocumentReader(io.StringIO(text), chunk_size)
+    for key in reader.iter_keys():
+        if key == 'b "quoted"':
+            assert list(reader.iter_items()) == [('nested', DOCUMENT[key]['nested'])]
+        else:
+            assert reader.decode() == DOCUMENT[key]
+
+def test_reader_rejects_a_truncated_document():
+    with pytest.raises((ValueError, json.JSONDecodeError)):
+        list(JsonDocumentReader(io.StringIO('[{"a": 1}, {"b": '), 4))
+
+@pytest.mark.parametrize('filename', ['records.json', 'records.jsonl', 'records.json.gz', 'records.jsonl.gz'])
+def test_records_round_trip_and_append(tmp_path, filename):
+    filepath = str(tmp_path / filename)
+    records = [{'sha': str(i), 'value': [i, {'nested': 'x' * i}]} for i in range(5)]
+    write_records(filepath, records[:3])
+    append_records(filepath, records[3:])
+    assert list(iter_records(filepath)) == records
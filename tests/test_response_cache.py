@@ -0,0 +1,52 @@
+from Classes import ApiSetting, ResponseCache, TokenPool
+from stub_github import StubGitHub
+from synthetic import generate_commit_details
+
+
+def api(stub, cache):
+    return ApiSetting('owner', 'repo', api_root=stub.url(), token_pool=TokenPool(['test']), cache=cache)
+
+
+def test_listing_is_revalidated_with_its_etag(tmp_path):
+    commits = list(generate_commit_details(commits=20))
+    with StubGitHub(commits) as stub:
+        api_setting = api(stub, ResponseCache(str(tmp_path)))
+        first = api_setting.get_data('commits', params={'per_page': 100})
+        remaining = stub.remaining
+        second = api_setting.get_data('commits', params={'per_page': 100})
+        assert stub.request_count == 2
+        # 304 はレートリミットを消費しない
+        assert stub.remaining == remaining
+    assert second == first
+    assert api_setting.usage()[0]['not_modified'] == 1
+
+
+def test_commit_details_are_served_from_the_cache_without_a_request(tmp_path):
+    commits = list(generate_commit_details(commits=5))
+    sha = commits[0]['sha']
+    with StubGitHub(commits) as stub:
+        assert api(stub, ResponseCache(str(tmp_path))).get_data('commits/' + sha) == commits[0]
+        # 別の実行でもディスク上のキャッシュから読む
+        assert api(stub, ResponseCache(str(tmp_path))).get_data('commits/' + sha) == commits[0]
+        assert stub.request_count == 1
+
+
+def test_least_recently_used_bodies_are_evicted(tmp_path):
+    commits = list(generate_commit_details(commits=10))
+    with StubGitHub(commits) as stub:
+        sizes = [len(stub.detail_body(commit['sha'])) for commit in commits]
+        max_bytes = sum(sizes[:4])
+        cache = ResponseCache(str(tmp_path), max_bytes)
+        api_setting = api(stub, cache)
+        for commit in commits:
+            api_setting.get_data('commits/' + commit['sha'])
+            # 最初のコミットは毎回読むので最近使ったものとして残る
+            assert cache.get(api_setting.base_url + 'commits/' + commits[0]['sha']) is not None
+        assert cache.total_bytes <= max_bytes
+        assert cache.get(api_setting.base_url + 'commits/' + commits[1]['sha']) is None
+        assert cache.get(api_setting.base_url + 'commits/' + commits[-1]['sha']) is not None
+        requests_before = stub.request_count
+        api_setting.get_data('commits/' + commits[1]['sha'])
+        assert stub.request_count == requests_before + 1
+    reloaded = ResponseCache(str(tmp_path), max_bytes)
+    assert reloaded.total_bytes == cache.total_bytes